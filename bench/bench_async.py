@@ -0,0 +1,95 @@
+# 同步/异步两条数据库路径的吞吐对比，需要本地postgresql，连接配置取config里的database
+# python bench/bench_async.py [并发数] [每轮秒数]
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import httpx
+from fastapi import FastAPI, Depends
+from pydantic import BaseModel
+from sqlalchemy import Column, Integer, String, DateTime, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from utils.config_utils import get_conf
+from utils.sal_utils import SqlalchemyConnect, SalBase, ModelCRUD, AsyncModelCRUD
+
+conf = get_conf()
+db_conf = dict(conf.database)
+db_conf['async_enable'] = True
+bench_db = SqlalchemyConnect(**db_conf)
+
+
+class BenchItem(bench_db.base, SalBase):
+    __tablename__ = 'bench_item'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(64))
+    create_time = Column(DateTime, server_default=func.now())
+
+
+class BenchId(BaseModel):
+    id: int
+
+
+ROWS = 1000
+crud = ModelCRUD(BenchItem)
+async_crud = AsyncModelCRUD(BenchItem)
+app = FastAPI()
+
+
+@app.get('/sync/{item_id}')
+def sync_get(item_id: int, db: Session = Depends(bench_db.get_db)):
+    return crud.get(db, BenchId(id=item_id)).to_dict()
+
+
+@app.get('/async/{item_id}')
+async def async_get(item_id: int, db: AsyncSession = Depends(bench_db.get_async_db)):
+    return (await async_crud.get(db, BenchId(id=item_id))).to_dict()
+
+
+def prepare():
+    bench_db.init_database()
+    db = bench_db.get_db_i()
+    try:
+        if db.query(BenchItem).count() < ROWS:
+            db.add_all([BenchItem(name=f'item{i}') for i in range(ROWS)])
+            db.commit()
+    finally:
+        db.close()
+
+
+async def run(path: str, concurrency: int, seconds: float):
+    done = 0
+    deadline = time.perf_counter() + seconds
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        async def worker(index):
+            nonlocal done
+            item_id = index % ROWS + 1
+            while time.perf_counter() < deadline:
+                response = await client.get(f'/{path}/{item_id}')
+                response.raise_for_status()
+                done += 1
+                item_id = item_id % ROWS + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(i) for i in range(concurrency)])
+        return done / (time.perf_counter() - start)
+
+
+async def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    prepare()
+    for path in ['sync', 'async']:
+        await run(path, 10, 1)  # 预热连接池
+        rps = await run(path, concurrency, seconds)
+        print(f'{path:5s}  并发 {concurrency}  {rps:10.1f} req/s')
+    await bench_db.async_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
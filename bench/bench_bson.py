@@ -0,0 +1,94 @@
+# pydantic模型转mongo文档的耗时：原来的json往返 对比 按字段计划直接转bson类型，不需要mongodb
+# python bench/bench_bson.py [条数]
+import json
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import bson
+from bson import Decimal128
+from pydantic import BaseModel
+
+from utils.mongo_utils import pydantic_to_mg_dict, pydantic_to_mg_dicts, pydantic_to_raw_bson
+
+
+class Action(str, Enum):
+    create = 'create'
+    update = 'update'
+
+
+class Operator(BaseModel):
+    id: int
+    name: str
+    dept: Optional[str] = None
+
+
+class AuditLog(BaseModel):
+    action: Action
+    table: str
+    row_id: int
+    operator: Operator
+    amount: Optional[Decimal] = None
+    changes: Dict[str, Optional[str]] = {}
+    tags: List[str] = []
+    ip: Optional[str] = None
+    create_time: datetime
+
+
+def legacy_to_mg_dict(data: BaseModel):
+    """
+    改之前的pydantic_to_mg_dict
+    """
+    return json.loads(data.json(exclude_none=True))
+
+
+def jsonable(value):
+    """
+    新结果转成json往返后的样子，用来和旧结果比较
+    """
+    if isinstance(value, dict):
+        return {key: jsonable(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [jsonable(item) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    return value
+
+
+def make_logs(count: int) -> List[AuditLog]:
+    now = datetime.now()
+    return [AuditLog(action=Action.update if i % 2 else Action.create, table='sys_user', row_id=i,
+                     operator=Operator(id=i % 20, name=f'user{i % 20}'), amount=Decimal('12.50'),
+                     changes={'name': f'old{i}', 'remark': None}, tags=['admin', 'web'], create_time=now)
+            for i in range(count)]
+
+
+def run(name, func, items, rounds=5):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(items)
+        spent = time.perf_counter() - start
+        best = spent if best is None else min(best, spent)
+    print(f'{name:36s} {len(items) / best:12.0f} docs/s')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logs = make_logs(count)
+    for log in logs[:100]:
+        assert jsonable(pydantic_to_mg_dict(log)) == legacy_to_mg_dict(log)
+    run('json往返(旧)', lambda items: [legacy_to_mg_dict(item) for item in items], logs)
+    run('model_dump(exclude_none)', lambda items: [item.model_dump(exclude_none=True) for item in items], logs)
+    run('pydantic_to_mg_dict', lambda items: [pydantic_to_mg_dict(item) for item in items], logs)
+    run('pydantic_to_mg_dicts', pydantic_to_mg_dicts, logs)
+    run('json往返+bson.encode(旧)', lambda items: [bson.encode(legacy_to_mg_dict(item)) for item in items], logs)
+    run('pydantic_to_raw_bson', pydantic_to_raw_bson, logs)
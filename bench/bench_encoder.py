@@ -0,0 +1,105 @@
+# 列表接口序列化的耗时：旧的to_full_dict+jsonable_encoder+json 对比 预编译的行编码器+orjson，不需要数据库
+# python bench/bench_encoder.py [行数]
+import json
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import Column, Integer, String, DateTime, Numeric, ForeignKey, JSON
+from sqlalchemy.orm import relationship
+
+from utils.response_utils import ORJsonResponse
+from utils.sal_utils import SqlalchemyConnect, SalBase, make_link_table, marge_col_names, encode_rows, QueryInclude
+
+bench_db = SqlalchemyConnect(db_type='postgresql')
+link_table = make_link_table(bench_db.base, 'bench_row', 'bench_tag')
+
+
+class BenchDept(bench_db.base, SalBase):
+    __tablename__ = 'bench_dept'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+
+
+class BenchTag(bench_db.base, SalBase):
+    __tablename__ = 'bench_tag'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+
+
+class BenchRow(bench_db.base, SalBase):
+    __tablename__ = 'bench_row'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+    price = Column(Numeric(10, 2))
+    extra = Column(JSON)
+    create_time = Column(DateTime)
+    update_time = Column(DateTime)
+    dept_id = Column(Integer, ForeignKey('bench_dept.id'))
+    dept = relationship('BenchDept')
+    tags = relationship('BenchTag', secondary=link_table)
+
+
+def legacy_to_dict(item, include=None, ex_include=None):
+    col_names = marge_col_names([c.name for c in item.__table__.columns], include, ex_include)
+    return {name: getattr(item, name) for name in col_names}
+
+
+def legacy_to_full_dict(item, include=None, ex_include=None, relation_use_id=False):
+    """
+    改成行编码器之前的to_full_dict
+    """
+    col_names = marge_col_names(set(item.model_config.cols.keys()), include, ex_include)
+    data = {}
+    for col_name in col_names:
+        col = item.model_config.cols[col_name]
+        col_val = getattr(item, col_name)
+        relation = col.relation
+        if relation and relation.relation_type in ['m2m', 'o2m']:
+            if relation_use_id:
+                data[col_name] = [getattr(child, relation.target_id_key) for child in col_val]
+            else:
+                data[col_name] = [legacy_to_dict(child) for child in col_val]
+        elif relation and relation.relation_type in ['o2o', 'm2o']:
+            data[col_name] = col_val and legacy_to_dict(col_val)
+        else:
+            data[col_name] = col_val
+    return data
+
+
+def make_rows(count: int):
+    depts = [BenchDept(id=i, name=f'dept{i}') for i in range(10)]
+    tags = [BenchTag(id=i, name=f'tag{i}') for i in range(20)]
+    now = datetime.now()
+    return [BenchRow(id=i, name=f'row{i}', price=Decimal('12.50'), extra={'k': i}, create_time=now, update_time=now,
+                     dept=depts[i % 10], tags=[tags[i % 20], tags[(i + 1) % 20]]) for i in range(count)]
+
+
+def run(name, func, rows, rounds=5):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(rows)
+        spent = time.perf_counter() - start
+        best = spent if best is None else min(best, spent)
+    print(f'{name:32s} {len(rows) / best:12.0f} rows/s')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench_db.init_model_configs()
+    rows = make_rows(count)
+    query_include = QueryInclude(relation_use_id=True)
+    assert [legacy_to_full_dict(row, relation_use_id=True) for row in rows[:100]] == \
+           encode_rows(BenchRow, rows[:100], query_include)
+    response = ORJsonResponse(content=None)
+    run('to_full_dict(旧)', lambda items: [legacy_to_full_dict(row, relation_use_id=True) for row in items], rows)
+    run('encode_rows', lambda items: encode_rows(BenchRow, items, query_include), rows)
+    run('旧: to_full_dict+jsonable+json', lambda items: json.dumps(
+        jsonable_encoder([legacy_to_full_dict(row, relation_use_id=True) for row in items])), rows)
+    run('新: encode_rows+orjson', lambda items: response.render(encode_rows(BenchRow, items, query_include)), rows)
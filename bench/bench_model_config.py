@@ -0,0 +1,44 @@
+# 启动时构建模型配置的耗时，不需要数据库
+# python bench/bench_model_config.py [模型数量]
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.orm import relationship
+
+from utils.sal_utils import SqlalchemyConnect, SalBase, make_link_table
+
+
+def make_models(base, count: int):
+    """
+    生成count个模型，每个模型有一个多对一、一个多对多关系和若干普通字段
+    """
+    models = []
+    for index in range(count):
+        name = f'bench_model_{index}'
+        attrs = {
+            '__tablename__': name,
+            'id': Column(Integer, primary_key=True),
+            'name': Column(String(64)),
+            'remark': Column(Text),
+            'create_time': Column(DateTime),
+        }
+        for col_index in range(10):
+            attrs[f'col_{col_index}'] = Column(String(32))
+        if index:
+            parent = f'bench_model_{index - 1}'
+            link_table = make_link_table(base, name, parent)
+            attrs['parent_id'] = Column(Integer, ForeignKey(f'{parent}.id'))
+            attrs['parent'] = relationship(f'BenchModel{index - 1}', foreign_keys=f'BenchModel{index}.parent_id')
+            attrs['links'] = relationship(f'BenchModel{index - 1}', secondary=link_table)
+        models.append(type(f'BenchModel{index}', (base, SalBase), attrs))
+    return models
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    bench_db = SqlalchemyConnect(db_type='postgresql')
+    make_models(bench_db.base, count)
+    bench_db.init_model_configs()
@@ -0,0 +1,82 @@
+# 改写前后的筛选条件在postgresql上的执行计划，需要本地postgresql，连接配置取config里的database
+# python bench/bench_predicates.py [行数]
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from sqlalchemy import Column, Integer, String, DateTime, Index, func, select, cast, text, literal_column
+
+from utils.config_utils import get_conf
+from utils.sal_utils import SqlalchemyConnect, SalBase, QueryParams, QueryParam, Explain, query_common_stmt
+
+bench_db = SqlalchemyConnect(**get_conf().database)
+
+
+class BenchEvent(bench_db.base, SalBase):
+    __tablename__ = 'bench_event'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+    create_time = Column(DateTime, index=True)
+    tags = Column(String(64))
+    __table_args__ = (
+        Index('ix_bench_event_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        Index('ix_bench_event_tags_array', func.string_to_array(literal_column('tags'), literal_column("','")),
+              postgresql_using='gin'),
+    )
+
+
+def prepare(db, rows: int):
+    with bench_db.engine.begin() as conn:
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    bench_db.init_database()
+    if db.execute(select(func.count()).select_from(BenchEvent)).scalar() >= rows:
+        return
+    db.execute(text(
+        "insert into bench_event (name, create_time, tags) "
+        "select 'event' || i, now() - (i || ' minutes')::interval, (i % 50) || ',' || (i % 7) "
+        "from generate_series(1, :rows) i"), {'rows': rows})
+    db.execute(text('analyze bench_event'))
+    db.commit()
+
+
+def plan_nodes(plan: dict) -> list:
+    nodes = [f"{plan['Node Type']}{' on ' + plan['Index Name'] if plan.get('Index Name') else ''}"]
+    for child in plan.get('Plans', []):
+        nodes += plan_nodes(child)
+    return nodes
+
+
+def explain(db, stmt, binds=None) -> str:
+    result = db.execute(Explain(stmt), binds).scalar()
+    result = json.loads(result) if isinstance(result, str) else result
+    return ' -> '.join(plan_nodes(result[0]['Plan']))
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    db = bench_db.get_db_i()
+    try:
+        prepare(db, rows)
+        day = db.execute(select(func.date(func.max(BenchEvent.create_time)))).scalar()
+        cases = [
+            ('datetime按天',
+             select(BenchEvent).where(func.date(BenchEvent.create_time) == day),
+             QueryParam(name='create_time', type='=', value=str(day))),
+            ('字符串like',
+             select(BenchEvent).where(cast(BenchEvent.name, String).like('%event12%')),
+             QueryParam(name='name', type='like', value='event12')),
+            ('find_in_set',
+             select(BenchEvent).where(text("',' || tags || ',' like '%,3,%'")),
+             QueryParam(name='tags', type='find_in_set', value=3)),
+        ]
+        for name, old_stmt, param in cases:
+            stmt, _, _, binds = query_common_stmt(BenchEvent, QueryParams(page_size=20, params=[param]), 'postgresql')
+            print(f'{name}\n  改写前: {explain(db, old_stmt)}\n  改写后: {explain(db, stmt, binds)}')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
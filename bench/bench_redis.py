@@ -0,0 +1,88 @@
+# 异步redis逐条命令和pipeline批量的吞吐对比，需要本地redis-server，连接配置取config里的redis
+# python bench/bench_redis.py [key数量]
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from utils.config_utils import get_conf
+from utils.redis_utils import AsyncRedisPool, RedisPool
+
+PREFIX = 'bench:redis:'
+
+
+def report(name, count, spent):
+    print(f'{name:28s} {count / spent:12.0f} keys/s')
+
+
+def run_sync(pool: RedisPool, keys, mapping):
+    conn = pool.conn
+    start = time.perf_counter()
+    for key in keys:
+        conn.set(key, mapping[key])
+    report('同步 逐条SET', len(keys), time.perf_counter() - start)
+    start = time.perf_counter()
+    for key in keys:
+        conn.get(key)
+    report('同步 逐条GET', len(keys), time.perf_counter() - start)
+
+
+async def run_async(pool: AsyncRedisPool, keys, mapping):
+    conn = pool.conn
+    start = time.perf_counter()
+    for key in keys:
+        await conn.set(key, mapping[key])
+    report('异步 逐条SET', len(keys), time.perf_counter() - start)
+    start = time.perf_counter()
+    for key in keys:
+        await conn.get(key)
+    report('异步 逐条GET', len(keys), time.perf_counter() - start)
+    # 并发数和连接池大小一样
+    semaphore = asyncio.Semaphore(pool.max_connections)
+
+    async def get(key):
+        async with semaphore:
+            return await conn.get(key)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[get(key) for key in keys])
+    report(f'异步 并发GET({pool.max_connections})', len(keys), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await pool.mset(mapping)
+    report('异步 pipeline MSET', len(keys), time.perf_counter() - start)
+    start = time.perf_counter()
+    await pool.mset(mapping, ex=300)
+    report('异步 pipeline SET EX', len(keys), time.perf_counter() - start)
+    start = time.perf_counter()
+    values = await pool.mget(keys)
+    report('异步 pipeline MGET', len(keys), time.perf_counter() - start)
+    assert values == [mapping[key] for key in keys]
+    start = time.perf_counter()
+    await pool.expire_many(keys, 300)
+    report('异步 pipeline EXPIRE', len(keys), time.perf_counter() - start)
+    start = time.perf_counter()
+    for key in keys[:2000]:
+        await pool.run_script('incr_expire', [key + ':n'], [300])
+    report('异步 lua incr_expire', min(len(keys), 2000), time.perf_counter() - start)
+    await pool.conn.delete(*keys, *[key + ':n' for key in keys[:2000]])
+    await pool.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    conf = get_conf()
+    keys = [f'{PREFIX}{i}' for i in range(count)]
+    mapping = {key: str(i) for i, key in enumerate(keys)}
+    pool = RedisPool(**conf.redis)
+    pool.connect()
+    run_sync(pool, keys, mapping)
+    async_pool = AsyncRedisPool(**conf.redis)
+    async_pool.connect()
+    asyncio.run(run_async(async_pool, keys, mapping))
+
+
+if __name__ == '__main__':
+    main()
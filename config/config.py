@@ -3,6 +3,11 @@ class Dev:
         title = "系统"
         sys_name = 'admin'
         port = 8888  # 端口
+        slow_sql_ms = 200  # 超过这个耗时的SQL打印慢日志
+        n_plus_one = 10  # 一个请求里同一语句执行超过这个次数报N+1
+        profile_token = ''  # 请求头 X-Profile 带这个值时采样这次请求的调用栈，空为关闭
+        profile_sample_rate = 0  # 随机采样的请求比例，0~1
+        profile_dir = 'profiles'  # 单次采样的调用栈文件目录，不能放在static_dir下
 
     class database:
         db_type = "postgresql"
@@ -10,20 +15,39 @@ class Dev:
         user = 'postgres'
         password = "12345"
         db = 'fastapi_rest_admin'
+        async_enable = False  # 开启异步引擎，需要安装对应驱动 asyncpg/aiomysql
+        pool_size = 5  # 连接池常驻连接数
+        max_overflow = 10  # 用满后最多再开的连接数
+        pool_timeout = 30  # 取连接最多等待秒数
+        pool_recycle = 3600 * 4  # 连接最长使用秒数
+        pool_pre_ping = False  # 取连接时先ping一下
+        pool_use_lifo = False  # 后进先出，空闲时多余的连接能按pool_recycle回收
+        replicas = []  # 从库，host字符串或{"host":..., "user":..., "password":..., "db":...}，没写的项和主库一样
+        replica_strategy = 'round_robin'  # 从库选择方式 round_robin/least_conn
+        replica_retry_seconds = 30  # 从库出错后摘掉的秒数
 
     class redis:
         host = "127.0.0.1"
         port = 6379
+        max_connections = 10  # 同步连接池大小
+        async_max_connections = 50  # 异步连接池大小
+        pool_timeout = 5  # 异步连接池用满时等待秒数
 
     class mongo:
         host = "127.0.0.1"
         port = "27017"
         db = 'fastapi_rest_admin'
+        max_pool_size = 100  # 连接池大小，同步和异步客户端各一个
 
 
 class Prod:
     class app:  # 系统配置
         port = 8888  # 端口
+        slow_sql_ms = 200  # 超过这个耗时的SQL打印慢日志
+        n_plus_one = 10  # 一个请求里同一语句执行超过这个次数报N+1
+        profile_token = ''  # 请求头 X-Profile 带这个值时采样这次请求的调用栈，空为关闭
+        profile_sample_rate = 0  # 随机采样的请求比例，0~1
+        profile_dir = 'profiles'  # 单次采样的调用栈文件目录，不能放在static_dir下
 
     class database:
         db_type = "postgresql"
@@ -31,12 +55,26 @@ class Prod:
         user = 'postgres'
         password = "12345"
         db = 'fastapi_rest_admin'
+        async_enable = False  # 开启异步引擎，需要安装对应驱动 asyncpg/aiomysql
+        pool_size = 5  # 连接池常驻连接数
+        max_overflow = 10  # 用满后最多再开的连接数
+        pool_timeout = 30  # 取连接最多等待秒数
+        pool_recycle = 3600 * 4  # 连接最长使用秒数
+        pool_pre_ping = False  # 取连接时先ping一下
+        pool_use_lifo = False  # 后进先出，空闲时多余的连接能按pool_recycle回收
+        replicas = []  # 从库，host字符串或{"host":..., "user":..., "password":..., "db":...}，没写的项和主库一样
+        replica_strategy = 'round_robin'  # 从库选择方式 round_robin/least_conn
+        replica_retry_seconds = 30  # 从库出错后摘掉的秒数
 
     class redis:
         host = "127.0.0.1"
         port = 6379
+        max_connections = 10  # 同步连接池大小
+        async_max_connections = 50  # 异步连接池大小
+        pool_timeout = 5  # 异步连接池用满时等待秒数
 
     class mongo:
         host = "127.0.0.1"
         port = "27017"
         db = 'fastapi_rest_admin'
+        max_pool_size = 100  # 连接池大小，同步和异步客户端各一个
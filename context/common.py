@@ -1,6 +1,8 @@
+from utils.cache_utils import EntityCache, QueryCache
 from utils.config_utils import get_conf
-from utils.mongo_utils import MongoConnect
-from utils.redis_utils import RedisPool
+from utils.metrics_utils import SqlMetrics, metrics_registry, pool_collector, cache_collector
+from utils.mongo_utils import MongoConnect, AsyncMongoConnect
+from utils.redis_utils import RedisPool, AsyncRedisPool
 from utils.sal_utils import SqlalchemyConnect
 
 # 获取配置数据，并给v(value)添加类型提示
@@ -9,15 +11,41 @@ conf = get_conf()
 # 数据库，一种类型的数据库尽量就一个
 common_db = SqlalchemyConnect(**conf.database)
 
+# sql监控，指标在 /{sys_name}/metrics
+sql_metrics = SqlMetrics(slow_seconds=conf.app.get('slow_sql_ms', 200) / 1000,
+                         n_plus_one=conf.app.get('n_plus_one', 10))
+sql_metrics.instrument(common_db.engine)
+if common_db.async_engine:
+    sql_metrics.instrument(common_db.async_engine.sync_engine)
+for router in [common_db.replica_router, common_db.async_replica_router]:
+    for replica_engine in router.engines if router else []:
+        sql_metrics.instrument(replica_engine)
+metrics_registry.register(pool_collector(common_db))
+
 # redis连接池
 redis_pool = RedisPool(**conf.redis)
 redis_pool.connect()
+# 异步redis，async接口里用，不阻塞事件循环
+async_redis_pool = AsyncRedisPool(**conf.redis)
+async_redis_pool.connect()
+
+# 实体缓存，ModelCRUD(model, cache=entity_cache)时get_dict走redis
+entity_cache = EntityCache(redis_pool.conn)
+# 列表查询缓存，ModelCRUD(model, query_cache=query_cache)时query_page_dict走缓存
+query_cache = QueryCache(redis_pool.conn)
+metrics_registry.register(cache_collector(entity_cache, query_cache))
 
 # mongodb
 mg_db = MongoConnect(**conf.mongo)
+# 异步mongodb，async接口里用
+async_mg_db = AsyncMongoConnect(**conf.mongo)
 
 
 class ctx:
     conf = conf
     common_db = common_db
+    sql_metrics = sql_metrics
     redis_pool = redis_pool
+    async_redis_pool = async_redis_pool
+    entity_cache = entity_cache
+    query_cache = query_cache
@@ -7,11 +7,14 @@ except Exception as e:
 import os.path
 from pathlib import Path
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 from config.log import uvicorn_log_config
-from context.common import conf, common_db
+from context.common import conf, common_db, sql_metrics
+from utils.metrics_utils import SqlMetricsMiddleware, metrics_registry
+from utils.profile_utils import SamplingProfiler, ProfileMiddleware, profile_token_checker, profile_endpoints
+from utils.response_utils import ORJsonResponse
 
 
 def init_app():
@@ -24,6 +27,7 @@ def init_app():
         version=app_conf.get('version', "v1.0.0"),
         docs_url=f"/{sys_name}/docs",
         openapi_url=f"/{sys_name}/openapi.json",
+        default_response_class=ORJsonResponse,
     )
 
     # 挂载静态目录
@@ -40,7 +44,24 @@ def init_app():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # sql监控
+    app.add_middleware(SqlMetricsMiddleware, sql_metrics=sql_metrics)
+    # 采样分析，请求头 X-Profile: {profile_token} 或按比例随机采样
+    profiler = SamplingProfiler(interval=app_conf.get('profile_interval_ms', 5) / 1000)
+    profile_token = app_conf.get('profile_token', '')
+    # 调用栈文件不放静态目录，只能带token下载
+    profile_dir = Path(app_conf.get('profile_dir', 'profiles'))
+    app.add_middleware(ProfileMiddleware, profiler=profiler, token=profile_token,
+                       sample_rate=app_conf.get('profile_sample_rate', 0),
+                       profile_dir=profile_dir, profile_url=f"/{sys_name}/profile/collapsed",
+                       exclude=(f"/{sys_name}/profile/", f"/{sys_name}/metrics"))
     app.router.prefix = f"/{sys_name}"
+    app.add_api_route("/metrics", metrics_registry.endpoint(), include_in_schema=False)
+    for path, endpoint in profile_endpoints(profiler, profile_dir):
+        app.add_api_route(path, endpoint, include_in_schema=False,
+                          dependencies=[Depends(profile_token_checker(profile_token))])
+    # 模型配置
+    common_db.init_model_configs()
     help.print(f"接口文档链接:  http://127.0.0.1:{conf.app.port}{app.docs_url}")
     return app
 
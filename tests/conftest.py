@@ -0,0 +1,75 @@
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Uuid, create_engine
+from sqlalchemy.orm import relationship
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from utils.sal_utils import SqlalchemyConnect, SalBase, make_link_table
+
+# 测试用内存sqlite，不需要mysql/postgresql
+conn = SqlalchemyConnect(db_type='sqlite')
+conn.engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+Base = conn.base
+user_role = make_link_table(Base, 'user', 'role')
+
+
+class Dept(Base, SalBase):
+    __tablename__ = 'dept'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    users = relationship('User', back_populates='dept')
+
+
+class Role(Base, SalBase):
+    __tablename__ = 'role'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    users = relationship('User', secondary=user_role, back_populates='roles', collection_class=set)
+
+
+class User(Base, SalBase):
+    __tablename__ = 'user'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+    age = Column(Integer)
+    token = Column(Uuid)
+    create_time = Column(DateTime, default=datetime.now)
+    dept_id = Column(Integer, ForeignKey('dept.id'))
+    dept = relationship('Dept', back_populates='users')
+    roles = relationship('Role', secondary=user_role, back_populates='users', collection_class=set)
+
+
+TOKENS = [uuid.UUID(int=i) for i in range(20)]
+
+
+def seed():
+    Base.metadata.create_all(conn.engine)
+    db = conn.get_db_i()
+    depts = [Dept(name=f'd{i}') for i in range(3)]
+    roles = [Role(name=f'r{i}') for i in range(4)]
+    db.add_all(depts + roles)
+    for i in range(20):
+        user = User(name=f'user{i}', age=i % 10, token=TOKENS[i], dept=depts[i % 3],
+                    create_time=datetime(2024, 1, 1 + i, 12, 0))
+        user.roles = {roles[i % 4], roles[(i + 1) % 4]}
+        db.add(user)
+    db.commit()
+    db.close()
+
+
+seed()
+
+
+@pytest.fixture
+def db():
+    session = conn.get_db_i()
+    try:
+        yield session
+    finally:
+        session.close()
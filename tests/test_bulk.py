@@ -0,0 +1,43 @@
+import asyncio
+import threading
+
+import pytest
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from utils.sal_utils import AsyncModelCRUD
+
+from conftest import Base, Dept
+
+pytest.importorskip('aiosqlite')
+
+
+class DeptIn(BaseModel):
+    name: str
+
+
+class RecordingCRUD(AsyncModelCRUD):
+    def __init__(self, model):
+        super().__init__(model)
+        self.write_threads = []
+
+    def after_write(self, ids: list, data_list=()):
+        self.write_threads.append((threading.get_ident(), list(ids)))
+
+
+def test_async_bulk_after_write_off_event_loop(tmp_path):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'bulk.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        crud = RecordingCRUD(Dept)
+        async with async_sessionmaker(engine)() as db:
+            result = await crud.bulk_add(db, [DeptIn(name='a'), DeptIn(name='b')])
+        await engine.dispose()
+        return threading.get_ident(), result, crud.write_threads
+
+    loop_thread, result, write_threads = asyncio.run(run())
+    assert result.success == 2
+    assert [ids for _, ids in write_threads] == [result.ids]
+    # 缓存失效是阻塞的redis调用，不能在事件循环线程里跑
+    assert write_threads[0][0] != loop_thread
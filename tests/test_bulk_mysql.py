@@ -0,0 +1,111 @@
+from contextlib import nullcontext
+from typing import Optional
+
+import pytest
+from pydantic import BaseModel
+from sqlalchemy.dialects import mysql
+
+from utils.sal_utils import ModelCRUD
+
+from conftest import Dept
+
+
+class DeptIn(BaseModel):
+    id: Optional[int] = None
+    name: str
+
+
+class FakeResult:
+    def __init__(self, lastrowid=None, rowcount=0, value=None):
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+        self.value = value
+        self.inserted_primary_key = (lastrowid,)
+
+    def scalar(self):
+        return self.value
+
+
+class FakeBind:
+    dialect = mysql.dialect()
+
+
+class FakeMysqlSession:
+    """
+    按mysql的规则模拟dept表：没有RETURNING，多行INSERT的lastrowid是第一个自增id，自增id间隔step
+    """
+
+    def __init__(self, step=1):
+        self.step = step
+        self.rows = {}
+        self.next_id = 1
+        self.info = {}
+
+    def get_bind(self):
+        return FakeBind()
+
+    def begin_nested(self):
+        return nullcontext()
+
+    def commit(self):
+        pass
+
+    def insert(self, values: dict) -> int:
+        id_value = values.get('id')
+        if id_value is None:
+            id_value = self.next_id
+            self.next_id += self.step
+        else:
+            self.next_id = max(self.next_id, id_value + 1)
+        self.rows[id_value] = values['name']
+        return id_value
+
+    def execute(self, stmt, params=None):
+        compiled = stmt.compile(dialect=mysql.dialect())
+        sql = str(compiled)
+        if 'auto_increment_increment' in sql:
+            return FakeResult(value=self.step)
+        assert sql.startswith('INSERT INTO dept')
+        if params is not None:
+            # executemany，带id的数据
+            for row in params:
+                self.insert(row)
+            return FakeResult(rowcount=len(params))
+        values = compiled.params
+        count = sql.split('VALUES', 1)[1].count('(')
+        if count == 1:
+            return FakeResult(lastrowid=self.insert({'id': values.get('id'), 'name': values['name']}), rowcount=1)
+        assert 'id' not in sql.split('VALUES', 1)[0].replace('INSERT INTO dept', '')
+        ids = [self.insert({'name': values[f'name_m{index}']}) for index in range(count)]
+        return FakeResult(lastrowid=ids[0], rowcount=count)
+
+
+def bulk_add(db, data_list):
+    result = ModelCRUD(Dept).bulk_add(db, data_list)
+    assert not result.errors
+    return result.ids
+
+
+@pytest.mark.parametrize('step', [1, 2])
+def test_bulk_add_autoincrement(step):
+    db = FakeMysqlSession(step)
+    ids = bulk_add(db, [DeptIn(name='a'), DeptIn(name='b'), DeptIn(name='c')])
+    assert ids == [1, 1 + step, 1 + 2 * step]
+    assert [db.rows[id_value] for id_value in ids] == ['a', 'b', 'c']
+
+
+def test_bulk_add_explicit_ids():
+    db = FakeMysqlSession()
+    assert bulk_add(db, [DeptIn(id=10, name='a'), DeptIn(id=20, name='b')]) == [10, 20]
+    assert db.rows == {10: 'a', 20: 'b'}
+
+
+@pytest.mark.parametrize('unset', [True, False])
+def test_bulk_add_mixed_ids(unset):
+    db = FakeMysqlSession()
+    # unset为False时id=None也在提交的字段里，和带id的数据分在同一组
+    auto = (lambda name: DeptIn(name=name)) if unset else (lambda name: DeptIn(id=None, name=name))
+    ids = bulk_add(db, [auto('a'), DeptIn(id=50, name='b'), auto('c'), DeptIn(id=60, name='d')])
+    assert ids[1] == 50 and ids[3] == 60
+    assert [db.rows[id_value] for id_value in ids] == ['a', 'b', 'c', 'd']
+    assert len(set(ids)) == 4
@@ -0,0 +1,46 @@
+import pytest
+
+from utils.cache_utils import EntityCache, QueryCache
+from utils.sal_utils import QueryParams
+
+from conftest import User
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def test_entity_cache_skips_fill_after_write():
+    cache = EntityCache(fakeredis.FakeRedis(decode_responses=True))
+    cache.set(User, 1, {'id': 1, 'name': 'a'})
+    assert cache.get(User, 1) == {'id': 1, 'name': 'a'}
+    cache.invalidate(User, [1])
+    # 刚写过，读到的可能是从库上的旧数据，不回填
+    cache.set(User, 1, {'id': 1, 'name': 'old'})
+    assert cache.get(User, 1) is None
+    cache.write_guard = 0
+    cache.set(User, 1, {'id': 1, 'name': 'b'})
+    assert cache.get(User, 1) == {'id': 1, 'name': 'b'}
+
+
+def test_query_cache_skips_after_write():
+    cache = QueryCache(fakeredis.FakeRedis(decode_responses=True))
+    params = QueryParams(page=1, page_size=10)
+    assert cache.key(User, params) is not None
+    cache.bump(User)
+    assert cache.key(User, params) is None
+
+
+def test_cache_metrics():
+    from utils.metrics_utils import cache_collector
+
+    entity_cache = EntityCache(fakeredis.FakeRedis(decode_responses=True))
+    query_cache = QueryCache(fakeredis.FakeRedis(decode_responses=True))
+    entity_cache.get(User, 1)
+    entity_cache.set(User, 1, {'id': 1})
+    entity_cache.get(User, 1)
+    entity_cache.invalidate(User, [1])
+    query_cache.bump(User)
+    text = '\n'.join(cache_collector(entity_cache, query_cache)())
+    assert 'entity_cache_hits_total{table="user"} 1' in text
+    assert 'entity_cache_misses_total{table="user"} 1' in text
+    assert 'entity_cache_invalidations_total 1' in text
+    assert 'query_cache_bumps_total 1' in text
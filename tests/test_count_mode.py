@@ -0,0 +1,42 @@
+import pytest
+
+from utils.sal_utils import QueryParams, QueryParam, query_page, query_rows
+
+from conftest import User
+
+AGE_PARAMS = [QueryParam(name='age', type='<', value=5)]
+
+
+def page(db, count_mode, page=1, params=None, reader=query_page):
+    return reader(db, User, QueryParams(page=page, page_size=8, count_mode=count_mode, params=params))
+
+
+@pytest.mark.parametrize('reader', [query_page, query_rows])
+@pytest.mark.parametrize('count_mode', ['exact', 'window', 'estimate'])
+def test_counted_modes(db, count_mode, reader):
+    first = page(db, count_mode, reader=reader)
+    assert first.count == 20 and first.has_more and len(first.items) == 8
+    last = page(db, count_mode, page=3, reader=reader)
+    assert last.count == 20 and not last.has_more and len(last.items) == 4
+    filtered = page(db, count_mode, params=AGE_PARAMS, reader=reader)
+    assert filtered.count == 10 and filtered.has_more
+
+
+@pytest.mark.parametrize('reader', [query_page, query_rows])
+def test_window_past_last_page(db, reader):
+    beyond = page(db, 'window', page=4, reader=reader)
+    assert beyond.items == [] and beyond.count == 20 and not beyond.has_more
+
+
+@pytest.mark.parametrize('reader', [query_page, query_rows])
+def test_none_mode_only_reports_has_more(db, reader):
+    first = page(db, 'none', reader=reader)
+    assert first.count is None and first.has_more and len(first.items) == 8
+    last = page(db, 'none', page=3, reader=reader)
+    assert last.count is None and not last.has_more and len(last.items) == 4
+
+
+def test_window_with_cursor_counts_exactly(db):
+    params = QueryParams(page_size=8, page_mode='cursor', count_mode='window')
+    page_data = query_page(db, User, params)
+    assert page_data.count == 20 and page_data.has_more
@@ -0,0 +1,64 @@
+import pytest
+from fastapi import HTTPException
+
+from utils.sal_utils import ModelCRUD, QueryParams, query_page
+
+from conftest import User
+
+crud = ModelCRUD(User)
+
+
+def cursor_page(db, order=None, **kwargs):
+    params = QueryParams(page_size=8, page_mode='cursor', order=order, count_mode='none', **kwargs)
+    return crud.query_page(db, params)
+
+
+def ids(page_data):
+    return [user.id for user in page_data.items]
+
+
+def test_after_walks_forward(db):
+    first = cursor_page(db)
+    assert ids(first) == list(range(1, 9))
+    assert first.has_more and first.before is None
+    second = cursor_page(db, after=first.after)
+    assert ids(second) == list(range(9, 17))
+    last = cursor_page(db, after=second.after)
+    assert ids(last) == list(range(17, 21))
+    assert not last.has_more and last.after is None
+    assert ids(cursor_page(db, before=last.before)) == list(range(9, 17))
+
+
+def test_before_walks_backward(db):
+    second = cursor_page(db, after=cursor_page(db).after)
+    back = cursor_page(db, before=second.before)
+    assert ids(back) == list(range(1, 9))
+    assert not back.has_more and back.before is None
+    assert back.after is not None
+
+
+def test_empty_before_is_last_page(db):
+    last = cursor_page(db, before='')
+    assert ids(last) == list(range(13, 21))
+    assert last.has_more and last.after is None
+    assert ids(cursor_page(db, before=last.before)) == list(range(5, 13))
+
+
+def test_cursor_with_duplicate_sort_values(db):
+    # age有重复值，游标要带上id才能不漏不重
+    order = {'age': 'desc'}
+    expected = [user.id for user in sorted(db.query(User), key=lambda user: (-user.age, user.id))]
+    seen, after = [], None
+    while True:
+        page_data = cursor_page(db, order=order, after=after)
+        seen += ids(page_data)
+        if not page_data.has_more:
+            break
+        after = page_data.after
+    assert seen == expected
+
+
+def test_bad_cursor(db):
+    with pytest.raises(HTTPException) as error:
+        query_page(db, User, QueryParams(page_size=8, page_mode='cursor', after='not-a-cursor'))
+    assert error.value.status_code == 400
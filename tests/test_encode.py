@@ -0,0 +1,13 @@
+from utils.sal_utils import get_row_encoder, row_encoders
+
+from conftest import User
+
+
+def test_row_encoder_cache_bounded(db):
+    user = db.query(User).first()
+    encoder = get_row_encoder(User, include=['id', 'name'])
+    assert get_row_encoder(User, include=['name', 'id', 'name']) is encoder
+    assert encoder(user) == user.to_full_dict(include=['id', 'name'])
+    for index in range(row_encoders.maxsize * 2):
+        get_row_encoder(User, include=['id', f'no_such_{index}'])
+    assert len(row_encoders.data) <= row_encoders.maxsize
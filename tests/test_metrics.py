@@ -0,0 +1,17 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from utils.metrics_utils import MetricsRegistry, SqlMetrics
+
+
+def test_failed_statement_does_not_leak_start_time():
+    engine = create_engine('sqlite://')
+    metrics = SqlMetrics(registry=MetricsRegistry())
+    metrics.instrument(engine)
+    with engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.execute(text('SELECT * FROM no_such_table'))
+        assert not conn.info.get('sql_metrics_start')
+        conn.execute(text('SELECT 1'))
+        assert not conn.info.get('sql_metrics_start')
@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+from typing import Optional, List
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+from pydantic import BaseModel
+from pymongo import ASCENDING, DESCENDING
+
+from utils.mongo_utils import MongoCRUD, pydantic_to_mg_dicts
+from utils.query_utils import QueryParams, QueryParam, encode_cursor
+
+
+class Log(BaseModel):
+    name: str
+    level: int
+    tags: List[str] = []
+    create_time: datetime
+
+
+class LogQuery(BaseModel):
+    name: Optional[str] = None
+    level: Optional[List[int]] = None
+    create_time: Optional[datetime] = None
+
+
+crud = MongoCRUD(Log, 'logs', filter_fields=['name', 'level', 'tags', 'create_time'])
+
+
+def params(**kwargs):
+    return QueryParams[LogQuery](page_size=kwargs.pop('page_size', 10), **kwargs)
+
+
+def test_filter_from_params():
+    plan = crud.query_plan(params(params=[
+        QueryParam(name='level', type='>=', value=1),
+        QueryParam(name='name', type='like', value='a.b'),
+        QueryParam(name='tags', type='find_in_set', value='x'),
+        QueryParam(name='create_time', type='=', value='2024-01-02'),
+        QueryParam(name='_id', type='in', value=['65a000000000000000000000']),
+    ]))
+    assert plan.filter == {
+        'level': {'$gte': 1},
+        'name': {'$regex': r'a\.b'},
+        'tags': 'x',
+        'create_time': {'$gte': datetime(2024, 1, 2), '$lt': datetime(2024, 1, 3)},
+        '_id': {'$in': [ObjectId('65a000000000000000000000')]},
+    }
+
+
+def test_filter_from_query_model_and_range():
+    plan = crud.query_plan(params(query=LogQuery(name='user', level=[1, 2]), params=[
+        QueryParam(name='create_time', type='range', value=['2024-01-02T00:00:00', None]),
+        QueryParam(name='level', type='<', value=5),
+    ]))
+    # level出现两次时用$and
+    assert plan.filter == {'$and': [
+        {'name': {'$regex': 'user'}},
+        {'level': {'$in': [1, 2]}},
+        {'create_time': {'$gte': datetime(2024, 1, 2)}},
+        {'level': {'$lt': 5}},
+    ]}
+
+
+def test_unknown_field_rejected():
+    with pytest.raises(HTTPException) as error:
+        crud.query_plan(params(params=[QueryParam(name='secret', type='=', value=1)]))
+    assert error.value.status_code == 400
+    with pytest.raises(HTTPException):
+        crud.query_plan(params(order={'secret': 'asc'}))
+
+
+def test_sort_skip_and_projection():
+    plan = crud.query_plan(params(page=3, order={'level': 'desc', 'name': None}, include=['name'],
+                                  count_mode='none'))
+    assert plan.sort == [('level', DESCENDING)]
+    assert (plan.skip, plan.limit) == (20, 11)
+    assert plan.projection == {'name': 1, 'level': 1}
+    assert crud.query_plan(params(ex_include=['tags'])).projection == {'tags': 0}
+
+
+def test_cursor_plan():
+    object_id = ObjectId()
+    cursor = encode_cursor([2, str(object_id)])
+    after = crud.query_plan(params(page_mode='cursor', order={'level': 'desc'}, after=cursor,
+                                   params=[QueryParam(name='level', type='>', value=0)]))
+    assert after.sort == [('level', DESCENDING), ('_id', ASCENDING)]
+    assert after.limit == 11 and after.skip == 0
+    assert after.page_filter == {
+        'level': {'$gt': 0},
+        '$or': [{'level': {'$lt': 2}}, {'level': 2, '_id': {'$gt': object_id}}],
+    }
+    last = crud.query_plan(params(page_mode='cursor', order={'level': 'desc'}, before=''))
+    assert last.sort == [('level', ASCENDING), ('_id', DESCENDING)]
+    assert last.page_filter == {}
+    with pytest.raises(HTTPException):
+        crud.query_plan(params(page_mode='cursor', after=encode_cursor([1, 2, 3])))
+
+
+class FakeConn:
+    def __init__(self, database):
+        self.database = database
+
+    def collection(self, dbname, sheet):
+        return self.database[sheet]
+
+
+@pytest.fixture
+def mg():
+    mongomock = pytest.importorskip('mongomock')
+    conn = FakeConn(mongomock.MongoClient()['test'])
+    base = datetime(2024, 1, 1, 10)
+    conn.database.logs.insert_many(pydantic_to_mg_dicts([
+        Log(name=f'user{i}', level=i % 3, tags=['a'] if i % 2 else ['b'], create_time=base + timedelta(hours=i))
+        for i in range(50)]))
+    return conn
+
+
+def test_query_page(mg):
+    page_data = crud.query_page_dict(mg, params(params=[QueryParam(name='level', type='=', value=1)],
+                                                order={'create_time': 'desc'}, include=['name']))
+    assert page_data['count'] == 17 and page_data['has_more']
+    assert page_data['items'][0]['name'] == 'user49'
+    assert set(page_data['items'][0]) == {'_id', 'name', 'create_time'}
+    assert isinstance(page_data['items'][0]['_id'], str)
+
+
+def test_cursor_pages_cover_collection(mg):
+    seen, after = [], None
+    while True:
+        page_data = crud.query_page_dict(mg, params(page_mode='cursor', order={'level': 'asc'}, after=after,
+                                                    page_size=7, count_mode='none'))
+        seen += [item['name'] for item in page_data['items']]
+        if not page_data['has_more']:
+            break
+        after = page_data['after']
+    assert len(seen) == len(set(seen)) == 50
+    assert [item['level'] for item in mg.database.logs.find({'name': {'$in': seen[:17]}})] == [0] * 17
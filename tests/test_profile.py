@@ -0,0 +1,57 @@
+import time
+
+import pytest
+from fastapi import FastAPI, Depends
+from starlette.staticfiles import StaticFiles
+
+from utils.profile_utils import SamplingProfiler, ProfileMiddleware, profile_token_checker, profile_endpoints
+
+testclient = pytest.importorskip('fastapi.testclient')
+
+
+@pytest.fixture
+def client(tmp_path):
+    static_dir, profile_dir = tmp_path / 'static', tmp_path / 'profiles'
+    static_dir.mkdir()
+    profiler = SamplingProfiler(interval=0.002)
+    app = FastAPI()
+    app.mount('/admin/static', StaticFiles(directory=static_dir), name='static')
+    app.add_middleware(ProfileMiddleware, profiler=profiler, token='tok', profile_dir=profile_dir,
+                       profile_url='/admin/profile/collapsed', exclude=('/admin/profile/',))
+    app.router.prefix = '/admin'
+
+    @app.get('/work')
+    def work():
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            sum(range(100))
+        return 1
+
+    for path, endpoint in profile_endpoints(profiler, profile_dir):
+        app.add_api_route(path, endpoint, dependencies=[Depends(profile_token_checker('tok'))])
+    with testclient.TestClient(app) as client:
+        client.static_dir, client.profile_dir = static_dir, profile_dir
+        yield client
+
+
+def test_profile_file_only_behind_token(client):
+    url = client.get('/admin/work', headers={'x-profile': 'tok'}).headers['x-profile-file']
+    file_name = url.split('file=')[1]
+    assert url.startswith('/admin/profile/collapsed?file=')
+    assert (client.profile_dir / file_name).is_file()
+    assert not list(client.static_dir.rglob('*.collapsed'))
+    assert client.get(url).status_code == 403
+    response = client.get(url, headers={'x-profile': 'tok'})
+    assert response.status_code == 200 and 'work' in response.text
+
+
+@pytest.mark.parametrize('file_name', ['../secret.collapsed', 'a/b.collapsed', 'x.txt', '.collapsed'])
+def test_profile_file_name_checked(client, file_name):
+    response = client.get('/admin/profile/collapsed', params={'file': file_name}, headers={'x-profile': 'tok'})
+    assert response.status_code == 400
+
+
+def test_missing_profile_file(client):
+    response = client.get('/admin/profile/collapsed', params={'file': 'none.collapsed'},
+                          headers={'x-profile': 'tok'})
+    assert response.status_code == 404
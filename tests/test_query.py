@@ -0,0 +1,21 @@
+from utils.sal_utils import ModelCRUD, QueryParams, QueryParam, query_common, query_rows
+
+from conftest import User, TOKENS
+
+crud = ModelCRUD(User)
+
+
+def test_empty_in_list(db):
+    params = QueryParams(page=1, page_size=10, params=[QueryParam(name='age', type='in', value=[])])
+    count, query, _, _ = query_common(db, User, params)
+    assert count == 0
+    page_data = crud.query_page(db, params)
+    assert page_data.count == 0 and page_data.items == []
+    assert query_rows(db, User, params).count == 0
+
+
+def test_like_uuid_column(db):
+    token = str(TOKENS[3])
+    params = QueryParams(page=1, page_size=10, params=[QueryParam(name='token', type='like', value=token[-6:])])
+    page_data = crud.query_page(db, params)
+    assert [user.token for user in page_data.items] == [TOKENS[3]]
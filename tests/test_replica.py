@@ -0,0 +1,80 @@
+import pytest
+from sqlalchemy import create_engine, select, text, insert
+from sqlalchemy.orm import sessionmaker
+
+from conftest import Base, Dept
+from utils.sal_utils import ReplicaRouter, RoutingSession, Explain
+
+
+def make_engine(path, name):
+    engine = create_engine(f'sqlite:///{path}', pool_pre_ping=True)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Dept).values(id=1, name=name))
+    return engine
+
+
+@pytest.fixture
+def primary(tmp_path):
+    return make_engine(tmp_path / 'primary.db', 'primary')
+
+
+@pytest.fixture
+def replica(tmp_path):
+    return make_engine(tmp_path / 'replica.db', 'replica')
+
+
+def make_session(primary, replicas):
+    router = ReplicaRouter(replicas)
+    factory = sessionmaker(bind=primary, class_=RoutingSession, info={'replica_router': router})
+    return factory(), router
+
+
+def dept_name(db):
+    return db.scalar(select(Dept.name).where(Dept.id == 1))
+
+
+def test_read_goes_to_replica(primary, replica):
+    db, _ = make_session(primary, [replica])
+    with db:
+        assert dept_name(db) == 'replica'
+        assert not db.info.get('primary')
+
+
+def test_read_your_writes_after_write(primary, replica):
+    db, _ = make_session(primary, [replica])
+    with db:
+        assert dept_name(db) == 'replica'
+        db.get(Dept, 1).name = 'changed'
+        db.flush()
+        assert db.info['primary']
+        assert dept_name(db) == 'changed'
+
+
+def test_read_only_statements_stay_on_replica(primary, replica):
+    db, _ = make_session(primary, [replica])
+    with db:
+        db.execute(Explain(select(Dept)))
+        readonly = text('select name from dept where id = 1').execution_options(readonly=True)
+        assert db.scalar(readonly) == 'replica'
+        assert not db.info.get('primary')
+        # 没标readonly的text看不出读写，按写处理
+        assert db.scalar(text('select name from dept where id = 1')) == 'primary'
+        assert db.info['primary']
+
+
+def test_dead_replica_is_ejected_before_the_read_fails(primary, replica, tmp_path):
+    dead = create_engine(f'sqlite:///{tmp_path / "missing" / "replica.db"}', pool_pre_ping=True)
+    db, router = make_session(primary, [dead, replica])
+    with db:
+        assert dept_name(db) == 'replica'
+    assert not router.is_healthy(dead)
+    assert router.errors == [1, 0]
+
+
+def test_all_replicas_dead_reads_primary(primary, tmp_path):
+    dead = create_engine(f'sqlite:///{tmp_path / "missing" / "replica.db"}')
+    db, router = make_session(primary, [dead])
+    with db:
+        assert dept_name(db) == 'primary'
+    assert not router.is_healthy(dead)
@@ -0,0 +1,65 @@
+from typing import Optional, List
+
+import pytest
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from utils.sal_utils import ModelCRUD
+
+from conftest import Base, Role, User
+
+
+class RoleIn(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str] = None
+
+
+class UserIn(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str] = None
+    roles: Optional[List[int]] = None
+
+
+@pytest.fixture
+def db(tmp_path):
+    # 单独的库，写操作不影响其他测试用的共享数据
+    engine = create_engine(f"sqlite:///{tmp_path / 'upsert.db'}")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    roles = [Role(id=i, name=f'r{i}') for i in range(1, 4)]
+    session.add_all(roles + [User(id=1, name='u1', roles={roles[0]})])
+    session.commit()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def test_bulk_upsert_updates_and_inserts_in_order(db):
+    items = ModelCRUD(Role).bulk_upsert(db, [RoleIn(id=3, name='new3'), RoleIn(id=5, name='r5'),
+                                             RoleIn(id=1, name='new1')])
+    assert [(item.id, item.name) for item in items] == [(3, 'new3'), (5, 'r5'), (1, 'new1')]
+    assert db.execute(select(Role.id, Role.name).order_by(Role.id)).all() == [
+        (1, 'new1'), (2, 'r2'), (3, 'new3'), (5, 'r5')]
+
+
+def test_bulk_upsert_missing_key(db):
+    with pytest.raises(HTTPException) as error:
+        ModelCRUD(Role).bulk_upsert(db, [RoleIn(id=1, name='a'), RoleIn(name='b')], upsert_keys=['id'])
+    assert error.value.status_code == 400
+    assert [item['index'] for item in error.value.detail] == [1]
+    assert db.scalar(select(Role.name).where(Role.id == 1)) == 'r1'
+
+
+def test_upsert_replaces_m2m(db):
+    crud = ModelCRUD(User)
+    user = crud.upsert(db, UserIn(id=1, name='renamed', roles=[2, 3]))
+    assert user.id == 1 and user.name == 'renamed'
+    db.expire_all()
+    assert {role.id for role in db.get(User, 1).roles} == {2, 3}
+    created = crud.upsert(db, UserIn(id=2, name='u2', roles=[1]))
+    db.expire_all()
+    assert created.id == 2 and {role.id for role in db.get(User, 2).roles} == {1}
@@ -0,0 +1,314 @@
+import hashlib
+import json
+from collections import OrderedDict
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, List, Optional, Type
+
+import redis
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import inspect as sa_inspect
+
+# 当前请求是否跳过缓存，用 Depends(cache_control) 按请求头设置
+cache_disabled: ContextVar[bool] = ContextVar('cache_disabled', default=False)
+
+
+async def cache_control(request: Request):
+    """
+    路由依赖，请求头带 Cache-Control: no-cache 时这次请求不读缓存
+    要用async依赖，同步依赖在线程池里跑，设置的ContextVar带不回接口
+    """
+    cache_disabled.set('no-cache' in request.headers.get('cache-control', ''))
+
+
+def include_shape(query_include=None) -> str:
+    if not query_include:
+        return 'full'
+    shape = [sorted(query_include.include or []), sorted(query_include.ex_include or []),
+             bool(query_include.relation_use_id)]
+    return hashlib.md5(json.dumps(shape).encode()).hexdigest()[:12]
+
+
+class EntityCache:
+    """
+    ModelCRUD.get_dict的redis读穿缓存，缓存to_full_dict的结果
+    实体key: {prefix}:e:{表名}:{id}:{include形状}
+    依赖集合: {prefix}:dep:{表名}:{id}，记录哪些实体key里包含了这条数据（自己以及把它当关联带出来的数据）
+    写入时删掉对应依赖集合里的所有key，数据库是准的，redis出错只当没命中
+    写入后write_guard秒内不回填改动过的数据，这时读到的可能是还没追上的从库
+    """
+
+    def __init__(self, conn: redis.Redis, prefix: str = 'sal', default_ttl: int = 300, write_guard: int = 3):
+        self.conn = conn
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.write_guard = write_guard
+        self.ttls: Dict[str, int] = {}
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self.errors = 0
+        self.invalidations = 0  # 写入后删掉的缓存key数
+        self.guarded = 0  # 刚写过没有回填的次数
+
+    def set_ttl(self, model: Type, seconds: int):
+        self.ttls[model.__tablename__] = seconds
+
+    def get_ttl(self, table: str) -> int:
+        return self.ttls.get(table, self.default_ttl)
+
+    def entity_key(self, table: str, id_value, shape: str) -> str:
+        return f"{self.prefix}:e:{table}:{id_value}:{shape}"
+
+    def dep_key(self, table: str, id_value) -> str:
+        return f"{self.prefix}:dep:{table}:{id_value}"
+
+    def guard_key(self, table: str, id_value) -> str:
+        return f"{self.prefix}:w:{table}:{id_value}"
+
+    def get(self, model: Type, id_value, query_include=None) -> Optional[dict]:
+        table = model.__tablename__
+        if cache_disabled.get():
+            return None
+        try:
+            value = self.conn.get(self.entity_key(table, id_value, include_shape(query_include)))
+        except redis.RedisError:
+            self.errors += 1
+            return None
+        if value is None:
+            self.misses[table] = self.misses.get(table, 0) + 1
+            return None
+        self.hits[table] = self.hits.get(table, 0) + 1
+        return json.loads(value)
+
+    def set(self, model: Type, id_value, data: dict, query_include=None) -> dict:
+        """
+        写入缓存，返回可以直接json序列化的数据，命中和不命中时接口拿到的是一样的内容
+        """
+        data = jsonable_encoder(data)
+        if cache_disabled.get():
+            return data
+        table = model.__tablename__
+        ttl = self.get_ttl(table)
+        key = self.entity_key(table, id_value, include_shape(query_include))
+        # 依赖集合比实体key活得久，免得实体还在依赖已经过期
+        dep_ttl = max([ttl, self.default_ttl, *self.ttls.values()])
+        deps = [(table, id_value)] + self.related_ids(model, data)
+        try:
+            if self.write_guard and self.conn.exists(*[self.guard_key(*dep) for dep in deps]):
+                self.guarded += 1
+                return data
+            pipe = self.conn.pipeline(transaction=False)
+            pipe.set(key, json.dumps(data, ensure_ascii=False), ex=ttl)
+            for dep in deps:
+                pipe.sadd(self.dep_key(*dep), key)
+                pipe.expire(self.dep_key(*dep), dep_ttl)
+            pipe.execute()
+        except redis.RedisError:
+            self.errors += 1
+        return data
+
+    def related_ids(self, model: Type, data: dict) -> List[tuple]:
+        """
+        从to_full_dict的结果里找出带出来的关联数据 [(表名, id)]
+        """
+        related = []
+        for col_name, col in model.model_config.cols.items():
+            relation = col.relation
+            if not relation or data.get(col_name) is None:
+                continue
+            value = data[col_name]
+            table = relation.target_model.__tablename__
+            for child in value if isinstance(value, list) else [value]:
+                child_id = child.get(relation.target_id_key) if isinstance(child, dict) else child
+                if child_id is not None:
+                    related.append((table, child_id))
+        return related
+
+    def written_ids(self, model: Type, data: dict) -> List[tuple]:
+        """
+        写入的数据新关联上的目标，这些目标缓存里的反向关系也变了
+        旧的关联在依赖集合里已经有记录
+        """
+        written = []
+        for col_name, col in model.model_config.cols.items():
+            relation = col.relation
+            if not relation:
+                continue
+            table = relation.target_model.__tablename__
+            value = data.get(col_name)
+            if relation.relation_type in ['m2m', 'o2m'] and value:
+                written += [(table, child.get(relation.target_id_key) if isinstance(child, dict) else child)
+                            for child in value]
+            elif relation.relation_type == 'm2o':
+                # 外键字段改了，新的目标下面多了这条数据
+                for column in sa_inspect(model).relationships[col_name].local_columns:
+                    if data.get(column.key) is not None:
+                        written.append((table, data[column.key]))
+        return written
+
+    def invalidate(self, model: Type, ids: list, data_list: List[dict] = ()):
+        table = model.__tablename__
+        deps = [(table, id_value) for id_value in ids]
+        for data in data_list:
+            deps += self.written_ids(model, data)
+        dep_keys = list({self.dep_key(*dep) for dep in deps})
+        if not dep_keys:
+            return
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            for dep_key in dep_keys:
+                pipe.smembers(dep_key)
+            keys = set(dep_keys)
+            for members in pipe.execute():
+                keys.update(members)
+            pipe = self.conn.pipeline(transaction=False)
+            pipe.delete(*keys)
+            self.invalidations += len(keys) - len(dep_keys)
+            if self.write_guard:
+                for dep in set(deps):
+                    pipe.set(self.guard_key(*dep), 1, ex=self.write_guard)
+            pipe.execute()
+        except redis.RedisError:
+            self.errors += 1
+
+    def stats(self) -> dict:
+        tables = sorted(set(self.hits) | set(self.misses))
+        return {
+            'errors': self.errors,
+            'invalidations': self.invalidations,
+            'guarded': self.guarded,
+            'tables': {table: {'hits': self.hits.get(table, 0), 'misses': self.misses.get(table, 0)}
+                       for table in tables},
+        }
+
+
+def model_tables(model: Type, write=False) -> List[str]:
+    """
+    查询结果依赖的表：自己、所有关系的目标表和中间表
+    写入时要通知的表：自己、多对多的中间表和目标表、一对多的目标表
+    """
+    tables = [model.__tablename__]
+    for col in model.model_config.cols.values():
+        relation = col.relation
+        if not relation or (write and relation.relation_type not in ['m2m', 'o2m']):
+            continue
+        tables.append(relation.target_model.__tablename__)
+        if relation.secondary is not None:
+            tables.append(relation.secondary.name)
+    return list(dict.fromkeys(tables))
+
+
+def query_params_hash(query_params) -> str:
+    """
+    QueryParams归一化后的hash，params的先后顺序不影响结果所以排序，order的先后是排序优先级要保留
+    """
+    data = query_params.dict(exclude_unset=True)
+    data['params'] = sorted(json.dumps(item, sort_keys=True, default=str) for item in data.get('params') or [])
+    data['order'] = list((data.get('order') or {}).items())
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class QueryCache:
+    """
+    列表查询结果缓存，key里带上相关表的版本号: {prefix}:q:{表名}:{各表版本号}:{查询参数hash}
+    写入时把相关表的版本号加一，旧key不会再被读到，等过期就行，不用记录每个key
+    进程内LRU放在redis前面，同一个key内容不会变，本地命中不用再读redis，只查一次版本号
+    相关表写入后write_guard秒内不走缓存，免得把从库上的旧数据存到新版本号下面
+    """
+
+    def __init__(self, conn: redis.Redis, prefix: str = 'sal', ttl: int = 60, local_size: int = 256,
+                 write_guard: int = 3):
+        self.conn = conn
+        self.prefix = prefix
+        self.ttl = ttl
+        self.write_guard = write_guard
+        self.local_size = local_size
+        self.local: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.local_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.bumps = 0  # 写入时更新版本号的次数
+        self.guarded = 0  # 相关表刚写过没走缓存的次数
+
+    def gen_key(self, table: str) -> str:
+        return f"{self.prefix}:gen:{table}"
+
+    def guard_key(self, table: str) -> str:
+        return f"{self.prefix}:w:{table}"
+
+    def key(self, model: Type, query_params) -> Optional[str]:
+        """
+        拿不到版本号或者相关表刚写过时返回None，这次不走缓存
+        """
+        if cache_disabled.get():
+            return None
+        tables = model_tables(model)
+        guards = [self.guard_key(table) for table in tables] if self.write_guard else []
+        try:
+            values = self.conn.mget([self.gen_key(table) for table in tables] + guards)
+        except redis.RedisError:
+            self.errors += 1
+            return None
+        gens = values[:len(tables)]
+        if any(values[len(tables):]):
+            self.guarded += 1
+            return None
+        gen = '.'.join(str(value or 0) for value in gens)
+        return f"{self.prefix}:q:{model.__tablename__}:{gen}:{query_params_hash(query_params)}"
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.lock:
+            if key in self.local:
+                self.local.move_to_end(key)
+                self.local_hits += 1
+                return self.local[key]
+        try:
+            value = self.conn.get(key)
+        except redis.RedisError:
+            self.errors += 1
+            return None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        data = json.loads(value)
+        self.set_local(key, data)
+        return data
+
+    def set_local(self, key: str, data: dict):
+        with self.lock:
+            self.local[key] = data
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def set(self, key: Optional[str], data: dict) -> dict:
+        data = jsonable_encoder(data)
+        if key is None:
+            return data
+        try:
+            self.conn.set(key, json.dumps(data, ensure_ascii=False), ex=self.ttl)
+        except redis.RedisError:
+            self.errors += 1
+            return data
+        self.set_local(key, data)
+        return data
+
+    def bump(self, model: Type):
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            for table in model_tables(model, write=True):
+                pipe.incr(self.gen_key(table))
+                if self.write_guard:
+                    pipe.set(self.guard_key(table), 1, ex=self.write_guard)
+            pipe.execute()
+            self.bumps += 1
+        except redis.RedisError:
+            self.errors += 1
+
+    def stats(self) -> dict:
+        return {'local_hits': self.local_hits, 'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+                'bumps': self.bumps, 'guarded': self.guarded, 'local_size': len(self.local)}
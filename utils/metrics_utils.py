@@ -0,0 +1,352 @@
+import re
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# 耗时分桶(秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 每个请求的语句数分桶
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def label_str(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in self.values.items():
+                lines.append(f'{self.name}{label_str(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        # 标签值 -> [各桶计数(不累加), 总和, 次数]
+        self.values: Dict[tuple, list] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_values, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    labels = label_str(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = label_str(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def gauge_lines(name: str, doc: str, values: Dict[tuple, float], labels: Tuple[str, ...] = (),
+                metric_type: str = 'gauge') -> List[str]:
+    """
+    收集时才算的指标(连接池、缓存统计)用这个输出，累计值metric_type传counter
+    """
+    lines = [f'# HELP {name} {doc}', f'# TYPE {name} {metric_type}']
+    for label_values, value in values.items():
+        lines.append(f'{name}{label_str(labels, label_values)} {value}')
+    return lines
+
+
+class MetricsRegistry:
+    """
+    /metrics 输出的所有指标，render时按注册顺序拼成prometheus文本格式
+    """
+
+    def __init__(self):
+        self.collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, collector: Callable[[], List[str]]):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        lines = []
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+    def endpoint(self):
+        async def metrics():
+            return PlainTextResponse(self.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+        return metrics
+
+
+metrics_registry = MetricsRegistry()
+
+# SqlalchemyConnect.pool_status()的字段 -> (指标名, 说明, 类型)
+POOL_METRICS = {
+    'size': ('db_pool_size', '连接池大小', 'gauge'),
+    'checked_in': ('db_pool_checked_in', '池里空闲的连接数', 'gauge'),
+    'checked_out': ('db_pool_checked_out', '借出去的连接数', 'gauge'),
+    'overflow': ('db_pool_overflow', '超出pool_size的连接数', 'gauge'),
+    'max_overflow': ('db_pool_max_overflow', '最多能超出pool_size的连接数', 'gauge'),
+    'waits': ('db_pool_waits_total', '取连接次数', 'counter'),
+    'wait_seconds': ('db_pool_wait_seconds_total', '取连接累计等待时间', 'counter'),
+    'max_wait_seconds': ('db_pool_max_wait_seconds', '取连接最长等待时间', 'gauge'),
+    'timeouts': ('db_pool_timeouts_total', '取连接超时次数', 'counter'),
+}
+
+
+def pool_collector(db, name: str = 'common') -> Callable[[], List[str]]:
+    """
+    metrics_registry.register(pool_collector(common_db)) 把连接池状态加到 /metrics
+    """
+
+    def collect() -> List[str]:
+        status = db.pool_status()
+        lines = []
+        for key, (metric, doc, metric_type) in POOL_METRICS.items():
+            values = {(name, engine): value[key] for engine, value in status.items() if key in value}
+            if values:
+                lines += gauge_lines(metric, doc, values, ('db', 'engine'), metric_type)
+        return lines
+
+    return collect
+
+# EntityCache.stats()/QueryCache.stats()的字段 -> (指标名, 说明, 类型)
+ENTITY_CACHE_METRICS = {
+    'errors': ('entity_cache_errors_total', '实体缓存redis出错次数', 'counter'),
+    'invalidations': ('entity_cache_invalidations_total', '写入后删掉的实体缓存key数', 'counter'),
+    'guarded': ('entity_cache_guarded_total', '刚写过没有回填实体缓存的次数', 'counter'),
+}
+QUERY_CACHE_METRICS = {
+    'local_hits': ('query_cache_local_hits_total', '列表查询缓存进程内命中次数', 'counter'),
+    'hits': ('query_cache_hits_total', '列表查询缓存redis命中次数', 'counter'),
+    'misses': ('query_cache_misses_total', '列表查询缓存没命中次数', 'counter'),
+    'errors': ('query_cache_errors_total', '列表查询缓存redis出错次数', 'counter'),
+    'bumps': ('query_cache_bumps_total', '写入时更新表版本号的次数', 'counter'),
+    'guarded': ('query_cache_guarded_total', '相关表刚写过没走缓存的次数', 'counter'),
+    'local_size': ('query_cache_local_size', '进程内缓存的查询数', 'gauge'),
+}
+
+
+def cache_collector(entity_cache=None, query_cache=None) -> Callable[[], List[str]]:
+    """
+    metrics_registry.register(cache_collector(entity_cache, query_cache)) 把缓存命中情况加到 /metrics
+    """
+
+    def collect() -> List[str]:
+        lines = []
+        if entity_cache is not None:
+            stats = entity_cache.stats()
+            tables = stats['tables']
+            lines += gauge_lines('entity_cache_hits_total', '实体缓存命中次数',
+                                 {(table,): value['hits'] for table, value in tables.items()}, ('table',), 'counter')
+            lines += gauge_lines('entity_cache_misses_total', '实体缓存没命中次数',
+                                 {(table,): value['misses'] for table, value in tables.items()}, ('table',),
+                                 'counter')
+            for key, (metric, doc, metric_type) in ENTITY_CACHE_METRICS.items():
+                lines += gauge_lines(metric, doc, {(): stats[key]}, (), metric_type)
+        if query_cache is not None:
+            stats = query_cache.stats()
+            for key, (metric, doc, metric_type) in QUERY_CACHE_METRICS.items():
+                lines += gauge_lines(metric, doc, {(): stats[key]}, (), metric_type)
+        return lines
+
+    return collect
+
+
+# 展开的 IN (?, ?, ?) 参数个数不同也算同一个语句
+_in_params = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+)\s*\)')
+_table_patterns = {
+    'select': re.compile(r'\bfrom\s+[`"]?(\w+)', re.I),
+    'insert': re.compile(r'\binto\s+[`"]?(\w+)', re.I),
+    'update': re.compile(r'^\s*update\s+[`"]?(\w+)', re.I),
+    'delete': re.compile(r'\bfrom\s+[`"]?(\w+)', re.I),
+}
+
+
+def param_shape(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return f'{type(value).__name__}[{len(value)}]'
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}({len(value)})'
+    return type(value).__name__
+
+
+def params_shape(parameters, executemany=False) -> str:
+    """
+    绑定参数只记类型和长度，不记值，慢日志里不会带出业务数据
+    """
+    if executemany:
+        return f'{len(parameters)} x {params_shape(parameters[0]) if parameters else "()"}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {param_shape(value)}' for key, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(param_shape(value) for value in parameters) + ')'
+    return param_shape(parameters)
+
+
+class RequestStats:
+    """
+    一次请求里执行的语句，按语句模板计数
+    """
+    __slots__ = ('queries', 'seconds', 'templates')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.templates: Dict[str, int] = {}
+
+
+# 当前请求的统计，中间件里设置，线程池和run_sync里拿到的是同一个对象
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+class SqlMetrics:
+    """
+    挂在engine的before/after_cursor_execute上，记录每条语句的耗时、行数
+    配合SqlMetricsMiddleware统计每个请求的语句数，同一个语句模板在一个请求里执行超过n_plus_one次时报N+1
+    """
+
+    def __init__(self, slow_seconds: float = 0.2, n_plus_one: int = 10, registry: MetricsRegistry = metrics_registry):
+        self.slow_seconds = slow_seconds
+        self.n_plus_one = n_plus_one
+        self.latency = Histogram('sql_statement_duration_seconds', 'SQL语句耗时', ('op', 'table'))
+        self.rows = Counter('sql_statement_rows_total', 'SQL语句返回或影响的行数', ('op', 'table'))
+        self.slow = Counter('sql_slow_statements_total', '慢SQL次数', ('op', 'table'))
+        self.request_queries = Histogram('sql_request_queries', '每个请求执行的SQL语句数', ('endpoint',),
+                                         buckets=COUNT_BUCKETS)
+        self.request_seconds = Histogram('sql_request_duration_seconds', '每个请求花在SQL上的时间', ('endpoint',))
+        self.n_plus_one_total = Counter('sql_n_plus_one_total', '请求里同一语句模板重复执行超过阈值的次数',
+                                        ('endpoint',))
+        for metric in [self.latency, self.rows, self.slow, self.request_queries, self.request_seconds,
+                       self.n_plus_one_total]:
+            registry.register(metric.render)
+        # 语句原文 -> (模板, op, 表名)，SQLAlchemy编译缓存让同一语句的文本重复出现
+        self.statements: Dict[str, Tuple[str, str, str]] = {}
+        self.engines = []
+
+    def statement_info(self, statement: str) -> Tuple[str, str, str]:
+        info = self.statements.get(statement)
+        if info is not None:
+            return info
+        template = ' '.join(_in_params.sub('(?)', statement).split())
+        op = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+        pattern = _table_patterns.get(op)
+        match = pattern and pattern.search(statement)
+        info = (template, op if pattern else 'other', match.group(1) if match else '')
+        if len(self.statements) < 10000:
+            self.statements[statement] = info
+        return info
+
+    def instrument(self, engine: Engine):
+        """
+        异步引擎传 async_engine.sync_engine
+        """
+        if engine is None or engine in self.engines:
+            return
+        self.engines.append(engine)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(engine, 'handle_error', self.handle_error)
+
+    # 开始时间按执行上下文记在连接上，出错的语句在handle_error里去掉，不会和后面的语句配错
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('sql_metrics_start', {})[id(context)] = perf_counter()
+
+    @staticmethod
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None:
+            conn.info.get('sql_metrics_start', {}).pop(id(exception_context.execution_context), None)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.get('sql_metrics_start', {}).pop(id(context), None)
+        if start is None:
+            return
+        spent = perf_counter() - start
+        template, op, table = self.statement_info(statement)
+        self.latency.observe(spent, op, table)
+        # sqlite的select拿不到rowcount，是-1
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            self.rows.inc(op, table, amount=cursor.rowcount)
+        if spent >= self.slow_seconds:
+            self.slow.inc(op, table)
+            print(f"慢SQL {spent * 1000:.1f}ms 参数{params_shape(parameters, executemany)}: {template}")
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += spent
+            stats.templates[template] = stats.templates.get(template, 0) + 1
+
+    def finish_request(self, endpoint: str, stats: RequestStats):
+        self.request_queries.observe(stats.queries, endpoint)
+        self.request_seconds.observe(stats.seconds, endpoint)
+        repeated = [(count, template) for template, count in stats.templates.items() if count > self.n_plus_one]
+        if not repeated:
+            return
+        self.n_plus_one_total.inc(endpoint)
+        for count, template in sorted(repeated, reverse=True):
+            print(f"N+1 {endpoint} 同一语句执行{count}次: {template}")
+
+
+class SqlMetricsMiddleware:
+    """
+    每个请求开一个RequestStats，结束后按路由模板汇总，没匹配到路由的请求记为unmatched
+    """
+
+    def __init__(self, app: ASGIApp, sql_metrics: SqlMetrics):
+        self.app = app
+        self.sql_metrics = sql_metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_stats.reset(token)
+            route = scope.get('route')
+            endpoint = f"{scope['method']} {getattr(route, 'path_format', None) or 'unmatched'}"
+            self.sql_metrics.finish_request(endpoint, stats)
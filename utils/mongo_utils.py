@@ -1,56 +1,843 @@
-import json
-from copy import deepcopy
+import re
+from datetime import date, datetime, time, timedelta
+from decimal import Context, Decimal
+from enum import Enum
+from threading import Lock
+from types import NoneType, UnionType
+from typing import Generic, TypeVar, Dict, List, Iterator, AsyncIterator, Optional, Sequence, Tuple, Callable, Union, \
+    Any, Annotated, Literal, Type, get_args, get_origin
 
-from bson import ObjectId
+import bson
+from bson import ObjectId, Decimal128
+from bson.raw_bson import RawBSONDocument
+from fastapi import HTTPException
 from pydantic import BaseModel
-from pymongo import MongoClient
-from typing import Generic, TypeVar
+from pydantic_core import to_jsonable_python
+from pymongo import MongoClient, AsyncMongoClient, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from utils.query_utils import QueryParams, QueryParam, PageData, CountMode, get_count_mode, range_plan, \
+    encode_cursor, decode_cursor
 
 ModelType = TypeVar("ModelType", bound=BaseModel)
 
+MONGO_BATCH_SIZE = 1000  # 批量写入每批的文档数，也是find每次从服务端取的文档数
+
+# 本身就是bson类型，不用转换的字段类型
+BSON_NATIVE_TYPES = {str, int, float, bool, datetime, ObjectId, bytes, Decimal128}
+
+
+DECIMAL128_CONTEXT = Context(prec=34)
+
+
+def decimal_to_bson(value: Decimal) -> Decimal128:
+    """
+    有效数字不超过34位的有限值直接拼出Decimal128的高低64位，比Decimal128(value)快一半多，其余情况交给bson
+    """
+    sign, digits, exponent = value.as_tuple()
+    if isinstance(exponent, int) and len(digits) <= 34 and -6176 <= exponent <= 6111:
+        coefficient = abs(int(value.scaleb(-exponent, DECIMAL128_CONTEXT)))
+        high = (sign << 63) | ((exponent + 6176) << 49) | (coefficient >> 64)
+        return Decimal128((high, coefficient & 0xFFFFFFFFFFFFFFFF))
+    return Decimal128(value)
+
+
+def bson_value(value):
+    """
+    单个值转成bson能直接存的类型：datetime、ObjectId原样保留，Decimal转Decimal128，date转当天0点的datetime
+    bson没有的类型(UUID、time、timedelta...)按pydantic的json规则转，和原来的json往返结果一样
+    """
+    cls = value.__class__
+    if cls in BSON_NATIVE_TYPES or value is None:
+        return value
+    if isinstance(value, BaseModel):
+        return pydantic_to_mg_dict(value)
+    if isinstance(value, dict):
+        return {key if key.__class__ is str else str(to_jsonable_python(key)): bson_value(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [bson_value(item) for item in value]
+    if isinstance(value, Enum):
+        return bson_value(value.value)
+    if isinstance(value, date):
+        return value if isinstance(value, datetime) else datetime(value.year, value.month, value.day)
+    if isinstance(value, Decimal):
+        return decimal_to_bson(value)
+    if isinstance(value, tuple(BSON_NATIVE_TYPES)):
+        return value
+    return to_jsonable_python(value)
+
+
+def needs_bson_convert(annotation, seen: set = None) -> bool:
+    """
+    model_dump出来的值按声明的类型判断要不要再转：str/int/datetime和由它们组成的list、dict、嵌套模型都不用转
+    Decimal、Enum、date、set、Any之类的要转
+    """
+    origin = get_origin(annotation)
+    if origin is Annotated:
+        return needs_bson_convert(get_args(annotation)[0], seen)
+    if origin is Literal:
+        return not all(isinstance(arg, (str, int, bool)) or arg is None for arg in get_args(annotation))
+    if origin in (Union, UnionType, list, tuple):
+        return any(needs_bson_convert(arg, seen) for arg in get_args(annotation) if arg is not Ellipsis)
+    if origin is dict:
+        key_type, value_type = get_args(annotation) or (Any, Any)
+        return key_type is not str or needs_bson_convert(value_type, seen)
+    if annotation in BSON_NATIVE_TYPES or annotation is NoneType:
+        return False
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        seen = seen or set()
+        if annotation in seen:
+            return True
+        seen.add(annotation)
+        return model_has_custom_dump(annotation) or annotation.model_config.get('extra') == 'allow' or any(
+            needs_bson_convert(field.annotation, seen) for field in annotation.model_fields.values())
+    return True
+
+
+def enum_to_bson(value):
+    return bson_value(value.value) if isinstance(value, Enum) else value
+
+
+def field_converter(annotation) -> Callable:
+    """
+    Optional[Decimal]、Optional[枚举]这种常见的字段直接用对应的转换函数，省掉bson_value里一串isinstance
+    """
+    origin = get_origin(annotation)
+    if origin is Annotated:
+        return field_converter(get_args(annotation)[0])
+    if origin in (Union, UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not NoneType]
+        return field_converter(args[0]) if len(args) == 1 else bson_value
+    if annotation is Decimal:
+        return decimal_to_bson
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return enum_to_bson
+    return bson_value
+
+
+def model_has_custom_dump(cls: type) -> bool:
+    decorators = cls.__pydantic_decorators__
+    return bool(decorators.field_serializers or decorators.model_serializers or cls.model_computed_fields)
+
+
+# 模型类 -> 编码函数，每个类第一次编码时生成
+model_bson_encoders: Dict[type, Callable[[BaseModel], dict]] = {}
+model_bson_lock = Lock()
+
+
+def model_bson_encoder(cls: type) -> Callable[[BaseModel], dict]:
+    encoder = model_bson_encoders.get(cls)
+    if encoder is None:
+        with model_bson_lock:
+            encoder = model_bson_encoders.get(cls)
+            if encoder is None:
+                encoder = model_bson_encoders[cls] = build_model_bson_encoder(cls)
+    return encoder
+
+
+def build_model_bson_encoder(cls: type) -> Callable[[BaseModel], dict]:
+    """
+    model_dump(exclude_none)在pydantic-core里一次转完，datetime、嵌套模型都已经是python原生值
+    之后只把声明类型里含有bson不支持的类型的那几个字段再转一遍，其余字段原样用
+    有自定义序列化时序列化结果的类型不确定，所有字段都转
+    """
+    if model_has_custom_dump(cls):
+        converters = None
+    else:
+        converters = tuple((name, field_converter(field.annotation)) for name, field in cls.model_fields.items()
+                           if needs_bson_convert(field.annotation))
+    allow_extra = cls.model_config.get('extra') == 'allow'
+
+    def encode(data: BaseModel) -> dict:
+        doc = data.model_dump(exclude_none=True)
+        if converters is None:
+            items = [(name, bson_value) for name in doc]
+        elif allow_extra and data.__pydantic_extra__:
+            items = [*converters, *((name, bson_value) for name in data.__pydantic_extra__)]
+        else:
+            items = converters
+        for name, convert in items:
+            value = doc.get(name)
+            if value is not None:
+                doc[name] = convert(value)
+        return doc
+
+    return encode
+
+
+def pydantic_to_mg_dict(data: BaseModel) -> dict:
+    """
+    pydantic模型转成mongo文档，直接转成bson类型，不再经过json字符串
+    """
+    return model_bson_encoder(data.__class__)(data)
+
+
+def pydantic_to_mg_dicts(data_list: List[BaseModel]) -> List[dict]:
+    """
+    批量版本，同一个类的编码函数只查一次
+    """
+    docs = []
+    cls, encoder = None, None
+    for data in data_list:
+        if data.__class__ is not cls:
+            cls = data.__class__
+            encoder = model_bson_encoder(cls)
+        docs.append(encoder(data))
+    return docs
 
-def pydantic_to_mg_dict(data: BaseModel):
-    data = json.loads(data.json(exclude_none=True))
-    return data
+
+def pydantic_to_bson(data: BaseModel) -> bytes:
+    return bson.encode(pydantic_to_mg_dict(data))
+
+
+def pydantic_to_raw_bson(data_list: List[BaseModel], with_id: bool = True) -> List[RawBSONDocument]:
+    """
+    编码好的bson字节，insert_many时pymongo不用再编码一次
+    raw文档pymongo不会补_id，with_id时在这里补上，insert_many才能返回写入的id
+    """
+    docs = []
+    for doc in pydantic_to_mg_dicts(data_list):
+        if with_id and '_id' not in doc:
+            doc = {'_id': ObjectId(), **doc}
+        docs.append(RawBSONDocument(bson.encode(doc)))
+    return docs
+
+
+def chunk_docs(items: Sequence, size: int):
+    for start in range(0, len(items), size):
+        yield start, items[start:start + size]
+
+
+def bulk_summary() -> dict:
+    return {'inserted': 0, 'matched': 0, 'modified': 0, 'deleted': 0, 'upserted': 0, 'errors': []}
+
+
+def add_bulk_result(summary: dict, details: dict, offset: int):
+    """
+    把BulkWriteResult.bulk_api_result或者BulkWriteError.details累加到summary，出错的下标换算成整个列表里的下标
+    """
+    summary['inserted'] += details.get('nInserted', 0)
+    summary['matched'] += details.get('nMatched', 0)
+    summary['modified'] += details.get('nModified', 0)
+    summary['deleted'] += details.get('nRemoved', 0)
+    summary['upserted'] += details.get('nUpserted', 0)
+    for error in details.get('writeErrors', []):
+        summary['errors'].append({'index': offset + error['index'], 'detail': error.get('errmsg', '')})
+
+
+def collect_inserted(result: dict, docs: list, offset: int, details: dict = None, ordered: bool = False) -> bool:
+    """
+    把一批insert_many的结果记到result里，insert_many会先给没有_id的文档补上_id，除去出错的就是写入成功的
+    按顺序写并且出错时返回True，出错之后的文档和后面的批次都没写
+    """
+    summary = bulk_summary()
+    if details:
+        add_bulk_result(summary, details, offset)
+    errors = summary['errors']
+    if ordered and errors:
+        docs = docs[:errors[0]['index'] - offset]
+    failed = {error['index'] - offset for error in errors}
+    result['ids'] += [str(doc['_id']) for index, doc in enumerate(docs) if index not in failed]
+    result['errors'] += errors
+    return ordered and bool(errors)
 
 
 class MongoConnect:
-    def __init__(self, host="localhost", port: int = 27017, db: str = None, user: str = None, password: str = None):
+    def __init__(self, host="localhost", port: int = 27017, db: str = None, user: str = None, password: str = None,
+                 max_pool_size: int = 100):
         self.host = host
         self.port = int(port)
         self.db = db
         self.user = user
         self.password = password
         if self.user:
-            self.client = MongoClient(host=self.host, port=self.port,
+            self.client = MongoClient(host=self.host, port=self.port, maxPoolSize=max_pool_size,
                                       username=self.user, password=self.password)
         else:
-            self.client = MongoClient(host=self.host, port=self.port)
+            self.client = MongoClient(host=self.host, port=self.port, maxPoolSize=max_pool_size)
         self.db = self.client[self.db]
+        # (库名, 集合名) -> Collection，不用每次调用都重新取
+        self.collections: Dict[Tuple[str, str], object] = {}
 
     def get_db(self):
         yield self.db
 
+    def collection(self, dbname: Optional[str], sheet: str):
+        """
+        dbname为None时用配置里的库
+        """
+        key = (dbname, sheet)
+        collection = self.collections.get(key)
+        if collection is None:
+            collection = self.collections[key] = (self.client[dbname] if dbname else self.db)[sheet]
+        return collection
+
     def insert_data(self, dbname: str, sheet: str, data: dict):
-        collection = self.client[dbname][sheet]
+        collection = self.collection(dbname, sheet)
         item = collection.insert_one(data)
         return item.inserted_id.__str__()
 
+    def insert_many(self, dbname: str, sheet: str, data_list: List[dict], ordered: bool = False,
+                    batch_size: int = MONGO_BATCH_SIZE) -> dict:
+        """
+        分批insert_many，默认不按顺序写，一条出错不影响同一批的其他文档
+        返回 {'ids': 写入成功的id, 'errors': [{'index': 下标, 'detail': 错误}]}
+        """
+        collection = self.collection(dbname, sheet)
+        result = {'ids': [], 'errors': []}
+        for offset, docs in chunk_docs(data_list, batch_size):
+            details = None
+            try:
+                collection.insert_many(docs, ordered=ordered)
+            except BulkWriteError as e:
+                details = e.details
+            if collect_inserted(result, docs, offset, details, ordered):
+                break
+        return result
+
+    def bulk_write(self, dbname: str, sheet: str, requests: list, ordered: bool = False,
+                   batch_size: int = MONGO_BATCH_SIZE) -> dict:
+        """
+        requests是pymongo的InsertOne/UpdateOne/DeleteOne/ReplaceOne...，分批写，默认不按顺序
+        返回各类数量和出错的下标
+        """
+        collection = self.collection(dbname, sheet)
+        summary = bulk_summary()
+        for offset, batch in chunk_docs(requests, batch_size):
+            try:
+                add_bulk_result(summary, collection.bulk_write(batch, ordered=ordered).bulk_api_result, offset)
+            except BulkWriteError as e:
+                add_bulk_result(summary, e.details, offset)
+                if ordered:
+                    break
+        return summary
+
+    def find(self, dbname: str, sheet: str, filter: dict = None, projection: dict = None, sort: list = None,
+             batch_size: int = MONGO_BATCH_SIZE, limit: int = 0) -> Iterator[dict]:
+        """
+        流式读取，服务端每次返回batch_size条，不会一次把结果全放进内存
+        """
+        cursor = self.collection(dbname, sheet).find(filter or {}, projection, sort=sort, limit=limit,
+                                                     batch_size=batch_size)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
     def delete_data_by_id(self, dbname: str, sheet: str, _id: str):
-        collection = self.client[dbname][sheet]
+        collection = self.collection(dbname, sheet)
         collection.delete_one({'_id': ObjectId(_id)})
         return True
 
     def find_data_by_id(self, dbname: str, sheet: str, _id: str):
-        collection = self.client[dbname][sheet]
+        collection = self.collection(dbname, sheet)
         return collection.find_one({'_id': ObjectId(_id)}, {"_id": False})
 
     def update_data_by_id(self, dbname: str, sheet: str, _id: str, data: dict):
-        collection = self.client[dbname][sheet]
+        collection = self.collection(dbname, sheet)
         collection.update_one({'_id': ObjectId(_id)}, {"$set": data})
         return True
 
     def replace_data_by_id(self, dbname: str, sheet: str, _id: str, data: dict):
-        collection = self.client[dbname][sheet]
+        collection = self.collection(dbname, sheet)
         collection.find_one_and_replace({'_id': ObjectId(_id)}, data)
         return True
+
+
+class AsyncMongoConnect(MongoConnect):
+    """
+    pymongo自带的异步客户端(AsyncMongoClient)，方法和MongoConnect一样，都要await，find是异步生成器
+    """
+
+    def __init__(self, host="localhost", port: int = 27017, db: str = None, user: str = None, password: str = None,
+                 max_pool_size: int = 100):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.password = password
+        auth = {'username': user, 'password': password} if user else {}
+        # 第一次操作时才连接，可以在事件循环启动前创建
+        self.client = AsyncMongoClient(host=self.host, port=self.port, maxPoolSize=max_pool_size, **auth)
+        self.db = self.client[db]
+        self.collections: Dict[Tuple[str, str], object] = {}
+
+    async def close(self):
+        await self.client.close()
+
+    async def insert_data(self, dbname: str, sheet: str, data: dict):
+        item = await self.collection(dbname, sheet).insert_one(data)
+        return item.inserted_id.__str__()
+
+    async def insert_many(self, dbname: str, sheet: str, data_list: List[dict], ordered: bool = False,
+                          batch_size: int = MONGO_BATCH_SIZE) -> dict:
+        collection = self.collection(dbname, sheet)
+        result = {'ids': [], 'errors': []}
+        for offset, docs in chunk_docs(data_list, batch_size):
+            details = None
+            try:
+                await collection.insert_many(docs, ordered=ordered)
+            except BulkWriteError as e:
+                details = e.details
+            if collect_inserted(result, docs, offset, details, ordered):
+                break
+        return result
+
+    async def bulk_write(self, dbname: str, sheet: str, requests: list, ordered: bool = False,
+                         batch_size: int = MONGO_BATCH_SIZE) -> dict:
+        collection = self.collection(dbname, sheet)
+        summary = bulk_summary()
+        for offset, batch in chunk_docs(requests, batch_size):
+            try:
+                add_bulk_result(summary, (await collection.bulk_write(batch, ordered=ordered)).bulk_api_result,
+                                offset)
+            except BulkWriteError as e:
+                add_bulk_result(summary, e.details, offset)
+                if ordered:
+                    break
+        return summary
+
+    async def find(self, dbname: str, sheet: str, filter: dict = None, projection: dict = None, sort: list = None,
+                   batch_size: int = MONGO_BATCH_SIZE, limit: int = 0) -> AsyncIterator[dict]:
+        cursor = self.collection(dbname, sheet).find(filter or {}, projection, sort=sort, limit=limit,
+                                                     batch_size=batch_size)
+        try:
+            async for doc in cursor:
+                yield doc
+        finally:
+            await cursor.close()
+
+    async def delete_data_by_id(self, dbname: str, sheet: str, _id: str):
+        await self.collection(dbname, sheet).delete_one({'_id': ObjectId(_id)})
+        return True
+
+    async def find_data_by_id(self, dbname: str, sheet: str, _id: str):
+        return await self.collection(dbname, sheet).find_one({'_id': ObjectId(_id)}, {"_id": False})
+
+    async def update_data_by_id(self, dbname: str, sheet: str, _id: str, data: dict):
+        await self.collection(dbname, sheet).update_one({'_id': ObjectId(_id)}, {"$set": data})
+        return True
+
+    async def replace_data_by_id(self, dbname: str, sheet: str, _id: str, data: dict):
+        await self.collection(dbname, sheet).find_one_and_replace({'_id': ObjectId(_id)}, data)
+        return True
+
+
+# 通用列表查询：QueryParams编译成mongo的filter/sort/projection，条件的写法和ModelCRUD一样
+
+COMPARE_MONGO_OPERATORS = {'>': '$gt', '>=': '$gte', '<': '$lt', '<=': '$lte'}
+
+
+def unwrap_annotation(annotation):
+    """
+    去掉Optional、Annotated，拿到字段本身的类型
+    """
+    origin = get_origin(annotation)
+    if origin is Annotated:
+        return unwrap_annotation(get_args(annotation)[0])
+    if origin in (Union, UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not NoneType]
+        return unwrap_annotation(args[0]) if len(args) == 1 else annotation
+    return annotation
+
+
+def day_range(value) -> Optional[Tuple[datetime, datetime]]:
+    """
+    datetime字段按天查询时的 [当天0点, 第二天0点)，值解析不出日期时返回None
+    """
+    if isinstance(value, datetime):
+        day = value.date()
+    elif isinstance(value, date):
+        day = value
+    elif isinstance(value, str):
+        try:
+            day = date.fromisoformat(value[:10])
+        except ValueError:
+            return None
+    else:
+        return None
+    start = datetime.combine(day, time())
+    return start, start + timedelta(days=1)
+
+
+def range_condition(name: str, variant: str, values: list) -> Optional[dict]:
+    if variant == 'range_ge':
+        return {name: {'$gte': values[0]}}
+    if variant == 'range_le':
+        return {name: {'$lte': values[0]}}
+    if variant == 'range_between':
+        return {name: {'$gte': values[0], '$lte': values[1]}}
+    return None
+
+
+def merge_conditions(conditions: List[dict]) -> dict:
+    """
+    各条件的字段不重复时合成一个文档，有重复时用$and
+    """
+    result = {}
+    for condition in conditions:
+        if result.keys() & condition.keys():
+            return {'$and': conditions}
+        result.update(condition)
+    return result
+
+
+def cursor_condition(order_keys: List[Tuple[str, str]], values: list, reverse: bool = False) -> dict:
+    """
+    keyset条件，展开为 a > va or (a = va and b > vb)
+    """
+    conditions = []
+    for index, (key, direction) in enumerate(order_keys):
+        forward = (direction == 'asc') != reverse
+        condition = {order_keys[i][0]: values[i] for i in range(index)}
+        condition[key] = {'$gt' if forward else '$lt': values[index]}
+        conditions.append(condition)
+    return conditions[0] if len(conditions) == 1 else {'$or': conditions}
+
+
+def doc_value(doc: dict, name: str):
+    """
+    按 a.b 的路径取文档里的值，Decimal128转回Decimal，游标里才能还原
+    """
+    value = doc
+    for key in name.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value.to_decimal() if isinstance(value, Decimal128) else value
+
+
+def mg_jsonable(value):
+    """
+    mongo文档里的ObjectId转字符串，Decimal128转Decimal，接口可以直接返回
+    """
+    if isinstance(value, dict):
+        return {key: mg_jsonable(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [mg_jsonable(item) for item in value]
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return value
+
+
+class MongoQueryPlan:
+    """
+    一次列表查询编译出来的mongo参数
+    """
+    __slots__ = ('filter', 'page_filter', 'sort', 'projection', 'skip', 'limit', 'order_keys', 'page', 'page_size',
+                 'count_mode')
+
+    def __init__(self):
+        self.filter: dict = {}
+        self.page_filter: dict = {}  # 加上游标条件的filter
+        self.sort: List[Tuple[str, int]] = []
+        self.projection: Optional[dict] = None
+        self.skip = 0
+        self.limit = 0
+        self.order_keys: List[Tuple[str, str]] = []
+        self.page = 1
+        self.page_size = 0
+        self.count_mode: CountMode = 'exact'
+
+
+class MongoCRUD:
+    """
+    mongo集合的通用列表查询，接收和ModelCRUD一样的QueryParams，db传MongoConnect
+    filter_fields之外的字段不能查询、排序，避免前端传任意字段导致全集合扫描
+    """
+
+    def __init__(self, model: Type[BaseModel], sheet: str, dbname: str = None, filter_fields: Sequence[str] = None,
+                 indexes: Sequence[Sequence[Tuple[str, int]]] = ()):
+        """
+        :param model: 集合里文档对应的pydantic模型，按字段类型转换查询值
+        :param sheet: 集合名，dbname为None时用配置里的库
+        :param filter_fields: 可以查询、排序的字段，ensure_indexes给每个字段建索引；不传时模型的所有字段都能查，不建索引
+        :param indexes: 另外要建的联合索引，[[(字段, 1或-1)]]
+        """
+        self.model = model
+        self.sheet = sheet
+        self.dbname = dbname
+        self.field_types = {name: unwrap_annotation(field.annotation) for name, field in model.model_fields.items()}
+        self.index_fields = list(filter_fields or [])
+        self.filter_fields = set(self.field_types if filter_fields is None else filter_fields) | {'_id'}
+        self.indexes = indexes
+
+    def check_field(self, name: str) -> str:
+        """
+        a.b 这种嵌套字段按第一级判断
+        """
+        if name in self.filter_fields or name.split('.')[0] in self.filter_fields:
+            return name
+        raise HTTPException(status_code=400, detail=f"不能按{name}查询")
+
+    def field_value(self, name: str, value):
+        """
+        查询值转成和存储时一样的bson类型，_id的字符串转ObjectId，日期字段的字符串转datetime
+        """
+        if isinstance(value, str):
+            if name == '_id':
+                return ObjectId(value) if ObjectId.is_valid(value) else value
+            if self.field_types.get(name) in (datetime, date):
+                try:
+                    return datetime.fromisoformat(value)
+                except ValueError:
+                    return value
+            return value
+        return bson_value(value)
+
+    def param_condition(self, item: QueryParam) -> Optional[dict]:
+        """
+        params里的一个条件
+        """
+        name = self.check_field(item.name)
+        query_type = item.type
+        value = item.value
+        if query_type in ['=', '==']:
+            days = self.field_types.get(name) is datetime and value is not None and day_range(value)
+            if days:
+                return {name: {'$gte': days[0], '$lt': days[1]}}
+            return {name: self.field_value(name, value)}
+        if query_type in COMPARE_MONGO_OPERATORS:
+            return {name: {COMPARE_MONGO_OPERATORS[query_type]: self.field_value(name, value)}}
+        if query_type == 'in':
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            return {name: {'$in': [self.field_value(name, item) for item in values]}}
+        if query_type == 'like':
+            return {name: {'$regex': re.escape(str(value))}}
+        if query_type == 'find_in_set':
+            # 数组字段里包含这个值
+            return {name: self.field_value(name, value)}
+        if query_type == 'range':
+            variant, values = range_plan(value)
+            return range_condition(name, variant, [self.field_value(name, item) for item in values])
+        return None
+
+    def query_condition(self, name: str, value) -> Optional[dict]:
+        """
+        query模型里的一个字段，规则和sal_utils.query_data_plan一样：列表in，字符串模糊查询，datetime按天
+        """
+        name = self.check_field(name)
+        field_type = self.field_types.get(name)
+        if field_type in (datetime, date, time):
+            if not value:
+                return None
+            if type(value) == list:
+                if len(value) != 2:
+                    return None
+                variant, values = range_plan(value)
+                return range_condition(name, variant, [self.field_value(name, item) for item in values])
+            days = field_type is datetime and day_range(value)
+            if days:
+                return {name: {'$gte': days[0], '$lt': days[1]}}
+            return {name: self.field_value(name, value)}
+        if type(value) == list and value:
+            return {name: {'$in': [self.field_value(name, item) for item in value]}}
+        if field_type is str and value:
+            return {name: {'$regex': re.escape(value)}}
+        return {name: self.field_value(name, value)}
+
+    def compile_filter(self, query_params: QueryParams) -> dict:
+        conditions = []
+        if query_params.query:
+            for name, value in query_params.query.model_dump(exclude_unset=True).items():
+                conditions.append(self.query_condition(name, value))
+        for item in query_params.params or []:
+            conditions.append(self.param_condition(item))
+        return merge_conditions([condition for condition in conditions if condition])
+
+    def compile_projection(self, query_params: QueryParams, order_keys: List[Tuple[str, str]]) -> Optional[dict]:
+        """
+        include时只返回这些字段，排序字段要用来生成游标也一起返回；否则去掉ex_include的字段
+        """
+        ex_include = set(query_params.ex_include or [])
+        if query_params.include:
+            fields = [name for name in query_params.include if name not in ex_include]
+            fields += [key for key, _ in order_keys if key not in fields]
+            return {name: 1 for name in fields}
+        if ex_include:
+            return {name: 0 for name in ex_include}
+        return None
+
+    def query_plan(self, query_params: QueryParams) -> MongoQueryPlan:
+        """
+        QueryParams编译成filter/sort/projection和skip/limit
+        游标分页和count_mode为none、estimate时多取一条来判断是否还有下一页
+        """
+        plan = MongoQueryPlan()
+        plan.filter = plan.page_filter = self.compile_filter(query_params)
+        plan.page_size = query_params.page_size
+        plan.count_mode = get_count_mode(query_params)
+        order_keys = [(self.check_field(key), value) for key, value in (query_params.order or {}).items() if value]
+        if query_params.page_mode == 'cursor':
+            if '_id' not in [key for key, _ in order_keys]:
+                order_keys.append(('_id', 'asc'))
+            reverse = query_params.before is not None
+            cursor = query_params.before if reverse else query_params.after
+            if cursor:
+                values = decode_cursor(cursor)
+                if len(values) != len(order_keys):
+                    raise HTTPException(status_code=400, detail="游标无效")
+                values = [self.field_value(key, value) for (key, _), value in zip(order_keys, values)]
+                plan.page_filter = merge_conditions([plan.filter, cursor_condition(order_keys, values, reverse)])
+            plan.sort = [(key, ASCENDING if (direction == 'asc') != reverse else DESCENDING)
+                         for key, direction in order_keys]
+            plan.limit = plan.page_size + 1
+        else:
+            plan.page = query_params.page
+            plan.sort = [(key, ASCENDING if direction == 'asc' else DESCENDING) for key, direction in order_keys]
+            plan.skip = (plan.page - 1) * plan.page_size
+            plan.limit = plan.page_size if plan.count_mode in ['exact', 'window'] else plan.page_size + 1
+        plan.order_keys = order_keys
+        plan.projection = self.compile_projection(query_params, order_keys)
+        return plan
+
+    def facet_pipeline(self, plan: MongoQueryPlan) -> List[dict]:
+        """
+        count_mode为window时，一次aggregate同时取这一页和总数
+        """
+        items = [{'$skip': plan.skip}, {'$limit': plan.limit}]
+        if plan.projection:
+            items.append({'$project': plan.projection})
+        pipeline = [{'$match': plan.filter}]
+        if plan.sort:
+            pipeline.append({'$sort': dict(plan.sort)})
+        pipeline.append({'$facet': {'items': items, 'count': [{'$count': 'count'}]}})
+        return pipeline
+
+    def find_kwargs(self, plan: MongoQueryPlan) -> dict:
+        return dict(filter=plan.page_filter, projection=plan.projection, sort=plan.sort or None, skip=plan.skip,
+                    limit=plan.limit)
+
+    def make_page_data(self, items: List[dict], count: Optional[int], query_params: QueryParams,
+                       plan: MongoQueryPlan) -> PageData:
+        """
+        和sal_utils.make_page_data一样组装一页结果，游标分页生成前后页游标
+        """
+        page_data = PageData()
+        page_data.count = count
+        page_data.page = plan.page
+        page_data.page_size = plan.page_size
+        if query_params.page_mode != 'cursor':
+            page_data.items = items[:plan.page_size]
+            if count is not None and plan.count_mode in ['exact', 'window']:
+                page_data.has_more = plan.page * plan.page_size < count
+            else:
+                page_data.has_more = len(items) > plan.page_size
+            return page_data
+
+        has_more = len(items) > plan.page_size
+        items = items[:plan.page_size]
+        backward = query_params.before is not None
+        if backward:
+            items.reverse()
+        page_data.items = items
+        page_data.has_more = has_more
+        if items:
+            # 往前翻时has_more表示前面还有数据，从游标翻页时反方向一定还有数据
+            if backward:
+                page_data.before = self.make_cursor(items[0], plan) if has_more else None
+                page_data.after = self.make_cursor(items[-1], plan) if query_params.before else None
+            else:
+                page_data.after = self.make_cursor(items[-1], plan) if has_more else None
+                page_data.before = self.make_cursor(items[0], plan) if query_params.after else None
+        return page_data
+
+    def make_cursor(self, doc: dict, plan: MongoQueryPlan) -> str:
+        return encode_cursor([doc_value(doc, key) for key, _ in plan.order_keys])
+
+    def count(self, db: MongoConnect, query_params: QueryParams) -> Optional[int]:
+        return self.count_plan(db.collection(self.dbname, self.sheet), self.query_plan(query_params))
+
+    def count_plan(self, collection, plan: MongoQueryPlan) -> Optional[int]:
+        """
+        没有筛选条件时用集合元数据里的文档数(estimated_document_count)，不扫描；有条件时exact用count_documents
+        estimate在有条件时mongo没有估算的办法，不统计，只返回has_more
+        """
+        if plan.count_mode not in ['exact', 'estimate']:
+            return None
+        if not plan.filter:
+            return collection.estimated_document_count()
+        if plan.count_mode == 'exact':
+            return collection.count_documents(plan.filter)
+        return None
+
+    def query_page(self, db: MongoConnect, query_params: QueryParams) -> PageData:
+        plan = self.query_plan(query_params)
+        collection = db.collection(self.dbname, self.sheet)
+        if plan.count_mode == 'window':
+            result = next(collection.aggregate(self.facet_pipeline(plan)), None) or {}
+            items = result.get('items', [])
+            count = result['count'][0]['count'] if result.get('count') else 0
+        else:
+            count = self.count_plan(collection, plan)
+            items = list(collection.find(**self.find_kwargs(plan)))
+        return self.make_page_data(items, count, query_params, plan)
+
+    def query_page_dict(self, db: MongoConnect, query_params: QueryParams) -> dict:
+        return self.page_data_dict(self.query_page(db, query_params))
+
+    @staticmethod
+    def page_data_dict(page_data: PageData) -> dict:
+        return dict(
+            items=mg_jsonable(page_data.items),
+            count=page_data.count, page=page_data.page, page_size=page_data.page_size,
+            has_more=page_data.has_more, after=page_data.after, before=page_data.before,
+        )
+
+    def index_models(self) -> List[IndexModel]:
+        """
+        filter_fields每个字段一个单字段索引，再加上indexes里的联合索引
+        """
+        models = [IndexModel([(name, ASCENDING)]) for name in self.index_fields if name != '_id']
+        models += [IndexModel(list(keys)) for keys in self.indexes]
+        return models
+
+    def ensure_indexes(self, db: MongoConnect) -> List[str]:
+        """
+        建好声明的索引，已经存在的同样索引mongo直接跳过，返回索引名
+        """
+        models = self.index_models()
+        if not models:
+            return []
+        return db.collection(self.dbname, self.sheet).create_indexes(models)
+
+
+class AsyncMongoCRUD(MongoCRUD):
+    """
+    MongoCRUD的异步版本，db传AsyncMongoConnect，编译查询的部分共用
+    """
+
+    async def count(self, db: AsyncMongoConnect, query_params: QueryParams) -> Optional[int]:
+        return await self.count_plan(db.collection(self.dbname, self.sheet), self.query_plan(query_params))
+
+    async def count_plan(self, collection, plan: MongoQueryPlan) -> Optional[int]:
+        if plan.count_mode not in ['exact', 'estimate']:
+            return None
+        if not plan.filter:
+            return await collection.estimated_document_count()
+        if plan.count_mode == 'exact':
+            return await collection.count_documents(plan.filter)
+        return None
+
+    async def query_page(self, db: AsyncMongoConnect, query_params: QueryParams) -> PageData:
+        plan = self.query_plan(query_params)
+        collection = db.collection(self.dbname, self.sheet)
+        if plan.count_mode == 'window':
+            cursor = await collection.aggregate(self.facet_pipeline(plan))
+            results = await cursor.to_list(1)
+            result = results[0] if results else {}
+            items = result.get('items', [])
+            count = result['count'][0]['count'] if result.get('count') else 0
+        else:
+            count = await self.count_plan(collection, plan)
+            items = await collection.find(**self.find_kwargs(plan)).to_list(None)
+        return self.make_page_data(items, count, query_params, plan)
+
+    async def query_page_dict(self, db: AsyncMongoConnect, query_params: QueryParams) -> dict:
+        return self.page_data_dict(await self.query_page(db, query_params))
+
+    async def ensure_indexes(self, db: AsyncMongoConnect) -> List[str]:
+        models = self.index_models()
+        if not models:
+            return []
+        return await db.collection(self.dbname, self.sheet).create_indexes(models)
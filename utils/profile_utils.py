@@ -0,0 +1,297 @@
+import asyncio.events
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import Context, ContextVar
+from pathlib import Path
+from random import random
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# 采样时靠这两个帧找出线程当前在替哪个请求干活：
+# 事件循环里 Handle._run 的 self._context 是正在跑的task的上下文，anyio线程池里 WorkerThread.run 的局部变量context
+HANDLE_RUN_CODE = asyncio.events.Handle._run.__code__
+try:
+    from anyio._backends._asyncio import WorkerThread
+
+    WORKER_RUN_CODE = WorkerThread.run.__code__
+except (ImportError, AttributeError):
+    WORKER_RUN_CODE = None
+QUEUE_GET_CODE = queue.Queue.get.__code__
+
+# 每个endpoint最多保留的不同调用栈数量
+MAX_STACKS = 5000
+# ProfileMiddleware生成的单次采样文件名
+PROFILE_FILE_RE = re.compile(r'[\w-][\w.-]*\.collapsed')
+
+
+class ProfileSession:
+    """
+    一次被采样的请求，root是中间件__call__的帧，栈里有它就是这个请求
+    """
+    __slots__ = ('root', 'stacks', 'samples', 'start', 'seconds')
+
+    def __init__(self, root):
+        self.root = root
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+
+
+profile_session: ContextVar[Optional[ProfileSession]] = ContextVar('profile_session', default=None)
+
+
+def context_session(context) -> Optional[ProfileSession]:
+    return context.get(profile_session) if isinstance(context, Context) else None
+
+
+class EndpointProfile:
+    __slots__ = ('requests', 'samples', 'seconds', 'stacks')
+
+    def __init__(self):
+        self.requests = 0
+        self.samples = 0
+        self.seconds = 0.0
+        self.stacks: Counter = Counter()
+
+
+class SamplingProfiler:
+    """
+    有请求在采样时起一个线程，每interval秒抓一次所有线程的调用栈，只记属于被采样请求的那部分
+    不用settrace，没在采样的请求没有额外开销
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.sessions: Dict[object, ProfileSession] = {}
+        self.endpoints: Dict[str, EndpointProfile] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.labels: Dict[object, str] = {}
+        self.root_dir = str(Path.cwd())
+
+    def start(self, session: ProfileSession):
+        with self.lock:
+            self.sessions[session.root] = session
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+                self.thread.start()
+
+    def stop(self, session: ProfileSession):
+        with self.lock:
+            self.sessions.pop(session.root, None)
+        session.seconds = time.perf_counter() - session.start
+
+    def run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.sessions:
+                    self.thread = None
+                    return
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_id:
+                        self.sample(frame)
+
+    def sample(self, frame):
+        """
+        从最里层往外走，遇到请求的根帧或者带着请求上下文的调度帧就停，之前走过的帧就是这个请求的栈
+        """
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            session = self.sessions.get(frame)
+            if session is None and frame.f_code is HANDLE_RUN_CODE:
+                session = context_session(getattr(frame.f_locals.get('self'), '_context', None))
+            elif session is None and frame.f_code is WORKER_RUN_CODE:
+                # 空闲的工作线程停在queue.get上，局部变量context还是上一个任务的
+                if not frames or frames[-1].f_code is QUEUE_GET_CODE:
+                    return
+                session = context_session(frame.f_locals.get('context'))
+            if session is not None:
+                if session.root in self.sessions and frames:
+                    session.stacks[';'.join(self.label(f) for f in reversed(frames))] += 1
+                    session.samples += 1
+                return
+            frames.append(frame)
+            frame = frame.f_back
+
+    def label(self, frame) -> str:
+        code = frame.f_code
+        label = self.labels.get(code)
+        if label is None:
+            file = code.co_filename
+            if file.startswith(self.root_dir):
+                file = os.path.relpath(file, self.root_dir)
+            else:
+                file = re.sub(r'^.*[\\/](site-packages|python3\.\d+)[\\/]', '', file)
+            label = self.labels[code] = f"{getattr(code, 'co_qualname', code.co_name)} ({file}:{code.co_firstlineno})"
+        return label
+
+    def record(self, endpoint: str, session: ProfileSession):
+        with self.lock:
+            profile = self.endpoints.get(endpoint)
+            if profile is None:
+                profile = self.endpoints[endpoint] = EndpointProfile()
+            profile.requests += 1
+            profile.samples += session.samples
+            profile.seconds += session.seconds
+            for stack, count in session.stacks.items():
+                if stack in profile.stacks or len(profile.stacks) < MAX_STACKS:
+                    profile.stacks[stack] += count
+
+    def top(self, n: int = 20) -> dict:
+        """
+        每个endpoint按自身耗时(栈顶)和累计耗时(栈上出现过)排前n的函数
+        """
+        result = {}
+        with self.lock:
+            items = [(endpoint, profile.requests, profile.samples, profile.seconds, list(profile.stacks.items()))
+                     for endpoint, profile in self.endpoints.items()]
+        for endpoint, requests, samples, seconds, stacks in items:
+            self_counts = Counter()
+            total_counts = Counter()
+            for stack, count in stacks:
+                labels = stack.split(';')
+                self_counts[labels[-1]] += count
+                for label in set(labels):
+                    total_counts[label] += count
+            result[endpoint] = {
+                'requests': requests,
+                'samples': samples,
+                'avg_ms': round(seconds / requests * 1000, 2) if requests else 0,
+                'self': [[label, count, round(count / samples, 4)] for label, count in self_counts.most_common(n)],
+                'total': [[label, count, round(count / samples, 4)] for label, count in total_counts.most_common(n)],
+            }
+        return result
+
+    def collapsed(self, endpoint: str = None) -> str:
+        """
+        collapsed stack格式，flamegraph.pl/speedscope可以直接打开，不传endpoint时所有endpoint合在一起，endpoint作为栈底
+        """
+        with self.lock:
+            items = [(name, list(profile.stacks.items())) for name, profile in self.endpoints.items()
+                     if endpoint is None or name == endpoint]
+        lines = []
+        for name, stacks in items:
+            prefix = '' if endpoint else f'{name};'
+            lines += [f'{prefix}{stack} {count}' for stack, count in stacks]
+        return '\n'.join(lines) + '\n'
+
+
+def session_collapsed(session: ProfileSession) -> str:
+    return '\n'.join(f'{stack} {count}' for stack, count in session.stacks.items()) + '\n'
+
+
+class ProfileMiddleware:
+    """
+    请求头 X-Profile 等于配置的token时采样这个请求，调用栈写到 profile_dir，响应头 X-Profile-File 给出下载地址
+    profile_dir里是调用栈和接口路径，不能放在静态目录下，只能带token从 /profile/collapsed?file= 下载
+    另外按sample_rate随机采样一部分请求，只进每个endpoint的汇总；exclude里的路径前缀不采样
+    """
+
+    def __init__(self, app: ASGIApp, profiler: SamplingProfiler, token: str = '', sample_rate: float = 0,
+                 profile_dir: Path = Path('profiles'), profile_url: str = '/profile/collapsed', exclude: tuple = ()):
+        self.app = app
+        self.exclude = exclude
+        self.profiler = profiler
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self.profile_dir = Path(profile_dir)
+        self.profile_url = profile_url
+
+    def forced(self, scope: Scope) -> bool:
+        if self.token is None:
+            return False
+        for key, value in scope['headers']:
+            if key == b'x-profile':
+                return value == self.token
+        return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['path'].startswith(self.exclude):
+            return await self.app(scope, receive, send)
+        forced = self.forced(scope)
+        if not forced and not (self.sample_rate and random() < self.sample_rate):
+            return await self.app(scope, receive, send)
+
+        session = ProfileSession(sys._getframe())
+        file_name = None
+        if forced:
+            path = re.sub(r'[^\w.-]+', '_', scope['path']).strip('_')
+            file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method']}-{path}-{id(session):x}.collapsed"
+
+            async def send_profile(message):
+                if message['type'] == 'http.response.start':
+                    headers = list(message.get('headers', []))
+                    headers.append((b'x-profile-file', f'{self.profile_url}?file={file_name}'.encode()))
+                    message = {**message, 'headers': headers}
+                await send(message)
+        else:
+            send_profile = send
+
+        token = profile_session.set(session)
+        self.profiler.start(session)
+        try:
+            await self.app(scope, receive, send_profile)
+        finally:
+            self.profiler.stop(session)
+            profile_session.reset(token)
+            route = scope.get('route')
+            self.profiler.record(f"{scope['method']} {getattr(route, 'path_format', None) or 'unmatched'}", session)
+            if file_name:
+                await run_in_threadpool(self.write, file_name, session)
+
+    def write(self, file_name: str, session: ProfileSession):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        (self.profile_dir / file_name).write_text(session_collapsed(session), encoding='utf-8')
+
+
+def profile_token_checker(token: str):
+    """
+    汇总接口的依赖，请求头 X-Profile 要等于配置的token，没配token时接口不可用
+    """
+
+    async def check(request: Request):
+        if not token or request.headers.get('x-profile') != token:
+            raise HTTPException(status_code=403, detail='需要profile token')
+
+    return check
+
+
+def read_profile_file(profile_dir: Path, file_name: str) -> str:
+    """
+    只认中间件生成的文件名，不能带路径
+    """
+    if not PROFILE_FILE_RE.fullmatch(file_name):
+        raise HTTPException(status_code=400, detail='文件名无效')
+    path = Path(profile_dir) / file_name
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail='文件不存在')
+    return path.read_text(encoding='utf-8')
+
+
+def profile_endpoints(profiler: SamplingProfiler, profile_dir: Path = Path('profiles')) -> List[tuple]:
+    """
+    [(路径, 接口)]，init_app里挂到 /{sys_name} 下，profile_dir和ProfileMiddleware的一致
+    """
+
+    async def profile_top(n: int = 20):
+        return profiler.top(n)
+
+    async def profile_collapsed(endpoint: str = None, file: str = None):
+        if file:
+            return PlainTextResponse(await run_in_threadpool(read_profile_file, profile_dir, file))
+        return PlainTextResponse(profiler.collapsed(endpoint))
+
+    return [('/profile/top', profile_top), ('/profile/collapsed', profile_collapsed)]
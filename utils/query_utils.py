@@ -0,0 +1,136 @@
+# 通用列表查询的参数、分页结果和游标，sal_utils和mongo_utils共用，不依赖sqlalchemy和pymongo
+import base64
+import json
+from datetime import datetime, date, time
+from decimal import Decimal
+from enum import Enum
+from typing import Literal, List, Any, Optional, Generic, TypeVar, Dict
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+QueryType = Literal['=', '==', '>', '>=', '<', '<=', 'in', 'like', 'range', "find_in_set"]
+
+
+class QueryParam(BaseModel):
+    name: str
+    type: QueryType
+    value: Any
+
+
+# class OrderParam(BaseModel):
+#     order_by: str
+#     type: Literal['asc', 'desc'] = 'asc'
+
+
+ModelInfo = TypeVar('ModelInfo', bound=BaseModel)
+
+
+class QueryInclude(BaseModel):
+    include: Optional[List[str]] = None
+    ex_include: Optional[List[str]] = None
+    relation_use_id: bool = False  # 为true的话，m2m关系返回的是id数组
+
+
+PageMode = Literal['offset', 'cursor']
+CountMode = Literal['exact', 'window', 'estimate', 'none']
+
+
+class QueryParams(QueryInclude, Generic[ModelInfo]):
+    params: Optional[List[QueryParam]] = None
+    order: Optional[Dict[str, Literal["asc", "desc", None]]] = None
+    query: Optional[ModelInfo] = None
+    page: int = 1
+    page_size: int
+    page_mode: PageMode = 'offset'  # cursor: 游标分页，按after/before翻页，忽略page
+    after: Optional[str] = None  # 游标分页，取该游标之后的一页
+    before: Optional[str] = None  # 游标分页，取该游标之前的一页，传空字符串取最后一页
+    # exact: 精确count; window: 查数据时count(*) over()一起返回; estimate: 数据库估算行数; none: 不统计，只返回has_more
+    count_mode: CountMode = 'exact'
+
+
+class PageData:
+    """
+    一页查询结果
+    """
+    items: List[Any] = None
+    count: Optional[int] = None
+    page: int = 1
+    page_size: int = 0
+    has_more: Optional[bool] = None
+    after: Optional[str] = None  # 下一页游标
+    before: Optional[str] = None  # 上一页游标
+
+
+def get_count_mode(query_params: QueryParams) -> CountMode:
+    if query_params.count_mode == 'window' and query_params.page_mode == 'cursor':
+        return 'exact'
+    return query_params.count_mode
+
+
+def range_plan(value):
+    if not value:
+        return 'skip', []
+    if len(value) == 1:
+        if value[0] is not None:
+            return 'range_ge', [value[0]]
+        return 'skip', []
+    if len(value) == 2:
+        if value[0] is not None and value[1] is None:
+            return 'range_ge', [value[0]]
+        if value[0] is None and value[1] is not None:
+            return 'range_le', [value[1]]
+        if value[0] is not None and value[1] is not None:
+            return 'range_between', [value[0], value[1]]
+    return 'skip', []
+
+
+# 游标分页
+
+def _cursor_value_dump(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    if isinstance(value, time):
+        return {'t': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'dec': str(value)}
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _cursor_value_load(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+        if 't' in value:
+            return time.fromisoformat(value['t'])
+        if 'dec' in value:
+            return Decimal(value['dec'])
+        raise ValueError(value)
+    return value
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    排序字段的值编码成不透明的游标字符串
+    """
+    data = json.dumps([_cursor_value_dump(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+        if type(values) != list:
+            raise ValueError(values)
+        return [_cursor_value_load(value) for value in values]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="游标无效")
@@ -1,26 +1,149 @@
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
 import redis as redis
+import redis.asyncio as aioredis
+
+PIPELINE_BATCH_SIZE = 500  # 一次pipeline里最多的命令数，太多时拆成几次发送
+
+# 常用的lua脚本，AsyncRedisPool.run_script(名字, keys, args)调用
+LUA_SCRIPTS = {
+    # 计数加一，第一次加的时候设置过期时间，限流用，返回加完后的值
+    'incr_expire': """
+local value = redis.call('INCR', KEYS[1])
+if value == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return value
+""",
+    # 值等于ARGV[1]时才删除，释放自己加的锁用
+    'delete_if_equal': """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""",
+}
+
+
+def chunked(items: Sequence, size: int) -> Iterable[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 
 class RedisPool:
-    def __init__(self, host: str, port: int, password: str = None):
+    def __init__(self, host: str, port: int, password: str = None, max_connections: int = 10, **kwargs):
         self.host = host
         self.port = int(port)
         self.password = password if password else None
+        self.max_connections = max_connections
         self.redis_pool: redis.ConnectionPool = None
         self.conn: redis.Redis = None
 
-    def connect(self, max_connections=10):
-        if self.password:
-            self.redis_pool = redis.ConnectionPool(host=self.host, port=self.port,
-                                                   decode_responses=True,
-                                                   max_connections=max_connections)
-        else:
-            self.redis_pool = redis.ConnectionPool(host=self.host, port=self.port,
-                                                   password=self.password,
-                                                   decode_responses=True,
-                                                   max_connections=max_connections)
+    def connect(self, max_connections: int = None):
+        self.redis_pool = redis.ConnectionPool(host=self.host, port=self.port,
+                                               password=self.password,
+                                               decode_responses=True,
+                                               max_connections=max_connections or self.max_connections)
         self.conn = self.get_redis_client()
 
     def get_redis_client(self):
         conn = redis.Redis(connection_pool=self.redis_pool, decode_responses=True)
         return conn
+
+
+class AsyncRedisPool:
+    """
+    redis.asyncio的连接池，异步接口里用这个，不阻塞事件循环
+    连接池用满时等pool_timeout秒，不直接报错
+    批量读写用pipeline一次往返发出去，比一条条await少很多网络往返
+    """
+
+    def __init__(self, host: str, port: int, password: str = None, async_max_connections: int = 50,
+                 pool_timeout: float = 5, **kwargs):
+        self.host = host
+        self.port = int(port)
+        self.password = password if password else None
+        self.max_connections = async_max_connections
+        self.pool_timeout = pool_timeout
+        self.redis_pool: aioredis.BlockingConnectionPool = None
+        self.conn: aioredis.Redis = None
+        self.scripts: Dict[str, Any] = {}
+
+    def connect(self):
+        """
+        只建连接池，第一次执行命令时才真正连接，可以在事件循环启动前调用
+        """
+        self.redis_pool = aioredis.BlockingConnectionPool(host=self.host, port=self.port, password=self.password,
+                                                          decode_responses=True,
+                                                          max_connections=self.max_connections,
+                                                          timeout=self.pool_timeout)
+        self.conn = aioredis.Redis(connection_pool=self.redis_pool)
+        self.scripts = {}
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.aclose()
+            await self.redis_pool.aclose()
+
+    async def pipeline_execute(self, commands: List[Tuple[str, tuple, dict]],
+                               batch_size: int = PIPELINE_BATCH_SIZE) -> list:
+        """
+        commands: [(命令方法名, 参数, 关键字参数)]，按batch_size分批用pipeline发送，结果顺序和commands一致
+        """
+        results = []
+        for batch in chunked(commands, batch_size):
+            pipe = self.conn.pipeline(transaction=False)
+            for name, args, kwargs in batch:
+                getattr(pipe, name)(*args, **kwargs)
+            results += await pipe.execute()
+        return results
+
+    async def mget(self, keys: Sequence[str], batch_size: int = PIPELINE_BATCH_SIZE) -> List[Optional[str]]:
+        """
+        key很多时拆成几个MGET放在一个pipeline里，避免单条命令太大
+        """
+        if not keys:
+            return []
+        values = []
+        for result in await self.pipeline_execute([('mget', (list(batch),), {})
+                                                   for batch in chunked(keys, batch_size)]):
+            values += result
+        return values
+
+    async def mset(self, mapping: Dict[str, Any], ex: int = None, batch_size: int = PIPELINE_BATCH_SIZE):
+        """
+        不带过期时间时拆成几个MSET，带过期时间时每个key一条SET EX，都在pipeline里发送
+        """
+        if not mapping:
+            return
+        items = list(mapping.items())
+        if ex is None:
+            await self.pipeline_execute([('mset', (dict(batch),), {}) for batch in chunked(items, batch_size)])
+        else:
+            await self.pipeline_execute([('set', (key, value), {'ex': ex}) for key, value in items], batch_size)
+
+    async def hmget_many(self, requests: Sequence[Tuple[str, Sequence[str]]],
+                         batch_size: int = PIPELINE_BATCH_SIZE) -> List[List[Optional[str]]]:
+        """
+        requests: [(key, [字段])]，返回每个key对应字段的值列表
+        """
+        return await self.pipeline_execute([('hmget', (key, list(fields)), {}) for key, fields in requests],
+                                           batch_size)
+
+    async def expire_many(self, keys: Sequence[str], seconds: int, batch_size: int = PIPELINE_BATCH_SIZE) -> List[bool]:
+        return await self.pipeline_execute([('expire', (key, seconds), {}) for key in keys], batch_size)
+
+    def register_script(self, name: str, lua: str):
+        """
+        注册lua脚本，调用时先EVALSHA，服务端没有这个脚本时redis-py会自动用EVAL补上
+        """
+        self.scripts[name] = self.conn.register_script(lua)
+
+    async def run_script(self, name: str, keys: Sequence[str] = (), args: Sequence[Any] = ()):
+        script = self.scripts.get(name)
+        if script is None:
+            if name not in LUA_SCRIPTS:
+                raise KeyError(f"lua脚本没有注册: {name}")
+            self.register_script(name, LUA_SCRIPTS[name])
+            script = self.scripts[name]
+        return await script(keys=list(keys), args=list(args))
@@ -0,0 +1,35 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def orjson_default(value):
+    """
+    orjson原生支持datetime/date/time/UUID/Enum/dict/list，剩下的在这里转
+    """
+    if isinstance(value, Decimal):
+        # 和jsonable_encoder一样，整数值输出int
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError
+
+
+class ORJsonResponse(JSONResponse):
+    """
+    用orjson序列化的响应，init_app里设为默认响应类
+    只设成默认响应类时，接口返回的dict/模型还是先过一遍jsonable_encoder，省掉的只有json.dumps这一步；
+    接口直接 return ORJsonResponse(data) 才会跳过jsonable_encoder，大列表接口要这样返回
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=orjson_default,
+                            option=orjson.OPT_NON_STR_KEYS)
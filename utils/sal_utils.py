@@ -1,84 +1,421 @@
+import csv
+import inspect
+import io
 import json
+from collections import OrderedDict
+from datetime import datetime, date, time, timedelta
+from enum import Enum
 from functools import wraps
-from typing import Literal, List, Any, Optional, Union, Generic, TypeVar, Dict, Type
+from operator import attrgetter
+from threading import Lock
+from time import perf_counter, monotonic
+from typing import Literal, List, Any, Optional, Union, Dict, Type, Tuple
 
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, and_, asc, desc, func, String, Table, ForeignKey
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import create_engine, Column, and_, or_, asc, desc, func, String, Table, ForeignKey, tuple_, text, \
+    Index, Text, cast, literal, literal_column, select, delete, insert, update, bindparam, inspect as sa_inspect, \
+    event, Select
+from sqlalchemy.dialects.postgresql import ARRAY, array as pg_array
+from sqlalchemy.exc import IntegrityError, DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import Executable, ClauseElement, ColumnElement
+from sqlalchemy.sql.visitors import InternalTraversal
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, Query, Load
-from sqlalchemy_utils import database_exists, create_database, get_columns, get_column_key, get_type, get_primary_keys
+from sqlalchemy.orm import sessionmaker, Session, Query, Load, selectinload, joinedload, noload, load_only, aliased, \
+    configure_mappers as sa_configure_mappers
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy_utils import database_exists, create_database, get_columns, get_column_key
 from pydantic import BaseModel
 from sqlalchemy import Column
 from sqlalchemy.orm import InstrumentedAttribute, ColumnProperty, Relationship, DeclarativeMeta, Session
 from sqlalchemy_utils import get_columns, get_column_key
 
+from utils.cache_utils import EntityCache, QueryCache
+from utils.query_utils import QueryParam, QueryInclude, QueryParams, PageData, get_count_mode, range_plan, \
+    encode_cursor, decode_cursor
+
+
+pool_stats_lock = Lock()
+
+
+class PoolWaitMixin:
+    """
+    记录从连接池拿连接的等待时间，连接池用满时等待时间和超时次数会先涨起来
+    """
+    waits = 0
+    wait_seconds = 0.0
+    max_wait_seconds = 0.0
+    timeouts = 0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with pool_stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            spent = perf_counter() - start
+            with pool_stats_lock:
+                self.waits += 1
+                self.wait_seconds += spent
+                self.max_wait_seconds = max(self.max_wait_seconds, spent)
+
+
+class TimedQueuePool(PoolWaitMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(PoolWaitMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_status(pool) -> dict:
+    """
+    连接池当前状态，不是QueuePool(比如sqlite)时只有类型
+    """
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                      overflow=max(pool.overflow(), 0), max_overflow=pool._max_overflow)
+    if isinstance(pool, PoolWaitMixin):
+        status.update(waits=pool.waits, wait_seconds=pool.wait_seconds, max_wait_seconds=pool.max_wait_seconds,
+                      timeouts=pool.timeouts)
+    return status
+
+
+class ReplicaRouter:
+    """
+    从库选择，round_robin轮询或least_conn选借出连接最少的
+    从库连不上或连接断开时摘掉retry_seconds秒，到时间再放回去试，全都摘掉时读主库
+    """
+
+    def __init__(self, engines: List[Engine], strategy: Literal['round_robin', 'least_conn'] = 'round_robin',
+                 retry_seconds: float = 30):
+        self.engines = engines
+        self.strategy = strategy
+        self.retry_seconds = retry_seconds
+        self.indexes = {engine: index for index, engine in enumerate(engines)}
+        self.ejected_until = [0.0] * len(engines)
+        self.picks = [0] * len(engines)
+        self.errors = [0] * len(engines)
+        self.next_index = 0
+        self.lock = Lock()
+        for engine in engines:
+            event.listen(engine, 'handle_error', self.handle_error)
+
+    def pick(self) -> Optional[Engine]:
+        now = monotonic()
+        healthy = [index for index, until in enumerate(self.ejected_until) if until <= now]
+        if not healthy:
+            return None
+        with self.lock:
+            if self.strategy == 'least_conn':
+                index = min(healthy, key=lambda i: (getattr(self.engines[i].pool, 'checkedout', int)(), self.picks[i]))
+            else:
+                index = healthy[self.next_index % len(healthy)]
+                self.next_index += 1
+            self.picks[index] += 1
+        return self.engines[index]
+
+    def is_healthy(self, engine: Engine) -> bool:
+        return self.ejected_until[self.indexes[engine]] <= monotonic()
+
+    def eject(self, engine: Engine):
+        index = self.indexes[engine]
+        with self.lock:
+            self.errors[index] += 1
+            self.ejected_until[index] = monotonic() + self.retry_seconds
+
+    def handle_error(self, context):
+        # 只有连不上和连接断开才摘掉，sql本身的错误跟从库健康无关
+        if context.is_disconnect or context.connection is None:
+            self.eject(context.engine)
+
+    def status(self) -> Dict[str, dict]:
+        now = monotonic()
+        return {f'replica{index}': {**pool_status(engine.pool), 'healthy': int(self.ejected_until[index] <= now),
+                                    'picks': self.picks[index], 'errors': self.errors[index]}
+                for index, engine in enumerate(self.engines)}
+
+
+class RoutingSession(Session):
+    """
+    读写分离的session，info['replica_router']是ReplicaRouter时生效
+    没写过的session里普通select、EXPLAIN、execution_options(readonly=True)的语句走从库，一个session固定用选中的那个从库；
+    选从库时先取连接，连不上就摘掉换下一个，都不行读主库
+    写、select for update、flush都走主库，走过主库之后这个session后面的读也留在主库，能读到自己刚写的数据
+    """
+
+    def get_bind(self, mapper=None, *, clause=None, **kw):
+        router: ReplicaRouter = self.info.get('replica_router')
+        # 没有clause是在取dialect之类的，给主库但不算写过
+        if router is None or self.info.get('primary') or (clause is None and not self._flushing):
+            return super().get_bind(mapper, clause=clause, **kw)
+        if self.is_read_only(clause):
+            replica = self.info.get('replica')
+            if replica is None:
+                replica = self.info['replica'] = self.connect_replica(router)
+            if replica is not None:
+                return replica
+            return super().get_bind(mapper, clause=clause, **kw)
+        self.info['primary'] = True
+        return super().get_bind(mapper, clause=clause, **kw)
+
+    def is_read_only(self, clause) -> bool:
+        if self._flushing:
+            return False
+        if isinstance(clause, Select):
+            return clause._for_update_arg is None
+        # text()等语句看不出读写，要显式标readonly才走从库
+        return isinstance(clause, Explain) or \
+            (isinstance(clause, Executable) and bool(clause.get_execution_options().get('readonly')))
+
+    def connect_replica(self, router: ReplicaRouter) -> Optional[Engine]:
+        """
+        选一个能连上的从库，连接留在session事务里，后面的语句直接用
+        """
+        while True:
+            replica = router.pick()
+            if replica is None:
+                return None
+            try:
+                self.connection(bind_arguments={'bind': replica})
+                return replica
+            except DBAPIError:
+                # handle_error已经摘掉了，这里兜底其他方式抛出的连接错误
+                if router.is_healthy(replica):
+                    router.eject(replica)
+
+
+def use_primary(db: Union[Session, AsyncSession]):
+    """
+    这个session后面都走主库，写方法开始时调用，先查后改时查到的是主库的数据
+    """
+    db.info['primary'] = True
+
 
 class SqlalchemyConnect:
     def __init__(self, host="127.0.0.1", user="", password="", db="",
-                 db_type: Literal['mysql', 'postgresql'] = 'mysql'):
+                 db_type: Literal['mysql', 'postgresql'] = 'mysql', async_enable=False,
+                 pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=3600 * 4, pool_pre_ping=False,
+                 pool_use_lifo=False, replicas: List[Union[str, dict]] = None,
+                 replica_strategy: Literal['round_robin', 'least_conn'] = 'round_robin', replica_retry_seconds=30):
+        """
+        :param replicas: 从库，host字符串或者{host,user,password,db}，没写的项和主库一样
+        :param replica_strategy: 从库选择方式，round_robin轮询，least_conn借出连接最少
+        :param replica_retry_seconds: 从库出错后摘掉的秒数
+        """
         self.base = declarative_base()
         self.host = host
         self.user = user
         self.password = password
         self.db = db
+        self.db_type = db_type
+        # 连接池参数，同步和异步引擎共用
+        self.pool_options = dict(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout,
+                                 pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping, pool_use_lifo=pool_use_lifo)
+        self.replica_strategy = replica_strategy
+        self.replica_retry_seconds = replica_retry_seconds
+        self.replica_router: Optional[ReplicaRouter] = None
+        self.async_replica_router: Optional[ReplicaRouter] = None
         if db_type == 'mysql':
             self.engine = self.init_engine()
         if db_type == 'postgresql':
             self.engine = self.init_postgresql_engine()
-        # self.async_engine = self.init_async_engine()
-
-    def init_engine(self):
+        self._session_factory: Optional[sessionmaker] = None
+        # 异步引擎，需要安装aiomysql或asyncpg
+        self.async_engine = None
+        self.async_session: async_sessionmaker = None
+        if async_enable:
+            if db_type == 'mysql':
+                self.async_engine = self.init_async_engine()
+            if db_type == 'postgresql':
+                self.async_engine = self.init_async_postgresql_engine()
+        # 从库
+        replica_engines, async_replica_engines = [], []
+        if replicas:
+            init = {'mysql': self.init_engine, 'postgresql': self.init_postgresql_engine}[db_type]
+            replica_engines = [init(replica) for replica in replicas]
+            if async_enable:
+                async_init = {'mysql': self.init_async_engine, 'postgresql': self.init_async_postgresql_engine}[db_type]
+                async_replica_engines = [async_init(replica) for replica in replicas]
+        self.set_replicas(replica_engines, async_replica_engines)
+
+    def conn_args(self, replica: Union[str, dict] = None) -> tuple:
+        """
+        (user, password, host, db)，传从库配置时用从库的值覆盖
+        """
+        replica = {'host': replica} if isinstance(replica, str) else replica or {}
+        return (replica.get('user', self.user), replica.get('password', self.password),
+                replica.get('host', self.host), replica.get('db', self.db))
+
+    def engine_pool_options(self, replica: Union[str, dict] = None) -> dict:
+        """
+        从库总是pre_ping，连接断了在选从库取连接时就能发现并换下一个
+        """
+        return {**self.pool_options, 'pool_pre_ping': True} if replica else self.pool_options
+
+    def init_engine(self, replica: Union[str, dict] = None):
+        user, password, host, db = self.conn_args(replica)
         engine = create_engine(
-            f"mysql+pymysql://{self.user}:{self.password}@{self.host}/{self.db}?charset=utf8mb4", pool_recycle=3600 * 4)
+            f"mysql+pymysql://{user}:{password}@{host}/{db}?charset=utf8mb4",
+            poolclass=TimedQueuePool, **self.engine_pool_options(replica))
         return engine
 
-    def init_postgresql_engine(self):
-        engine = create_engine(f'postgresql+psycopg2://{self.user}:{self.password}@{self.host}/{self.db}',
-                               pool_recycle=3600 * 4, echo=False)
+    def init_postgresql_engine(self, replica: Union[str, dict] = None):
+        user, password, host, db = self.conn_args(replica)
+        engine = create_engine(f'postgresql+psycopg2://{user}:{password}@{host}/{db}',
+                               poolclass=TimedQueuePool, echo=False, **self.engine_pool_options(replica))
         return engine
 
+    def set_replicas(self, engines: List[Engine], async_engines: List[AsyncEngine] = None):
+        """
+        设置从库，本地测试时可以直接传sqlite文件的engine；自己建的engine最好开pool_pre_ping
+        """
+        self.replica_router = ReplicaRouter(engines, self.replica_strategy, self.replica_retry_seconds) \
+            if engines else None
+        self.async_replica_router = ReplicaRouter([engine.sync_engine for engine in async_engines],
+                                                  self.replica_strategy, self.replica_retry_seconds) \
+            if async_engines else None
+        self._session_factory = None
+        if self.async_engine is not None:
+            # 异步session里不能懒加载，提交后不过期，避免访问属性时触发查询
+            self.async_session = async_sessionmaker(self.async_engine, autoflush=False, expire_on_commit=False,
+                                                    sync_session_class=RoutingSession,
+                                                    info={'replica_router': self.async_replica_router})
+
+    @property
+    def session_factory(self) -> sessionmaker:
+        """
+        同一个engine只建一次sessionmaker，engine被替换时重建
+        """
+        factory = self._session_factory
+        if factory is None or factory.kw['bind'] is not self.engine:
+            factory = self._session_factory = sessionmaker(autocommit=False, autoflush=False, bind=self.engine,
+                                                           class_=RoutingSession,
+                                                           info={'replica_router': self.replica_router})
+        return factory
+
+    def pool_status(self) -> dict:
+        status = {'sync': pool_status(self.engine.pool)}
+        if self.replica_router:
+            status.update(self.replica_router.status())
+        if self.async_engine is not None:
+            status['async'] = pool_status(self.async_engine.pool)
+        if self.async_replica_router:
+            status.update({f'async_{name}': value for name, value in self.async_replica_router.status().items()})
+        return status
+
     def create_db(self):
         if not database_exists(self.engine.url):
             create_database(self.engine.url)
 
-    def get_db(self) -> sessionmaker:
+    def get_db(self) -> Session:
+        db = self.session_factory()
         try:
-            session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-            db = session()
             yield db
         finally:
             db.close()
 
-    def get_db_commit(self) -> sessionmaker:
+    def get_db_commit(self) -> Session:
+        """
+        写接口用，整个session走主库
+        """
+        db = self.session_factory()
+        use_primary(db)
         try:
-            session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-            db = session()
             yield db
             db.commit()
         finally:
             db.close()
 
     def get_db_i(self) -> Session:
-        # engine = create_engine(
-        #     f"mysql+pymysql://{self.user}:{self.password}@{self.host}/{self.db}?charset=utf8mb4")
-        session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-        db = session()
-        return db
+        return self.session_factory()
 
-    def init_database(self, create_db=False):
+    def init_database(self, create_db=False, search_indexes=True):
         if create_db:
             self.create_db()
         self.base.metadata.create_all(bind=self.engine)
+        if search_indexes:
+            self.init_search_indexes()
+
+    def init_search_indexes(self) -> List[str]:
+        """
+        按字段info里的search配置建索引，已经存在的跳过，返回新建的索引名
+        """
+        dialect_name = self.engine.dialect.name
+        created = []
+        with self.engine.begin() as conn:
+            for table in self.base.metadata.sorted_tables:
+                columns = [column for column in table.columns if column.info.get('search')]
+                if not columns:
+                    continue
+                exists = {index['name'] for index in sa_inspect(conn).get_indexes(table.name)}
+                for column in columns:
+                    index = search_index(column, dialect_name)
+                    if index is None:
+                        continue
+                    # 不留在表上，免得create_all建新表时在扩展装好之前就建这个索引
+                    table.indexes.discard(index)
+                    if index.name in exists:
+                        continue
+                    if column.info['search'] == 'trgm':
+                        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                    index.create(conn)
+                    created.append(index.name)
+        if created:
+            print(f"创建搜索索引: {', '.join(created)}")
+        return created
+
+    def init_model_configs(self):
+        """
+        启动时构建所有模型的ModelConfig，避免第一次请求时再构建
+        """
+        start = perf_counter()
+        sa_configure_mappers()
+        configured = perf_counter()
+        count = model_registry.init_base(self.base)
+        print(f"模型配置初始化: {count}个模型, mapper配置{(configured - start) * 1000:.1f}ms, "
+              f"ModelConfig构建{(perf_counter() - configured) * 1000:.1f}ms")
+        return count
+
+    def init_async_engine(self, replica: Union[str, dict] = None):
+        user, password, host, db = self.conn_args(replica)
+        async_engine = create_async_engine(
+            f"mysql+aiomysql://{user}:{password}@{host}/{db}?charset=utf8mb4",
+            poolclass=TimedAsyncQueuePool, **self.engine_pool_options(replica)
+        )
+        return async_engine
 
-    def init_async_engine(self):
+    def init_async_postgresql_engine(self, replica: Union[str, dict] = None):
+        user, password, host, db = self.conn_args(replica)
         async_engine = create_async_engine(
-            f"mysql+aiomysql://{self.user}:{self.password}@{self.host}/{self.db}?charset=utf8mb4", pool_recycle=3600 * 4
+            f'postgresql+asyncpg://{user}:{password}@{host}/{db}',
+            poolclass=TimedAsyncQueuePool, **self.engine_pool_options(replica)
         )
         return async_engine
 
+    async def get_async_db(self) -> AsyncSession:
+        async with self.async_session() as db:
+            yield db
+
+    async def get_async_db_commit(self) -> AsyncSession:
+        """
+        写接口用，整个session走主库
+        """
+        async with self.async_session() as db:
+            use_primary(db.sync_session)
+            yield db
+            await db.commit()
+
 
 def get_model_column_keys(model):
     return [get_column_key(model, item) for item in get_columns(model)]
@@ -94,61 +431,881 @@ def marge_col_names(col_names, include: List[str] = None, ex_include: List[str]
 
 # 通用查询接口
 
-QueryType = Literal['=', '==', '>', '>=', '<', '<=', 'in', 'like', 'range', "find_in_set"]
+def include_kwargs(query_include: QueryInclude = None) -> dict:
+    """
+    QueryInclude转成to_full_dict的参数
+    """
+    if not query_include:
+        return {}
+    return dict(include=query_include.include, ex_include=query_include.ex_include,
+                relation_use_id=query_include.relation_use_id)
 
 
-class QueryParam(BaseModel):
-    name: str
-    type: QueryType
-    value: Any
+def page_data_dict(model, page_data: PageData, query_include: QueryInclude = None) -> dict:
+    return dict(
+        items=encode_rows(model, page_data.items, query_include),
+        count=page_data.count, page=page_data.page, page_size=page_data.page_size,
+        has_more=page_data.has_more, after=page_data.after, before=page_data.before,
+    )
 
 
-# class OrderParam(BaseModel):
-#     order_by: str
-#     type: Literal['asc', 'desc'] = 'asc'
+def get_dialect_name(db: Session) -> str:
+    return db.get_bind().dialect.name
 
 
-ModelInfo = TypeVar('ModelInfo', bound=BaseModel)
+def query_common(db: Session, model, query_params: QueryParams):
+    """
+    通用数据库查询接口
+    游标分页时，返回的query已经带上游标条件、排序和limit，page固定为1，调用方照常offset/limit即可
+    count_mode为window和none时count在取数据时才能得到，这里返回None，需要用query_page
+    """
+    query = db.query(model)
+    page = query_params.page
+    page_size = query_params.page_size
+    plan = make_query_plan(model, query_params)
+    # 筛选
+    query = query_common_filter(model, query, query_params, plan)
 
+    count = query_count(db, model, query, query_params)
 
-class QueryInclude(BaseModel):
-    include: Optional[List[str]] = None
-    ex_include: Optional[List[str]] = None
-    relation_use_id: bool = False  # 为true的话，m2m关系返回的是id数组
+    # 排序，放在count之后，count时不用排序
+    query = query_common_sort(model, query, query_params, plan, get_dialect_name(db))
+    if query_params.page_mode == 'cursor':
+        query = query.limit(page_size)
+        page = 1
 
+    return count, query, page, page_size
 
-class QueryParams(QueryInclude, Generic[ModelInfo]):
-    params: Optional[List[QueryParam]] = None
-    order: Optional[Dict[str, Literal["asc", "desc", None]]] = None
-    query: Optional[ModelInfo] = None
-    page: int
-    page_size: int
+
+def query_common_filter(model, query: Query, query_params: QueryParams, plan: 'QueryPlan' = None):
+    """
+    query和params两种筛选条件
+    """
+    plan = plan or make_query_plan(model, query_params)
+    for key, variant, values in plan.query_items:
+        query = query_data_core(model, query, key, variant, values, f'qd_{key}')
+    for index, (item, variant, values) in enumerate(plan.param_items):
+        query = query_param_core(model, query, item, variant, values, f'qp{index}')
+    return query
 
 
-def query_common(db: Session, model, query_params: QueryParams):
+def query_common_sort(model, query: Query, query_params: QueryParams, plan: 'QueryPlan', dialect_name: str = None):
     """
-    通用数据库查询接口
+    排序或者游标条件，再加上字段和关系的加载策略
     """
-    query = db.query(model)
-    # if query_params.ex_include:
-    #     query = query.options(Load(model).load_only(*query_params.include))
-    # if query_params.include:
-    #     query = query.options(Load(model).noload(*query_params.ex_include))
-    page = query_params.page
-    page_size = query_params.page_size
-    # 排序
-    if query_params.order:
+    if query_params.page_mode == 'cursor':
+        query = query_cursor(model, query, query_params, dialect_name, plan.cursor_values)
+    elif query_params.order:
         query = query_order(model, query, query_params.order)
+    return query.options(*query_load_options(model, query_params, get_query_required_keys(model, query_params)))
+
+
+# 语句缓存
+
+class StatementCache:
+    """
+    按查询形状缓存构建好的语句，LRU淘汰
+    形状相同的查询只是绑定参数的值不同，命中后直接复用语句对象，
+    省掉构建表达式树的开销，sqlalchemy对同一个语句对象也会直接命中编译缓存
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'size': len(self.data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
 
+
+statement_cache = StatementCache()
+
+
+class QueryPlan:
+    """
+    一次查询拆成形状和绑定参数，形状相同的查询语句结构完全一样
+    """
+    shape: tuple = None
+    binds: Dict[str, Any] = None
+    query_items: List[tuple] = None  # (字段名, 分支, 绑定值)
+    param_items: List[tuple] = None  # (QueryParam, 分支, 绑定值)
+    cursor_values: Optional[List[Any]] = None
+
+
+def _value_shape(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return 'list', type(value[0]).__name__ if value else None
+    return type(value).__name__
+
+
+def _values_shape(values: List[Any]):
+    return tuple(_value_shape(value) for value in values)
+
+
+def _keys_shape(keys: Optional[List[str]]):
+    return tuple(sorted(set(keys))) if keys else None
+
+
+def make_query_plan(model, query_params: QueryParams) -> QueryPlan:
+    """
+    计算query、params、游标各个条件的分支和绑定值，绑定参数名和构建语句时一致
+    """
+    plan = QueryPlan()
+    binds = {}
+    cols: Dict[str, TypeInfo] = model.model_config.cols
+    plan.query_items = []
     if query_params.query:
-        query = query_common_query_core(model, query, query_params.query)
-    # 筛选
-    if query_params.params:
-        query = query_common_params_core(model, query, query_params.params)
+        for key, value in query_params.query.dict(exclude_unset=True).items():
+            if key in cols:
+                plan.query_items.append((key, *query_data_plan(cols[key], value)))
+    plan.param_items = [(item, *query_param_plan(model, item)) for item in query_params.params or []]
+    for key, variant, values in plan.query_items:
+        for index, value in enumerate(values):
+            binds[f'qd_{key}_{index}'] = value
+    for param_index, (item, variant, values) in enumerate(plan.param_items):
+        for index, value in enumerate(values):
+            binds[f'qp{param_index}_{index}'] = value
+
+    order_keys = tuple((key, value) for key, value in (query_params.order or {}).items() if value)
+    if query_params.page_mode == 'cursor':
+        order_keys = tuple(get_cursor_order(model, query_params.order))
+        cursor = query_params.before if query_params.before is not None else query_params.after
+        if cursor:
+            plan.cursor_values = decode_cursor(cursor)
+            if len(plan.cursor_values) != len(order_keys):
+                raise HTTPException(status_code=400, detail="游标无效")
+            for index, value in enumerate(plan.cursor_values):
+                binds[f'cur_{index}'] = value
+
+    plan.binds = binds
+    plan.shape = (
+        tuple((key, variant, _values_shape(values)) for key, variant, values in plan.query_items),
+        tuple((item.name, item.type, variant, _values_shape(values)) for item, variant, values in plan.param_items),
+        order_keys,
+        query_params.page_mode,
+        query_params.before is not None,
+        _values_shape(plan.cursor_values or []),
+        _keys_shape(query_params.include),
+        _keys_shape(query_params.ex_include),
+        query_params.relation_use_id,
+    )
+    return plan
 
-    count = query.count()
 
-    return count, query, page, page_size
+def query_common_stmt(model, query_params: QueryParams, dialect_name: str = None):
+    """
+    query_common的select语句版本，返回 (筛选语句, 排序后的语句, count语句, 绑定参数)
+    同一形状的查询复用缓存的语句，执行时要带上绑定参数
+    """
+    plan = make_query_plan(model, query_params)
+    key = (model, dialect_name, plan.shape)
+    stmts = statement_cache.get(key)
+    if stmts is None:
+        stmt = query_common_filter(model, select(model), query_params, plan)
+        sort_stmt = query_common_sort(model, stmt, query_params, plan, dialect_name)
+        count_stmt = select(func.count()).select_from(stmt.subquery())
+        stmts = (stmt, sort_stmt, count_stmt)
+        statement_cache.set(key, stmts)
+    return (*stmts, plan.binds)
+
+
+def query_count(db: Session, model, query: Query, query_params: QueryParams) -> Optional[int]:
+    """
+    按count_mode统计总数
+    游标分页时count(*) over()只能统计到游标之后的行，退回精确count
+    """
+    count_mode = get_count_mode(query_params)
+    if count_mode == 'exact':
+        return query.count()
+    if count_mode == 'estimate':
+        return estimate_count(db, model, query.statement, bool(query_params.params or query_params.query))
+    return None
+
+
+def statement_count(db: Session, stmt, binds: Dict[str, Any] = None):
+    return db.execute(select(func.count()).select_from(stmt.order_by(None).subquery()), binds).scalar()
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN语句，内部语句按正常方式编译，绑定参数不受影响
+    """
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _pg_explain(element: Explain, compiler, **kw):
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+@compiles(Explain)
+def _explain(element: Explain, compiler, **kw):
+    return f"EXPLAIN {compiler.process(element.statement, **kw)}"
+
+
+class SearchMatch(ColumnElement):
+    """
+    按字段配置的搜索方式生成的条件，编译时按数据库选择写法，不支持的数据库退回LIKE '%值%'
+    """
+    inherit_cache = True
+    _traverse_internals = [
+        ('column', InternalTraversal.dp_clauseelement),
+        ('value', InternalTraversal.dp_clauseelement),
+        ('search', InternalTraversal.dp_string),
+        ('config', InternalTraversal.dp_string),
+    ]
+
+    def __init__(self, column, value, search: str = 'like', config: str = 'simple'):
+        self.column = column
+        self.value = value
+        self.search = search
+        self.config = config
+
+
+def ts_config(config: str):
+    """
+    分词配置直接写在sql里，表达式索引才能匹配上，不能用绑定参数
+    """
+    if not config.isidentifier():
+        raise ValueError(f"tsvector配置名无效: {config}")
+    return literal_column(f"'{config}'::regconfig")
+
+
+def search_vector(column, config: str = 'simple'):
+    return func.to_tsvector(ts_config(config), column)
+
+
+@compiles(SearchMatch)
+def _search_match(element: SearchMatch, compiler, **kw):
+    return compiler.process(element.column.contains(element.value), **kw)
+
+
+@compiles(SearchMatch, 'postgresql')
+def _pg_search_match(element: SearchMatch, compiler, **kw):
+    if element.search in ['tsvector', 'tsvector_column']:
+        vector = element.column if element.search == 'tsvector_column' else search_vector(element.column,
+                                                                                           element.config)
+        query = func.plainto_tsquery(ts_config(element.config), element.value)
+        return compiler.process(vector.op('@@')(query), **kw)
+    return compiler.process(element.column.contains(element.value), **kw)
+
+
+@compiles(SearchMatch, 'mysql', 'mariadb')
+def _mysql_search_match(element: SearchMatch, compiler, **kw):
+    if element.search == 'fulltext':
+        return compiler.process(element.column.match(element.value), **kw)
+    return compiler.process(element.column.contains(element.value), **kw)
+
+
+class FindInSet(ColumnElement):
+    """
+    逗号分隔字段里是否包含某个值，mysql直接用find_in_set
+    postgresql: 数组字段用 column @> ARRAY[值]，字符串字段用 string_to_array(column, ',') @> ARRAY[值]，
+    都可以建gin索引（字符串字段建在string_to_array表达式上）
+    """
+    inherit_cache = True
+    _traverse_internals = [
+        ('column', InternalTraversal.dp_clauseelement),
+        ('value', InternalTraversal.dp_clauseelement),
+    ]
+
+    def __init__(self, column, value):
+        self.column = column
+        self.value = value
+
+
+@compiles(FindInSet)
+def _find_in_set(element: FindInSet, compiler, **kw):
+    return compiler.process(func.find_in_set(element.value, element.column), **kw)
+
+
+@compiles(FindInSet, 'postgresql')
+def _pg_find_in_set(element: FindInSet, compiler, **kw):
+    if isinstance(element.column.type, ARRAY):
+        condition = element.column.op('@>')(pg_array([cast(element.value, element.column.type.item_type)]))
+    else:
+        condition = func.string_to_array(element.column, literal_column("','")).op('@>')(
+            pg_array([cast(element.value, Text)]))
+    return compiler.process(condition, **kw)
+
+
+@compiles(FindInSet, 'sqlite')
+def _sqlite_find_in_set(element: FindInSet, compiler, **kw):
+    condition = (literal(',') + element.column + literal(',')).contains(literal(',') + element.value + literal(','))
+    return compiler.process(condition, **kw)
+
+
+def search_index(column: Column, dialect_name: str) -> Optional[Index]:
+    """
+    字段search配置对应的索引，数据库不支持时返回None
+    """
+    search = column.info.get('search')
+    table_name = column.table.name
+    if dialect_name == 'postgresql':
+        if search == 'trgm':
+            return Index(f'ix_{table_name}_{column.name}_trgm', column, postgresql_using='gin',
+                         postgresql_ops={column.name: 'gin_trgm_ops'})
+        if search == 'tsvector':
+            search_column = column.info.get('search_column')
+            if search_column:
+                return Index(f'ix_{table_name}_{search_column}_gin', column.table.c[search_column],
+                             postgresql_using='gin')
+            config = column.info.get('search_config', 'simple')
+            # 表达式索引推断不出表，需要指定
+            return Index(f'ix_{table_name}_{column.name}_tsv', search_vector(column, config), postgresql_using='gin',
+                         _table=column.table)
+    if dialect_name in ['mysql', 'mariadb'] and search == 'fulltext':
+        return Index(f'ix_{table_name}_{column.name}_ft', column, mysql_prefix='FULLTEXT')
+    return None
+
+
+def estimate_count(db: Session, model, stmt, filtered=True, binds: Dict[str, Any] = None) -> int:
+    """
+    估算行数，不扫描数据
+    postgresql有筛选条件时取EXPLAIN的估算行数，没有时取pg_class.reltuples
+    mysql没有筛选条件时取information_schema里的table_rows
+    其他情况或者表还没有统计信息时退回精确count
+    """
+    dialect_name = get_dialect_name(db)
+    estimate = None
+    if dialect_name == 'postgresql':
+        if filtered:
+            plan = db.execute(Explain(stmt), binds).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = plan[0]['Plan']['Plan Rows']
+        else:
+            estimate = db.execute(text("select reltuples::bigint from pg_class where oid = cast(:name as regclass)")
+                                  .execution_options(readonly=True),
+                                  {'name': model.__table__.fullname}).scalar()
+    elif dialect_name == 'mysql' and not filtered:
+        estimate = db.execute(text("select table_rows from information_schema.tables "
+                                   "where table_schema = database() and table_name = :name")
+                              .execution_options(readonly=True),
+                              {'name': model.__tablename__}).scalar()
+    if estimate is None or estimate < 0:
+        return statement_count(db, stmt, binds)
+    return int(estimate)
+
+
+def page_query(query: Query, query_params: QueryParams, page: int, page_size: int):
+    """
+    取一页数据的语句，Query和select都适用
+    游标分页和count_mode为none、estimate时多查一条来判断是否还有下一页
+    """
+    if query_params.page_mode == 'cursor':
+        return query.limit(page_size + 1)
+    query = query.offset((page - 1) * page_size)
+    count_mode = get_count_mode(query_params)
+    if count_mode == 'window':
+        return query.add_columns(func.count().over().label('total_count')).limit(page_size)
+    if count_mode == 'exact':
+        return query.limit(page_size)
+    return query.limit(page_size + 1)
+
+
+def make_page_data(model, items: List[Any], count: Optional[int], query_params: QueryParams, page: int,
+                   page_size: int) -> PageData:
+    """
+    根据page_query查出的数据组装一页结果，游标分页生成前后页游标
+    """
+    page_data = PageData()
+    page_data.count = count
+    page_data.page = page
+    page_data.page_size = page_size
+    if query_params.page_mode != 'cursor':
+        if count is not None and get_count_mode(query_params) in ['exact', 'window']:
+            page_data.items = items
+            page_data.has_more = page * page_size < count
+        else:
+            page_data.items = items[:page_size]
+            page_data.has_more = len(items) > page_size
+        return page_data
+
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    backward = query_params.before is not None
+    if backward:
+        items.reverse()
+    page_data.items = items
+    page_data.has_more = has_more
+    if items:
+        order_keys = get_cursor_order(model, query_params.order)
+        # 往前翻时has_more表示前面还有数据，从游标翻页时反方向一定还有数据
+        if backward:
+            page_data.before = make_cursor(items[0], order_keys) if has_more else None
+            page_data.after = make_cursor(items[-1], order_keys) if query_params.before else None
+        else:
+            page_data.after = make_cursor(items[-1], order_keys) if has_more else None
+            page_data.before = make_cursor(items[0], order_keys) if query_params.after else None
+    return page_data
+
+
+def query_page(db: Session, model, query_params: QueryParams) -> PageData:
+    """
+    通用分页查询，直接返回一页数据，语句走statement_cache
+    """
+    page = 1 if query_params.page_mode == 'cursor' else query_params.page
+    page_size = query_params.page_size
+    stmt, sort_stmt, count_stmt, binds = query_common_stmt(model, query_params, get_dialect_name(db))
+    count_mode = get_count_mode(query_params)
+    count = None
+    if count_mode == 'exact':
+        count = db.execute(count_stmt, binds).scalar()
+    elif count_mode == 'estimate':
+        count = estimate_count(db, model, stmt, bool(query_params.params or query_params.query), binds)
+    result = db.execute(page_query(sort_stmt, query_params, page, page_size), binds)
+    if count_mode == 'window':
+        rows = result.all()
+        items = [row[0] for row in rows]
+        if rows:
+            count = rows[0][1]
+        else:
+            # 超出最后一页时取不到窗口结果，只能单独count
+            count = db.execute(count_stmt, binds).scalar() if page > 1 else 0
+    else:
+        items = result.scalars().all()
+    return make_page_data(model, items, count, query_params, page, page_size)
+
+
+# 只读列表的Core行查询，不建ORM对象
+
+def agg_ids(column, dialect_name: str = None):
+    if dialect_name == 'postgresql':
+        return func.array_agg(column)
+    # mysql/sqlite逗号拼接，mysql注意group_concat_max_len
+    return func.group_concat(column)
+
+
+def column_python_type(column: Column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return str
+
+
+class RowReader:
+    """
+    只读查询的投影：要查的列、要外连接的关系，以及把一行结果转成和to_full_dict一样的dict
+    m2o/o2o通过外连接带出目标表字段，m2m/o2m通过聚合子查询带出id数组
+    """
+
+    def __init__(self, model, query_params: QueryParams, dialect_name: str = None):
+        cols: Dict[str, TypeInfo] = model.model_config.cols
+        selected = marge_col_names(cols.keys(), query_params.include, query_params.ex_include)
+        mapper = sa_inspect(model)
+        self.columns = []
+        self.joins = []
+        self.outputs = []  # (字段名, 类型, 参数)
+        self.relation_use_id = query_params.relation_use_id
+        for name in [name for name in cols if name in selected]:
+            relation = cols[name].relation
+            if not relation:
+                self.outputs.append((name, 'column', self.add_column(getattr(model, name).label(name))))
+            elif relation.relation_type in ['m2o', 'o2o']:
+                target = aliased(relation.target_model)
+                self.joins.append((target, getattr(model, name).of_type(target)))
+                names = [c.name for c in relation.target_model.__table__.columns]
+                indexes = [self.add_column(getattr(target, c).label(f'{name}__{c}')) for c in names]
+                pk_index = indexes[names.index(relation.target_id_key)]
+                self.outputs.append((name, 'object', (tuple(names), tuple(indexes), pk_index)))
+            elif relation.relation_type in ['m2m', 'o2m']:
+                target_table = relation.target_model.__table__
+                id_type = column_python_type(target_table.c[relation.target_id_key])
+                if relation.relation_type == 'm2m':
+                    secondary = relation.secondary
+                    ids = select(agg_ids(secondary.c[relation.target_secondary_key], dialect_name)).where(
+                        secondary.c[relation.source_secondary_key] == model.__table__.c[relation.source_key])
+                else:
+                    target_alias = target_table.alias()
+                    pairs = mapper.relationships[name].local_remote_pairs
+                    ids = select(agg_ids(target_alias.c[relation.target_id_key], dialect_name)).where(
+                        and_(*[target_alias.c[remote.key] == local for local, remote in pairs]))
+                index = self.add_column(ids.scalar_subquery().label(name))
+                self.outputs.append((name, 'ids', (index, id_type, relation)))
+        for key in get_query_required_keys(model, query_params):
+            if key not in selected:
+                self.add_column(getattr(model, key).label(key))
+
+    def add_column(self, column) -> int:
+        self.columns.append(column)
+        return len(self.columns) - 1
+
+    def stmt(self, filter_stmt):
+        stmt = filter_stmt.with_only_columns(*self.columns, maintain_column_froms=True)
+        for target, onclause in self.joins:
+            stmt = stmt.outerjoin(target, onclause)
+        return stmt
+
+    def __call__(self, db: Session, rows: list) -> List[dict]:
+        items = []
+        targets = {}
+        for row in rows:
+            data = {}
+            for name, kind, arg in self.outputs:
+                if kind == 'column':
+                    data[name] = row[arg]
+                elif kind == 'object':
+                    names, indexes, pk_index = arg
+                    data[name] = None if row[pk_index] is None else dict(zip(names, [row[i] for i in indexes]))
+                else:
+                    index, id_type, relation = arg
+                    value = row[index]
+                    if value is None:
+                        ids = []
+                    elif isinstance(value, list):
+                        ids = value
+                    else:
+                        ids = [id_type(child) for child in str(value).split(',')]
+                    data[name] = ids
+                    if not self.relation_use_id:
+                        targets.setdefault(name, (relation, set()))[1].update(ids)
+            items.append(data)
+        # 不用id时按id一次查出目标数据，和selectinload一样每个关系一条语句
+        for name, (relation, ids) in targets.items():
+            table = relation.target_model.__table__
+            id_column = table.c[relation.target_id_key]
+            loaded = {}
+            for chunk in chunk_list(list(ids)):
+                for target in db.execute(select(table).where(id_column.in_(chunk))).mappings():
+                    loaded[target[relation.target_id_key]] = dict(target)
+            for data in items:
+                data[name] = [loaded[child] for child in data[name] if child in loaded]
+        return items
+
+
+def query_rows_stmt(model, query_params: QueryParams, dialect_name: str = None):
+    """
+    只读查询的语句，返回 (筛选语句, 查询语句, count语句, RowReader, 绑定参数)，同样按形状缓存
+    """
+    plan = make_query_plan(model, query_params)
+    key = (model, dialect_name, plan.shape, 'rows')
+    stmts = statement_cache.get(key)
+    if stmts is None:
+        stmt = query_common_filter(model, select(model), query_params, plan)
+        reader = RowReader(model, query_params, dialect_name)
+        rows_stmt = reader.stmt(stmt)
+        if query_params.page_mode == 'cursor':
+            rows_stmt = query_cursor(model, rows_stmt, query_params, dialect_name, plan.cursor_values)
+        elif query_params.order:
+            rows_stmt = query_order(model, rows_stmt, query_params.order)
+        count_stmt = select(func.count()).select_from(stmt.subquery())
+        stmts = (stmt, rows_stmt, count_stmt, reader)
+        statement_cache.set(key, stmts)
+    return (*stmts, plan.binds)
+
+
+def query_rows(db: Session, model, query_params: QueryParams) -> PageData:
+    """
+    只读列表查询，直接从游标取元组拼dict，不建ORM对象，items和to_full_dict的结果一样
+    分页、游标、count_mode和query_page相同
+    """
+    page = 1 if query_params.page_mode == 'cursor' else query_params.page
+    page_size = query_params.page_size
+    stmt, rows_stmt, count_stmt, reader, binds = query_rows_stmt(model, query_params, get_dialect_name(db))
+    count_mode = get_count_mode(query_params)
+    count = None
+    if count_mode == 'exact':
+        count = db.execute(count_stmt, binds).scalar()
+    elif count_mode == 'estimate':
+        count = estimate_count(db, model, stmt, bool(query_params.params or query_params.query), binds)
+    rows = db.execute(page_query(rows_stmt, query_params, page, page_size), binds).all()
+    if count_mode == 'window':
+        if rows:
+            count = rows[0].total_count
+        else:
+            count = db.execute(count_stmt, binds).scalar() if page > 1 else 0
+    # 游标从Row上按字段名取值，先组装分页再转dict
+    page_data = make_page_data(model, rows, count, query_params, page, page_size)
+    page_data.items = reader(db, page_data.items)
+    return page_data
+
+
+ExportFormat = Literal['ndjson', 'csv']
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+
+
+def export_default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return str(value)
+
+
+def export_cell(value) -> str:
+    """
+    csv单元格，关系字段转成json
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=export_default)
+    return export_default(value)
+
+
+def export_chunks(session_factory, model, query_params: QueryParams, export_format: ExportFormat = 'ndjson',
+                  batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    按query_common的筛选和排序导出全部数据，每批数据生成一段文本
+    yield_per会开stream_results，psycopg2下是服务端游标，内存和总行数无关
+    session自己开自己关，yield依赖里的session在开始发送响应前就关了
+    """
+    db: Session = session_factory()
+    try:
+        _, sort_stmt, _, binds = query_common_stmt(model, query_params, get_dialect_name(db))
+        result = db.execute(sort_stmt.execution_options(yield_per=batch_size), binds)
+        encoder = get_row_encoder(model, **include_kwargs(query_params))
+        selected = marge_col_names(model.model_config.col_names, query_params.include, query_params.ex_include)
+        col_names = [name for name in model.model_config.col_names if name in selected]
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(col_names)
+            yield '\ufeff' + buffer.getvalue()  # 带BOM，excel才会按utf-8打开
+        for items in result.scalars().partitions():
+            if export_format == 'csv':
+                buffer.seek(0)
+                buffer.truncate()
+                for item in items:
+                    row = encoder(item)
+                    writer.writerow([export_cell(row[name]) for name in col_names])
+                chunk = buffer.getvalue()
+            else:
+                chunk = ''.join(json.dumps(encoder(item), ensure_ascii=False, default=export_default)
+                                + '\n' for item in items)
+            yield chunk
+    finally:
+        db.close()
+
+
+def export_response(session_factory, model, query_params: QueryParams, export_format: ExportFormat = 'ndjson',
+                    batch_size: int = EXPORT_BATCH_SIZE, request: Request = None) -> StreamingResponse:
+    """
+    流式导出响应，给了request时每批之前检查客户端是否断开，断开就停止查询并关掉游标
+    """
+    chunks = export_chunks(session_factory, model, query_params, export_format, batch_size)
+
+    async def stream():
+        try:
+            while True:
+                chunk = await run_in_threadpool(next, chunks, None)
+                if chunk is None or (request is not None and await request.is_disconnected()):
+                    break
+                yield chunk
+        finally:
+            await run_in_threadpool(chunks.close)
+
+    headers = {'Content-Disposition': f'attachment; filename="{model.__tablename__}.{export_format}"'}
+    return StreamingResponse(stream(), media_type=EXPORT_MEDIA_TYPES[export_format], headers=headers)
+
+
+def get_query_required_keys(model, query_params: QueryParams) -> List[str]:
+    """
+    不在输出里也必须加载的字段，游标分页要用排序字段的值生成游标
+    """
+    if query_params.page_mode == 'cursor':
+        return [key for key, _ in get_cursor_order(model, query_params.order)]
+    return []
+
+
+def column_load_options(model, query_include: QueryInclude = None, required_keys: List[str] = None):
+    """
+    include/ex_include下推到sql，只查需要的列，不再SELECT *
+    主键、输出的关系需要的外键和required_keys总会加载
+    没加载的列再访问会单独查询，to_dict/to_full_dict的include/ex_include要和查询时一致
+    """
+    include = query_include and query_include.include
+    ex_include = query_include and query_include.ex_include
+    if not include and not ex_include:
+        return []
+    model_config: ModelConfig = model.model_config
+    cols: Dict[str, TypeInfo] = model_config.cols
+    mapper = sa_inspect(model)
+    col_names = marge_col_names(cols.keys(), include, ex_include)
+    keys = {model_config.id_key, *(required_keys or [])}
+    for name in col_names:
+        if cols[name].relation:
+            # 关系两边对应的本表字段，m2o是外键，o2m/m2m是主键
+            for column in getattr(model, name).property.local_columns:
+                keys.add(mapper.get_property_by_column(column).key)
+        else:
+            keys.add(name)
+    column_keys = [prop.key for prop in mapper.column_attrs]
+    return [load_only(*[getattr(model, key) for key in column_keys if key in keys])]
+
+
+def query_load_options(model, query_include: QueryInclude = None, required_keys: List[str] = None):
+    return column_load_options(model, query_include, required_keys) + relation_load_options(model, query_include)
+
+
+def relation_load_options(model, query_include: QueryInclude = None):
+    """
+    根据include/ex_include和relation_use_id给关系字段加上加载策略，避免to_full_dict逐行懒加载
+    m2o/o2o用joinedload跟主表一起查，m2m/o2m用selectinload按主表id一次查完，不输出的关系noload
+    relation_use_id时m2m/o2m只加载目标表主键
+    """
+    include = query_include and query_include.include
+    ex_include = query_include and query_include.ex_include
+    relation_use_id = bool(query_include and query_include.relation_use_id)
+    cols: Dict[str, TypeInfo] = model.model_config.cols
+    col_names = marge_col_names(cols.keys(), include, ex_include)
+    options = []
+    for name, col in cols.items():
+        relation = col.relation
+        if not relation:
+            continue
+        attr = getattr(model, name)
+        if name not in col_names:
+            options.append(noload(attr))
+        elif relation.relation_type in ['m2o', 'o2o']:
+            options.append(joinedload(attr))
+        elif relation_use_id:
+            options.append(selectinload(attr).load_only(getattr(relation.target_model, relation.target_id_key)))
+        else:
+            options.append(selectinload(attr))
+    return options
+
+
+async def query_count_async(db: AsyncSession, model, stmt, count_stmt, binds: Dict[str, Any],
+                            query_params: QueryParams) -> Optional[int]:
+    count_mode = get_count_mode(query_params)
+    if count_mode == 'exact':
+        return (await db.execute(count_stmt, binds)).scalar()
+    if count_mode == 'estimate':
+        return await db.run_sync(estimate_count, model, stmt, bool(query_params.params or query_params.query), binds)
+    return None
+
+
+async def query_common_async(db: AsyncSession, model, query_params: QueryParams):
+    """
+    query_common的异步版本，筛选、排序、游标和count_mode都一样
+    返回的是已经带上参数值的select语句，用 (await db.execute(stmt.offset().limit())).scalars() 取数据
+    """
+    page = query_params.page
+    page_size = query_params.page_size
+    stmt, sort_stmt, count_stmt, binds = query_common_stmt(model, query_params, get_dialect_name(db))
+
+    count = await query_count_async(db, model, stmt, count_stmt, binds, query_params)
+
+    if query_params.page_mode == 'cursor':
+        sort_stmt = sort_stmt.limit(page_size)
+        page = 1
+
+    return count, sort_stmt.params(binds), page, page_size
+
+
+async def query_page_async(db: AsyncSession, model, query_params: QueryParams) -> PageData:
+    """
+    query_page的异步版本
+    """
+    page = 1 if query_params.page_mode == 'cursor' else query_params.page
+    page_size = query_params.page_size
+    stmt, sort_stmt, count_stmt, binds = query_common_stmt(model, query_params, get_dialect_name(db))
+    count = await query_count_async(db, model, stmt, count_stmt, binds, query_params)
+    result = await db.execute(page_query(sort_stmt, query_params, page, page_size), binds)
+    if get_count_mode(query_params) == 'window':
+        rows = result.all()
+        items = [row[0] for row in rows]
+        if rows:
+            count = rows[0][1]
+        else:
+            count = (await db.execute(count_stmt, binds)).scalar() if page > 1 else 0
+    else:
+        items = result.scalars().all()
+    return make_page_data(model, items, count, query_params, page, page_size)
+
+
+def get_cursor_order(model, order: Optional[Dict[str, Literal["asc", "desc", None]]]):
+    """
+    游标分页的排序字段，最后补上主键保证顺序唯一
+    排序字段需要非空，空值无法参与比较
+    """
+    id_key = model.model_config.id_key
+    order_keys = [(key, value) for key, value in (order or {}).items() if value]
+    if id_key not in [key for key, _ in order_keys]:
+        order_keys.append((id_key, 'asc'))
+    return order_keys
+
+
+def make_cursor(item, order_keys) -> str:
+    return encode_cursor([getattr(item, key) for key, _ in order_keys])
+
+
+def cursor_filter(model, order_keys, values: List[Any], reverse=False, dialect_name: str = None):
+    """
+    keyset条件，(a, b) > (va, vb)
+    排序方向一致时postgresql用行比较，能直接走联合索引，其他情况展开为 a > va or (a = va and b > vb)
+    """
+    columns = [getattr(model, key) for key, _ in order_keys]
+    binds = [bind_value(f'cur_{index}', value, column) for index, (column, value) in enumerate(zip(columns, values))]
+    directions = {direction for _, direction in order_keys}
+    if len(directions) == 1 and dialect_name == 'postgresql':
+        forward = (directions.pop() == 'asc') != reverse
+        if forward:
+            return tuple_(*columns) > tuple_(*binds)
+        return tuple_(*columns) < tuple_(*binds)
+    conditions = []
+    for index, (column, (_, direction)) in enumerate(zip(columns, order_keys)):
+        forward = (direction == 'asc') != reverse
+        condition = column > binds[index] if forward else column < binds[index]
+        conditions.append(and_(*[columns[i] == binds[i] for i in range(index)], condition))
+    return or_(*conditions)
+
+
+def query_cursor(model, query: Query, query_params: QueryParams, dialect_name: str = None,
+                 values: List[Any] = None):
+    """
+    游标分页，加上游标条件和排序，before时倒序查询，结果需要再反转
+    values是已经解码的游标值，不传时从after/before解码
+    """
+    order_keys = get_cursor_order(model, query_params.order)
+    reverse = query_params.before is not None
+    cursor = query_params.before if reverse else query_params.after
+    if values is None and cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(order_keys):
+            raise HTTPException(status_code=400, detail="游标无效")
+    if values:
+        query = query.filter(cursor_filter(model, order_keys, values, reverse, dialect_name))
+    for key, direction in order_keys:
+        column: Column = getattr(model, key)
+        if (direction == 'asc') != reverse:
+            query = query.order_by(asc(column))
+        else:
+            query = query.order_by(desc(column))
+    return query
 
 
 def query_order(model, query: Query, order_param: Dict[str, Literal["asc", "desc", None]]):
@@ -165,158 +1322,270 @@ def query_order(model, query: Query, order_param: Dict[str, Literal["asc", "desc
     return query
 
 
-def query_common_params_core(model, query: Query, params: List[QueryParam]):
+# 筛选条件
+# 每个条件先算出 (分支, 绑定值)，分支只跟字段和值的形状有关，再按分支用命名绑定参数拼接条件，
+# 这样同一形状的查询拼出的语句完全一样，可以缓存
+
+COMPARE_OPERATORS = {
+    '>': operators.gt,
+    '>=': operators.ge,
+    '<': operators.lt,
+    '<=': operators.le,
+}
+
+
+def bind_value(key: str, value, expr, operator=operators.eq, expanding=False):
+    """
+    命名绑定参数，类型和直接写 column == value 时一样
+    """
+    check_value = value[0] if expanding and value else value
+    return bindparam(key, value, type_=expr.type.coerce_compared_value(operator, check_value), expanding=expanding)
+
+
+def split_param_name(name: str):
+    """
+    name.child 形式的字段名，child是关系表或者json里的字段
+    """
+    if '.' in name:
+        name, child_name = name.split('.')
+        return name, child_name
+    return name, ""
+
+
+def date_eq_plan(value):
+    """
+    datetime字段按天查询改成 [当天0点, 第二天0点) 的范围，date(column)用不上索引
+    值解析不出日期时还是按date(column)比较
+    """
+    if isinstance(value, datetime):
+        day = value.date()
+    elif isinstance(value, date):
+        day = value
+    elif isinstance(value, str):
+        try:
+            day = date.fromisoformat(value[:10])
+        except ValueError:
+            return 'date_eq', [value]
+    else:
+        return 'date_eq', [value]
+    start = datetime.combine(day, time())
+    return 'date_range', [start, start + timedelta(days=1)]
+
+
+def is_string_column(column) -> bool:
+    """
+    字符串类型的列like时不用cast，Uuid之类映射成str的列还要cast成字符串
+    """
+    return isinstance(getattr(column, 'type', None), String)
+
+
+def query_param_plan(model, item: QueryParam):
+    """
+    params里一个条件的 (分支, 绑定值)
+    """
     cols: Dict[str, TypeInfo] = model.model_config.cols
-    for item in params:
-        name = item.name
-        child_name = ""
-        if '.' in name:
-            [name, child_name] = name.split('.')
-        query_type = item.type
-        value = item.value
-        col = cols[name]
-        col_base_type = col.col_base_type
-        column: Column = getattr(model, name)
-        if col_base_type == 'relation' and col.relation:
-            if col.relation.relation_type in ['m2o', 'o2o']:
-                if col.relation.source_foreign_key:
-                    query = query.join(col.relation.target_model,
-                                       getattr(col.relation.target_model, col.relation.target_id_key) == getattr(model,
-                                                                                                                 col.relation.source_foreign_key))
-                else:
-                    query = query.join(col.relation.target_model)
-                column = getattr(col.relation.target_model, child_name)
-        else:
-            if col_base_type == 'json':
-                column = column[child_name]
-        if query_type in ['=', '==']:
-            if col_base_type == 'relation' and col.relation and not child_name:
-                relation_type = col.relation.relation_type
-                secondary = col.relation.secondary
-                target_secondary_key = col.relation.target_secondary_key
-                source_secondary_key = col.relation.source_secondary_key
-                if relation_type == 'm2m':
-                    query = query.join(secondary, model.id == secondary.columns.get(source_secondary_key)) \
-                        .filter(secondary.columns.get(target_secondary_key) == value)
-            else:
-                if col.col_base_type == 'datetime':
-                    query = query.filter(func.date(column) == value)
-                elif col_base_type == 'json':
-                    query = query.filter(column == json.dumps(value))
-                else:
-                    query = query.filter(column == value)
-
-        elif query_type == ">":
-            query = query.filter(column > value)
-        elif query_type == "<":
-            query = query.filter(column < value)
-        elif query_type == ">=":
-            query = query.filter(column >= value)
-        elif query_type == "<=":
-            query = query.filter(column <= value)
-        elif query_type == "in":
-            if col_base_type == 'relation' and col.relation:
-                relation_type = col.relation.relation_type
-                if relation_type == 'm2m':
-                    secondary = col.relation.secondary
-                    target_secondary_key = col.relation.target_secondary_key
-                    source_secondary_key = col.relation.source_secondary_key
-                    if value and type(value) == list:
-                        query = query.join(secondary, model.id == secondary.columns.get(source_secondary_key)) \
-                            .filter(secondary.columns.get(target_secondary_key).in_(value))
-                    else:
-                        query = query.join(secondary, model.id == secondary.columns.get(source_secondary_key)) \
-                            .filter(secondary.columns.get(target_secondary_key) == value)
+    name, child_name = split_param_name(item.name)
+    query_type = item.type
+    value = item.value
+    col = cols[name]
+    col_base_type = col.col_base_type
+    is_relation = col_base_type == 'relation' and col.relation
+    if query_type in ['=', '==']:
+        if is_relation and not child_name:
+            if col.relation.relation_type == 'm2m':
+                return 'm2m_eq', [value]
+            return 'skip', []
+        if col_base_type == 'datetime':
+            return date_eq_plan(value)
+        if col_base_type == 'json':
+            return 'eq', [json.dumps(value)]
+        if value is None:
+            return 'is_null', []
+        return 'eq', [value]
+    if query_type in COMPARE_OPERATORS:
+        return 'compare', [value]
+    if query_type == 'in':
+        if is_relation:
+            if col.relation.relation_type != 'm2m':
+                return 'skip', []
+            if value and type(value) == list:
+                return 'm2m_in', [value]
+            return 'm2m_eq', [value]
+        return 'in', [list(value) if isinstance(value, (list, tuple, set)) else [value]]
+    if query_type == 'like':
+        if col.search and not child_name:
+            return 'search', [value]
+        if not child_name and col_base_type == 'str' and is_string_column(getattr(model, name)):
+            return 'like', [f'%{value}%']
+        if child_name and is_relation and col.relation.relation_type in ['m2o', 'o2o']:
+            target_model = col.relation.target_model
+            child_col = target_model.model_config.cols.get(child_name)
+            if child_col and child_col.col_base_type == 'str' and is_string_column(getattr(target_model, child_name)):
+                return 'like', [f'%{value}%']
+        return 'like_cast', [f'%{value}%']
+    if query_type == 'find_in_set':
+        return 'find_in_set', [str(value)]
+    if query_type == 'range':
+        return range_plan(value)
+    return 'skip', []
+
+
+def query_data_plan(col: 'TypeInfo', value):
+    """
+    query模型里一个字段的 (分支, 绑定值)
+    """
+    col_base_type = col.col_base_type
+    if col_base_type in ['int', 'float', 'any', 'enum', 'str']:
+        if type(value) == list and value:
+            return 'in', [value]
+        if col_base_type == 'str' and value:
+            if col.search:
+                return 'search', [value]
+            return 'like', [f'%{value}%']
+        if value is None:
+            return 'is_null', []
+        return 'eq', [value]
+    if col_base_type in ['date', 'datetime', 'time']:
+        if not value:
+            return 'skip', []
+        if type(value) == list:
+            if len(value) == 2:
+                return range_plan(value)
+            return 'skip', []
+        if col_base_type == 'datetime':
+            # 按天查
+            return date_eq_plan(value)
+        return 'eq', [value]
+    if col_base_type == 'relation' and col.relation:
+        relation_type = col.relation.relation_type
+        if relation_type in ['m2m', 'o2m']:
+            if value and type(value) == list:
+                return f'{relation_type}_in', [value]
+            return f'{relation_type}_eq', [value]
+    return 'skip', []
+
+
+def query_condition_core(model, query: Query, col: 'TypeInfo', column, query_type: str, variant: str,
+                         values: List[Any], prefix: str):
+    """
+    按分支拼接条件，绑定参数名为 {prefix}_{序号}
+    """
 
-            else:
-                query = query.filter(column.in_(value))
-        elif query_type == "like":
-            query = query.filter(column.cast(String).like(f'%{value}%'))
-        elif query_type == "find_in_set":
-            query = query.filter(func.find_in_set(value, column))
-        elif query_type == "range":
-            if value:
-                if len(value) == 1 and value[0] is not None:
-                    query = query.filter(column >= value[0])
-                if len(value) == 2:
-                    if value[0] is not None and value[1] is None:
-                        query = query.filter(column >= value[0])
-                    if value[0] is None and value[1] is not None:
-                        query = query.filter(column <= value[1])
-                    if value[0] is not None and value[1] is not None:
-                        query = query.filter(and_(column >= value[0], column <= value[1]))
+    def bind(index, expr, operator=operators.eq, expanding=False):
+        return bind_value(f'{prefix}_{index}', values[index], expr, operator, expanding)
+
+    if variant == 'skip':
+        return query
+    if variant == 'eq':
+        return query.filter(column == bind(0, column))
+    if variant == 'is_null':
+        return query.filter(column.is_(None))
+    if variant == 'date_eq':
+        date_column = func.date(column)
+        return query.filter(date_column == bind(0, date_column))
+    if variant == 'date_range':
+        return query.filter(and_(column >= bind(0, column, operators.ge), column < bind(1, column, operators.lt)))
+    if variant == 'compare':
+        operator = COMPARE_OPERATORS[query_type]
+        return query.filter(operator(column, bind(0, column, operator)))
+    if variant == 'in':
+        return query.filter(column.in_(bind(0, column, operators.in_op, True)))
+    if variant == 'like':
+        return query.filter(column.like(bind(0, column, operators.like_op)))
+    if variant == 'search':
+        search_column = col.search_column and getattr(model, col.search_column)
+        search_type = 'tsvector_column' if search_column is not None else col.search
+        return query.filter(SearchMatch(column if search_column is None else search_column, bind(0, column),
+                                        search_type, col.search_config))
+    if variant == 'like_cast':
+        str_column = column.cast(String)
+        return query.filter(str_column.like(bind(0, str_column, operators.like_op)))
+    if variant == 'find_in_set':
+        return query.filter(FindInSet(column, bindparam(f'{prefix}_0', values[0], type_=String())))
+    if variant == 'range_ge':
+        return query.filter(column >= bind(0, column, operators.ge))
+    if variant == 'range_le':
+        return query.filter(column <= bind(0, column, operators.le))
+    if variant == 'range_between':
+        return query.filter(and_(column >= bind(0, column, operators.ge), column <= bind(1, column, operators.le)))
+    if variant in ['m2m_eq', 'm2m_in']:
+        relation = col.relation
+        secondary = relation.secondary
+        source_column = secondary.columns.get(relation.source_secondary_key)
+        target_column = secondary.columns.get(relation.target_secondary_key)
+        query = query.join(secondary, getattr(model, model.model_config.id_key) == source_column)
+        if variant == 'm2m_in':
+            return query.filter(target_column.in_(bind(0, target_column, operators.in_op, True)))
+        return query.filter(target_column == bind(0, target_column))
+    if variant in ['o2m_eq', 'o2m_in']:
+        target_model = col.relation.target_model
+        target_column = getattr(target_model, col.relation.target_id_key)
+        query = query.join(target_model)
+        if variant == 'o2m_in':
+            return query.filter(target_column.in_(bind(0, target_column, operators.in_op, True)))
+        return query.filter(target_column == bind(0, target_column))
     return query
 
 
-def query_common_query_core(model, query: Query, query_data: BaseModel):
-    q_data = query_data.dict(exclude_unset=True)
+def query_param_core(model, query: Query, item: QueryParam, variant: str, values: List[Any], prefix: str):
+    """
+    params里的一个条件，关系字段先join，json字段取子字段
+    """
+    if variant == 'skip':
+        return query
     cols: Dict[str, TypeInfo] = model.model_config.cols
-    for key, value in q_data:
-        annotation = query_data.__annotations__[key]
-        if key in cols:
-            column: Column = getattr(model, key)
-            col = cols[key]
-            col_base_type = col.col_base_type
-            if col_base_type in ['int', 'float', 'any', 'enum', 'str']:
-                if type(value) == list and value:
-                    query = query.filter(column.in_(value))
-                else:
-                    if col_base_type == 'str' and value:
-                        query = query.filter(column.like(f'%{value}%'))
-                    else:
-                        query = query.filter(column == value)
+    name, child_name = split_param_name(item.name)
+    col = cols[name]
+    column: Column = getattr(model, name)
+    if col.col_base_type == 'relation' and col.relation:
+        relation = col.relation
+        if relation.relation_type in ['m2o', 'o2o']:
+            if relation.source_foreign_key:
+                query = query.join(relation.target_model,
+                                   getattr(relation.target_model, relation.target_id_key) == getattr(
+                                       model, relation.source_foreign_key))
+            else:
+                query = query.join(relation.target_model)
+            column = getattr(relation.target_model, child_name)
+    elif col.col_base_type == 'json':
+        column = column[child_name]
+    return query_condition_core(model, query, col, column, item.type, variant, values, prefix)
 
-            elif col_base_type in ['date', 'datetime', 'time']:
-                if value:
-                    if type(value) == list:
-                        if len(value) == 2:
-                            if value[0] is not None:
-                                query = query.filter(column >= value)
-                            if value[1] is not None:
-                                query = query.filter(column <= value)
 
-                    else:
-                        if col_base_type == 'datetime':
-                            # datetime转date来查
-                            query = query.filter(func.date(column) == value)
-                        else:
-                            query = query.filter(column == value)
-            elif col_base_type == 'relation' and col.relation:
-                relation_type = col.relation.relation_type
-                if relation_type == 'm2m':
-                    secondary = col.relation.secondary
-                    target_secondary_key = col.relation.target_secondary_key
-                    source_secondary_key = col.relation.source_secondary_key
-
-                    if value and type(value) == list:
-                        query = query.join(secondary, model.id == getattr(secondary, source_secondary_key)) \
-                            .filter(getattr(secondary, target_secondary_key).in_(value))
-                    else:
-                        query = query.join(secondary, model.id == getattr(secondary, source_secondary_key)) \
-                            .filter(getattr(secondary, target_secondary_key) == value)
-                elif relation_type == 'o2m':
-                    target_model = col.relation.target_model
-                    target_id_key = col.relation.target_id_key
-
-                    if value and type(value) == list:
-                        query = query.join(target_model).filter(getattr(target_model, target_id_key).in_(value))
-                    else:
-                        query = query.join(target_model).filter(getattr(target_model, target_id_key == value))
+def query_data_core(model, query: Query, key: str, variant: str, values: List[Any], prefix: str):
+    col: TypeInfo = model.model_config.cols[key]
+    return query_condition_core(model, query, col, getattr(model, key), None, variant, values, prefix)
+
 
+def query_common_params_core(model, query: Query, params: List[QueryParam]):
+    for index, item in enumerate(params):
+        variant, values = query_param_plan(model, item)
+        query = query_param_core(model, query, item, variant, values, f'qp{index}')
     return query
 
 
-def tree_table_to_json(db: Session, model, belong_str='belong', key_str='id'):
+def query_common_query_core(model, query: Query, query_data: BaseModel):
+    cols: Dict[str, TypeInfo] = model.model_config.cols
+    for key, value in query_data.dict(exclude_unset=True).items():
+        if key in cols:
+            variant, values = query_data_plan(cols[key], value)
+            query = query_data_core(model, query, key, variant, values, f'qd_{key}')
+    return query
+
+
+def tree_columns(model, belong_str='belong', key_str='id', col_names: List[str] = None) -> List[Column]:
     """
-    树结构数据库存储到json
+    树节点需要的字段，col_names为空时和to_dict一样取全部字段
     """
-    item_list = db.query(model).all()
-    node_list = []
-    for item in item_list:
-        item_dic = item.to_dict()
-        item_dic['children'] = []
-        node_list.append(item_dic)
+    table = model.__table__
+    col_names = col_names or [c.name for c in table.columns]
+    return [table.c[name] for name in dict.fromkeys([key_str, belong_str, *col_names])]
 
+
+def build_tree(node_list: List[dict], belong_str='belong', key_str='id') -> (List[dict], Dict[Any, dict]):
+    """
+    节点列表组装成树，返回 (根节点列表, {id: 节点})，找不到上级的节点不在树里
+    """
     nodes_dic = {node[key_str]: node for node in node_list}
     tree = []
     for node in node_list:
@@ -326,7 +1595,134 @@ def tree_table_to_json(db: Session, model, belong_str='belong', key_str='id'):
                 nodes_dic[belong]['children'].append(node)
         else:
             tree.append(node)
-    return tree
+    return tree, nodes_dic
+
+
+def tree_table_to_json(db: Session, model, belong_str='belong', key_str='id', col_names: List[str] = None):
+    """
+    树结构数据库存储到json
+    col_names只查需要的字段，不建ORM对象
+    """
+    rows = db.execute(select(*tree_columns(model, belong_str, key_str, col_names))).mappings()
+    node_list = [{**row, 'children': []} for row in rows]
+    return build_tree(node_list, belong_str, key_str)[0]
+
+
+def tree_subtree(db: Session, model, root_id, max_depth: int = 32, belong_str='belong', key_str='id',
+                 col_names: List[str] = None) -> Optional[dict]:
+    """
+    用递归CTE只查一个分支，max_depth为下探层数，0只有根节点，数据里有环时也靠它结束递归
+    """
+    columns = tree_columns(model, belong_str, key_str, col_names)
+    depth = literal(0).label('tree_depth')
+    tree = select(*columns, depth).where(columns[0] == root_id).cte('tree', recursive=True)
+    child = model.__table__.alias()
+    child_select = select(*[child.c[column.name] for column in columns], (tree.c.tree_depth + 1).label('tree_depth'))
+    child_select = child_select.where(child.c[belong_str] == tree.c[key_str], tree.c.tree_depth < max_depth)
+    tree = tree.union_all(child_select)
+    root = None
+    nodes_dic = {}
+    # 按层数排序，上级一定先出现
+    for row in db.execute(select(tree).order_by(tree.c.tree_depth)).mappings():
+        node = {column.name: row[column.name] for column in columns}
+        node['children'] = []
+        if root is None:
+            root = node
+        else:
+            nodes_dic[node[belong_str]]['children'].append(node)
+        nodes_dic[node[key_str]] = node
+    return root
+
+
+class TreeCache:
+    """
+    一个树表的进程内缓存，第一次读整表建树，之后只按改动的id补丁
+    ModelCRUD(model, tree_cache=...)写入后标记改动的id，下次get时一条 id IN 查出这些行，
+    存在的新增或更新（上级变了就挪过去），不存在的从上级里摘掉
+    多进程部署时别的进程的写入靠ttl到期重建兜底，返回的树不要修改
+    """
+
+    def __init__(self, model, belong_str='belong', key_str='id', col_names: List[str] = None, ttl: int = 60):
+        self.model = model
+        self.belong_str = belong_str
+        self.key_str = key_str
+        self.col_names = col_names
+        self.ttl = ttl
+        self.lock = Lock()
+        self.tree: List[dict] = None
+        self.nodes_dic: Dict[Any, dict] = {}
+        self.dirty = set()
+        self.build_time = 0
+
+    def mark_dirty(self, ids: list):
+        with self.lock:
+            self.dirty.update(ids)
+
+    def clear(self):
+        with self.lock:
+            self.tree = None
+
+    def get(self, db: Session) -> List[dict]:
+        with self.lock:
+            if self.tree is None or perf_counter() - self.build_time > self.ttl:
+                self.build(db)
+            elif self.dirty:
+                self.patch(db)
+            return self.tree
+
+    def build(self, db: Session):
+        columns = tree_columns(self.model, self.belong_str, self.key_str, self.col_names)
+        node_list = [{**row, 'children': []} for row in db.execute(select(*columns)).mappings()]
+        self.tree, self.nodes_dic = build_tree(node_list, self.belong_str, self.key_str)
+        self.dirty = set()
+        self.build_time = perf_counter()
+
+    def detach(self, node: dict):
+        siblings = self.tree if not node[self.belong_str] else \
+            self.nodes_dic.get(node[self.belong_str], {}).get('children', [])
+        for index, sibling in enumerate(siblings):
+            if sibling is node:
+                del siblings[index]
+                break
+
+    def attach(self, node: dict):
+        if not node[self.belong_str]:
+            self.tree.append(node)
+        elif node[self.belong_str] in self.nodes_dic:
+            self.nodes_dic[node[self.belong_str]]['children'].append(node)
+
+    def patch(self, db: Session):
+        belong_str, key_str = self.belong_str, self.key_str
+        columns = tree_columns(self.model, belong_str, key_str, self.col_names)
+        ids = list(self.dirty)
+        rows = {}
+        for chunk in chunk_list(ids):
+            result = db.execute(select(*columns).where(columns[0].in_(chunk))).mappings()
+            rows.update({row[key_str]: row for row in result})
+        for id_value in ids:
+            node = self.nodes_dic.get(id_value)
+            row = rows.get(id_value)
+            if node is not None:
+                self.detach(node)
+            if row is None:
+                # 删除，下级节点和重建时一样找不到上级，不再出现在树里
+                self.nodes_dic.pop(id_value, None)
+                continue
+            if node is None:
+                node = {'children': []}
+                self.nodes_dic[id_value] = node
+            node.update(row)
+            self.attach(node)
+        # 先插入的下级在上级之前进来时没挂上，再挂一次
+        for id_value in ids:
+            node = self.nodes_dic.get(id_value)
+            if node is not None and node[belong_str] and not self.is_attached(node):
+                self.attach(node)
+        self.dirty = set()
+
+    def is_attached(self, node: dict) -> bool:
+        parent = self.nodes_dic.get(node[self.belong_str])
+        return parent is not None and any(child is node for child in parent['children'])
 
 
 def get_relation(col: InstrumentedAttribute):
@@ -377,6 +1773,11 @@ def get_relation_col_dic(model: Type[DeclarativeMeta]):
 # 一个模型的字段类型
 # 基本类型
 RelationType = Literal['m2m', 'm2o', 'o2m', 'o2o']
+# 字段的搜索方式，Column(info={'search': 'trgm'})，like查询按这个生成条件
+# trgm: postgresql pg_trgm的gin索引，查询还是LIKE
+# tsvector: postgresql全文检索，info里可以加search_config(默认simple)和search_column(已有的tsvector字段)
+# fulltext: mysql FULLTEXT索引，MATCH ... AGAINST
+SearchType = Literal['like', 'trgm', 'tsvector', 'fulltext']
 BaseType = Literal[
     'int', 'float', 'bool', 'str', 'date', 'datetime', 'list', 'time', 'any', 'enum', 'set', 'relation', "json", "jsonb"]
 
@@ -427,10 +1828,14 @@ class TypeInfo:
     col_org_type: ColOrgTypeEnum = None
     col_base_type: BaseType = None
     relation: Relation = None
+    search: SearchType = None
+    search_config: str = 'simple'  # tsvector的分词配置
+    search_column: str = None  # tsvector存在单独字段时的字段名
 
 
 class ModelConfig:
     cols: Dict[str, TypeInfo] = {}
+    col_names: List[str] = []  # 所有字段名，包括关系字段
     id_key: str = 'id'
 
 
@@ -463,19 +1868,18 @@ COL_ORG_TYPE_MAP = {
 
 
 def get_model_id_key(model: Type[DeclarativeMeta]):
-    id_keys = list(get_primary_keys(model).keys())
-    print(id_keys)
-    if id_keys:
-        return id_keys[0]
+    mapper = sa_inspect(model)
+    if mapper.primary_key:
+        return mapper.get_property_by_column(mapper.primary_key[0]).key
 
 
 def get_relation_info(col: InstrumentedAttribute) -> Relation:
     prop = col.property
     if isinstance(prop, Relationship):
         r = Relation()
-        source_model = col.property.parent.entity
+        source_model = prop.parent.class_
         source_id_key = get_model_id_key(source_model)
-        target_model = prop.entity.entity
+        target_model = prop.mapper.class_
         target_id_key = get_model_id_key(target_model)
         source_uselist = prop.uselist
         target_uselist = False
@@ -483,31 +1887,17 @@ def get_relation_info(col: InstrumentedAttribute) -> Relation:
         r.target_model = target_model
         r.source_id_key = source_id_key
         r.target_id_key = target_id_key
-        if col.property._user_defined_foreign_keys:
-            r.source_foreign_key = list(col.property._user_defined_foreign_keys)[0].name
-            print(r.source_foreign_key)
+        if prop._user_defined_foreign_keys:
+            r.source_foreign_key = list(prop._user_defined_foreign_keys)[0].name
         #  找到另一个表内反向引用的字段id
-        for name in get_model_col_names(target_model):
-            target_col = getattr(target_model, name)
-            col_org_type = get_type(target_col)
-            if source_model == col_org_type:
-                target_uselist = target_col.property.uselist
-            # 寻找是否右表有对应的foreign_key
-            if hasattr(target_col, 'foreign_keys'):
-                for foreign_key in list(target_col.foreign_keys):
-                    if foreign_key.column.table.name == source_model.__tablename__:
-                        r.source_key = foreign_key.column.key
-        #  找到本表内反向引用的字段id
-        # for name in get_model_col_names(source_model):
-        #     source_col = getattr(target_model, name)
-        #     col_org_type = get_type(source_col)
-        #     if target_model == col_org_type:
-        #         source_uselist = source_col.property.uselist
-        #     # 寻找是否右表有对应的foreign_key
-        #     if hasattr(source_col,'foreign_keys'):
-        #         for foreign_key in List[source_col.foreign_keys]:
-        #             if foreign_key.column.table.name==target_model.__tablename__:
-        #                 r.target_key=foreign_key.column.key
+        for target_prop in prop.mapper.relationships:
+            if target_prop.mapper.class_ == source_model:
+                target_uselist = target_prop.uselist
+        # 寻找是否右表有对应的foreign_key
+        for target_column in prop.mapper.columns:
+            for foreign_key in target_column.foreign_keys:
+                if foreign_key.column.table.name == source_model.__tablename__:
+                    r.source_key = foreign_key.column.key
         if (source_uselist and target_uselist) or prop.secondary is not None:
             r.relation_type = 'm2m'
             columns = prop.secondary.columns
@@ -541,86 +1931,183 @@ def get_relation_info(col: InstrumentedAttribute) -> Relation:
 
 def get_model_config(model: Type[DeclarativeMeta]) -> ModelConfig:
     """
-    这个接口获取一个sql模型的各种信息
+    这个接口获取一个sql模型的各种信息，字段和关系直接从mapper上取
     :param model:
     :return:
     """
 
     # 映射
 
+    mapper = sa_inspect(model)
     model_config = ModelConfig()
+    model_config.id_key = get_model_id_key(model) or model_config.id_key
     cols = {}
-    for col_name in dir(model):
-        col = getattr(model, col_name)
-        if isinstance(col, InstrumentedAttribute):
-            if hasattr(col, 'primary_key') and col.primary_key:
-                model_config.id_key = col_name
-            type_info = TypeInfo()
-            col_org_type = get_type(col).__class__.__name__
-            col_base_type = COL_ORG_TYPE_MAP.get(col_org_type) or 'any'
-            relation = get_relation_info(col)
-            type_info.col_org_type = col_org_type
-            type_info.col_base_type = col_base_type
-            type_info.relation = relation
-            cols[col_name] = type_info
+    for prop in mapper.column_attrs:
+        type_info = TypeInfo()
+        col_org_type = prop.columns[0].type.__class__.__name__
+        type_info.col_org_type = col_org_type
+        type_info.col_base_type = COL_ORG_TYPE_MAP.get(col_org_type) or 'any'
+        info = prop.columns[0].info
+        if info.get('search'):
+            type_info.search = info['search']
+            type_info.search_config = info.get('search_config', type_info.search_config)
+            type_info.search_column = info.get('search_column')
+        cols[prop.key] = type_info
+    for prop in mapper.relationships:
+        type_info = TypeInfo()
+        type_info.col_org_type = 'DeclarativeMeta'
+        type_info.col_base_type = 'relation'
+        type_info.relation = get_relation_info(getattr(model, prop.key))
+        cols[prop.key] = type_info
     model_config.cols = cols
+    model_config.col_names = list(cols.keys())
     return model_config
 
 
 def get_model_col_names(model: Type[DeclarativeMeta]):
-    columns = []
-    for col_name in dir(model):
-        if isinstance(getattr(model, col_name), InstrumentedAttribute):
-            columns.append(col_name)
+    return model.model_config.col_names
+
+
+class ModelRegistry:
+    """
+    模型配置注册表，启动时按declarative base一次性构建所有模型的ModelConfig
+    启动后才声明的模型第一次访问时再构建，构建都在锁里，多个线程同时访问同一个模型也只构建一次
+    """
+
+    def __init__(self):
+        self.configs: Dict[type, ModelConfig] = {}
+        self.lock = Lock()
+
+    def get(self, model) -> ModelConfig:
+        model_config = self.configs.get(model)
+        if model_config is None:
+            with self.lock:
+                model_config = self.configs.get(model)
+                if model_config is None:
+                    model_config = get_model_config(model)
+                    self.configs[model] = model_config
+        return model_config
+
+    def init_base(self, base) -> int:
+        """
+        构建一个declarative base下所有SalBase模型的配置，返回模型数量
+        """
+        sa_configure_mappers()
+        with self.lock:
+            models = [mapper.class_ for mapper in base.registry.mappers if issubclass(mapper.class_, SalBase)]
+            for model in models:
+                if model not in self.configs:
+                    self.configs[model] = get_model_config(model)
+        return len(models)
+
+
+model_registry = ModelRegistry()
+
+
+def tuple_getter(names: tuple):
+    """
+    attrgetter只有一个字段时返回的不是元组，统一成元组
+    """
+    if not names:
+        return lambda item: ()
+    if len(names) == 1:
+        getter = attrgetter(names[0])
+        return lambda item: (getter(item),)
+    return attrgetter(*names)
+
+
+class RowEncoder:
+    """
+    一个模型在一种include形状下的行编码器，输出和to_dict/to_full_dict一致
+    要输出的字段和取值函数只在第一次用到这种形状时算一次，之后每行就是一次attrgetter加zip
+    """
+
+    def __init__(self, model, col_names: Tuple[str, ...], relation_use_id=False, full=True):
+        cols: Dict[str, TypeInfo] = model.model_config.cols if full else {}
+        self.names = tuple(name for name in col_names if not (name in cols and cols[name].relation))
+        self.getter = tuple_getter(self.names)
+        self.relations = []
+        for name in col_names:
+            relation = name in cols and cols[name].relation
+            if relation:
+                self.relations.append((name, attrgetter(name), relation_encode(relation, relation_use_id)))
+
+    def __call__(self, item) -> dict:
+        data = dict(zip(self.names, self.getter(item)))
+        for name, getter, encode in self.relations:
+            data[name] = encode(getter(item))
+        return data
+
+
+def relation_encode(relation: Relation, relation_use_id=False):
+    if relation.relation_type in ['m2m', 'o2m']:
+        if relation_use_id:
+            id_getter = attrgetter(relation.target_id_key)
+            return lambda value: [id_getter(child) for child in value]
+        target_encoder = get_row_encoder(relation.target_model, full=False)
+        return lambda value: [target_encoder(child) for child in value]
+    if relation.relation_type in ['o2o', 'm2o']:
+        target_encoder = get_row_encoder(relation.target_model, full=False)
+        return lambda value: value and target_encoder(value)
+    return lambda value: value
 
-    return columns
+
+def row_encoder_names(model, include: List[str] = None, ex_include: List[str] = None, full=True) -> Tuple[str, ...]:
+    """
+    include/ex_include解析出要输出的字段，按模型里字段的顺序
+    """
+    if full:
+        all_names = list(model.model_config.cols.keys())
+    else:
+        all_names = [c.name for c in model.__table__.columns]
+    selected = marge_col_names(all_names, include, ex_include)
+    return tuple(name for name in all_names if name in selected)
+
+
+# LRU，key是前端传的include/ex_include，没命中时再按解析后的字段找，
+# include顺序、写法不同但字段相同的共用一个编码器，总数量有上限
+row_encoders = StatementCache(maxsize=512)
+
+
+def get_row_encoder(model, include: List[str] = None, ex_include: List[str] = None, relation_use_id=False,
+                    full=True) -> RowEncoder:
+    """
+    full=False对应to_dict，只有表字段
+    """
+    key = (model, include and tuple(include), ex_include and tuple(ex_include), bool(relation_use_id), full)
+    encoder = row_encoders.get(key)
+    if encoder is None:
+        col_names = row_encoder_names(model, include, ex_include, full)
+        names_key = (model, 'names', col_names, bool(relation_use_id), full)
+        encoder = row_encoders.get(names_key)
+        if encoder is None:
+            # 并发时可能重复构建，结果一样，不用加锁
+            encoder = RowEncoder(model, col_names, relation_use_id, full)
+            row_encoders.set(names_key, encoder)
+        row_encoders.set(key, encoder)
+    return encoder
+
+
+def encode_rows(model, items: list, query_include: QueryInclude = None) -> List[dict]:
+    """
+    一批数据转to_full_dict，同一个编码器只取一次
+    """
+    encoder = get_row_encoder(model, **include_kwargs(query_include))
+    return [encoder(item) for item in items]
 
 
 class SalBase:
-    __model_config: ModelConfig = None
 
     @classmethod
     @property
     def model_config(cls) -> ModelConfig:
-        if cls.__model_config is None:
-            cls.__model_config = 'process_ing'
-            cls.__model_config = get_model_config(cls)
-        return cls.__model_config
+        return model_registry.get(cls)
 
     def to_dict(self, include: List[str] = None, ex_include: List[str] = None):
-        col_names = marge_col_names([c.name for c in self.__table__.columns], include, ex_include)
-        data = {name: getattr(self, name) for name in col_names}
-        return data
+        return get_row_encoder(type(self), include, ex_include, full=False)(self)
 
     def to_full_dict(self, include: List[str] = None, ex_include: List[str] = None, relation_use_id=False):
-        col_names = marge_col_names(set(self.model_config.cols.keys()), include, ex_include)
-        data = {}
-        for col_name in col_names:
-            col = self.model_config.cols[col_name]
-            col_val = getattr(self, col_name)
-            relation = col.relation
-            if relation:
-                if relation.relation_type == 'm2m':
-                    if relation_use_id:
-                        col_data = [getattr(item, relation.target_id_key) for item in col_val]
-                    else:
-                        col_data = [item.to_dict() for item in col_val]
-                    data[col_name] = col_data
-                elif relation.relation_type == 'o2m':
-                    if relation_use_id:
-                        col_data = [getattr(item, relation.target_id_key) for item in col_val]
-                    else:
-                        col_data = [item.to_dict() for item in col_val]
-                    data[col_name] = col_data
-                elif relation.relation_type == 'o2o':
-                    data[col_name] = col_val and col_val.to_dict()
-                elif relation.relation_type == 'm2o':
-                    data[col_name] = col_val and col_val.to_dict()
-                else:
-                    data[col_name] = col_val
-            else:
-                data[col_name] = col_val
-        return data
+        return get_row_encoder(type(self), include, ex_include, relation_use_id)(self)
 
 
 class TableModel(DeclarativeMeta, SalBase):
@@ -628,6 +2115,19 @@ class TableModel(DeclarativeMeta, SalBase):
 
 
 def handle_db_errors(func):
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except IntegrityError as e:
+                if 'UniqueViolation' in str(e.args):
+                    raise HTTPException(status_code=400, detail="数据重复")
+                else:
+                    raise e
+
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         try:
@@ -641,13 +2141,70 @@ def handle_db_errors(func):
     return wrapper
 
 
+BULK_CHUNK_SIZE = 500  # 批量操作每条语句的行数
+
+
+class BulkItemError(BaseModel):
+    index: int  # 在提交列表里的下标
+    detail: str
+
+
+class BulkResult(BaseModel):
+    """
+    批量操作结果，ids和提交顺序一致，出错的数据不在ids里
+    """
+    success: int = 0
+    ids: List[Any] = []
+    errors: List[BulkItemError] = []
+
+
+def db_error_detail(e: DBAPIError) -> str:
+    if 'UniqueViolation' in str(e.args) or 'Duplicate entry' in str(e.args) or 'UNIQUE constraint' in str(e.args):
+        return "数据重复"
+    return str(e.orig)
+
+
+def chunk_list(items: list, size: int = BULK_CHUNK_SIZE):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
 class ModelCRUD:
 
-    def __init__(self, model: Type[TableModel]):
+    def __init__(self, model: Type[TableModel], upsert_keys: List[str] = None, upsert_constraint: str = None,
+                 cache: EntityCache = None, cache_ttl: int = None, query_cache: QueryCache = None,
+                 tree_cache: TreeCache = None):
+        """
+        :param upsert_keys: upsert判断冲突的字段，默认主键
+        :param upsert_constraint: postgresql下也可以直接指定唯一约束名
+        :param cache: 实体缓存，给了之后get_dict走缓存，写入时清掉相关缓存
+        :param cache_ttl: 这个模型的缓存秒数，默认用cache的default_ttl
+        :param query_cache: 列表查询缓存，给了之后query_page_dict走缓存，写入时更新相关表的版本号
+        :param tree_cache: 树表缓存，写入时标记改动的节点
+        """
         self.model = model
+        self.upsert_keys = upsert_keys
+        self.upsert_constraint = upsert_constraint
+        self.cache = cache
+        self.query_cache = query_cache
+        self.tree_cache = tree_cache
+        if cache and cache_ttl:
+            cache.set_ttl(model, cache_ttl)
+
+    def after_write(self, ids: list, data_list: List[dict] = ()):
+        """
+        写入提交后调用，ids是改动的数据id，data_list是提交的字段，用来找到新关联上的数据
+        """
+        if self.cache:
+            self.cache.invalidate(self.model, ids, data_list)
+        if self.query_cache:
+            self.query_cache.bump(self.model)
+        if self.tree_cache:
+            self.tree_cache.mark_dirty(ids)
 
     @handle_db_errors
     def update(self, db: Session, data: BaseModel):
+        use_primary(db)
         model = self.model
         id_key = self.model.model_config.id_key
         item = db.query(model).filter(getattr(model, id_key) == (getattr(data, id_key))).first()
@@ -696,18 +2253,35 @@ class ModelCRUD:
                 else:
                     setattr(item, k, v)
         db.commit()
+        self.after_write([getattr(item, id_key)], [data])
         db.refresh(item)
         return item
 
     @handle_db_errors
-    def get(self, db: Session, data: BaseModel):
-        item = db.query(self.model).filter(getattr(self.model, self.model.model_config.id_key) == (
-            getattr(data, self.model.model_config.id_key))).first()
+    def get(self, db: Session, data: BaseModel, query_include: QueryInclude = None):
+        item = db.query(self.model).options(*query_load_options(self.model, query_include)).filter(
+            getattr(self.model, self.model.model_config.id_key) == (
+                getattr(data, self.model.model_config.id_key))).first()
         return item
 
+    def get_dict(self, db: Session, data: BaseModel, query_include: QueryInclude = None) -> Optional[dict]:
+        """
+        返回to_full_dict的结果，配置了cache时先读缓存
+        """
+        id_value = getattr(data, self.model.model_config.id_key)
+        if self.cache:
+            cached = self.cache.get(self.model, id_value, query_include)
+            if cached is not None:
+                return cached
+        item = self.get(db, data, query_include)
+        if item is None:
+            return None
+        full = item.to_full_dict(**include_kwargs(query_include))
+        return self.cache.set(self.model, id_value, full, query_include) if self.cache else full
+
     @handle_db_errors
     def add(self, db: Session, data: BaseModel):
-
+        use_primary(db)
         model = self.model
         item = model()
         data = data.dict(exclude_unset=True)
@@ -732,6 +2306,7 @@ class ModelCRUD:
                     setattr(item, k, v)
         db.add(item)
         db.commit()
+        self.after_write([getattr(item, model.model_config.id_key)], [data])
         db.refresh(item)
         return item
 
@@ -739,13 +2314,537 @@ class ModelCRUD:
     def query(self, db: Session, data: QueryParams) -> (int, List[Any]):
         return query_common(db, self.model, data)
 
+    @handle_db_errors
+    def query_page(self, db: Session, data: QueryParams) -> PageData:
+        return query_page(db, self.model, data)
+
+    @handle_db_errors
+    def query_rows(self, db: Session, data: QueryParams) -> PageData:
+        return query_rows(db, self.model, data)
+
+    def query_page_dict(self, db: Session, data: QueryParams) -> dict:
+        """
+        query_page的结果转成dict，items按include/ex_include输出，配置了query_cache时先读缓存
+        """
+        key = self.query_cache and self.query_cache.key(self.model, data)
+        if key:
+            cached = self.query_cache.get(key)
+            if cached is not None:
+                return cached
+        result = page_data_dict(self.model, self.query_page(db, data), data)
+        return self.query_cache.set(key, result) if self.query_cache else result
+
+    def export(self, session_factory, data: QueryParams, export_format: ExportFormat = 'ndjson',
+               batch_size: int = EXPORT_BATCH_SIZE, request: Request = None) -> StreamingResponse:
+        """
+        流式导出，session_factory传SqlalchemyConnect.get_db_i
+        """
+        return export_response(session_factory, self.model, data, export_format, batch_size, request)
+
     @handle_db_errors
     def delete(self, db: Session, data: BaseModel):
+        use_primary(db)
         db.query(self.model).filter(getattr(self.model, self.model.model_config.id_key) == (
             getattr(data, self.model.model_config.id_key))).delete()
         db.commit()
+        self.after_write([getattr(data, self.model.model_config.id_key)])
         return True
 
+    def bulk_items(self, db: Session, data_list: List[BaseModel], result: BulkResult) -> list:
+        """
+        把提交的数据拆成 (下标, 字段值, 多对多id) ，多对多的目标id按关系一次查完，不存在的记为错误
+        批量操作不走ORM对象，一对一的嵌套数据不支持
+        """
+        model_config: ModelConfig = self.model.model_config
+        items = []
+        for index, data in enumerate(data_list):
+            values, links, error = {}, {}, None
+            for k, v in data.dict(exclude_unset=True).items():
+                col_type_info: TypeInfo = model_config.cols.get(k.split('.')[0])
+                if not col_type_info:
+                    continue
+                relation = col_type_info.relation
+                if '.' in k or (relation and relation.relation_type == 'o2o'):
+                    error = f"批量操作不支持一对一字段: {k}"
+                elif relation:
+                    if relation.relation_type == 'm2m' and v is not None:
+                        links[k] = [child[relation.target_id_key] if type(child) == dict else child for child in v]
+                else:
+                    values[k] = v
+            if error:
+                result.errors.append(BulkItemError(index=index, detail=error))
+            else:
+                items.append((index, values, links))
+
+        missing = {}
+        for k in {k for _, _, links in items for k in links}:
+            relation = model_config.cols[k].relation
+            target_id = getattr(relation.target_model, relation.target_id_key)
+            ids = list({child for _, _, links in items for child in links.get(k, [])})
+            exists = set()
+            for chunk in chunk_list(ids):
+                exists.update(db.scalars(select(target_id).filter(target_id.in_(chunk))))
+            missing[k] = set(ids) - exists
+        checked = []
+        for index, values, links in items:
+            lost = [f"{k}: {child}" for k, children in links.items() for child in children if child in missing[k]]
+            if lost:
+                result.errors.append(BulkItemError(index=index, detail=f"关联数据不存在 {', '.join(lost)}"))
+            else:
+                checked.append((index, values, links))
+        return checked
+
+    def bulk_existing_ids(self, db: Session, ids: list) -> set:
+        id_col = getattr(self.model, self.model.model_config.id_key)
+        exists = set()
+        for chunk in chunk_list(list(set(ids))):
+            exists.update(db.scalars(select(id_col).filter(id_col.in_(chunk))))
+        return exists
+
+    def bulk_run(self, db: Session, chunk: list, execute, result: BulkResult) -> dict:
+        """
+        一块数据先整体在savepoint里执行，失败再逐条执行找出出错的那几条
+        execute(rows) 返回每行的id
+        """
+        try:
+            with db.begin_nested():
+                return dict(zip([index for index, _ in chunk], execute([row for _, row in chunk])))
+        except DBAPIError as e:
+            if len(chunk) == 1:
+                result.errors.append(BulkItemError(index=chunk[0][0], detail=db_error_detail(e)))
+                return {}
+            done = {}
+            for index, row in chunk:
+                try:
+                    with db.begin_nested():
+                        done[index] = execute([row])[0]
+                except DBAPIError as e:
+                    result.errors.append(BulkItemError(index=index, detail=db_error_detail(e)))
+            return done
+
+    def bulk_insert_rows(self, db: Session, rows: List[dict]) -> list:
+        """
+        postgresql等支持executemany RETURNING的一条多行INSERT拿回id
+        mysql没有RETURNING，带id的数据executemany，没带id的再单独插入：
+        自增id用一条多行 INSERT ... VALUES，LAST_INSERT_ID()是这条语句的第一个id，
+        InnoDB给行数已知的INSERT一次分配好连续的自增id(间隔auto_increment_increment)，按行数推出所有id
+        其他情况逐条插入取自增id，返回的id顺序和rows一致
+        """
+        model = self.model
+        id_key = model.model_config.id_key
+        dialect = db.get_bind().dialect
+        if getattr(dialect, 'insert_executemany_returning_sort_by_parameter_order', False):
+            stmt = insert(model).returning(getattr(model, id_key), sort_by_parameter_order=True)
+            return list(db.scalars(stmt, rows))
+        ids = [row.get(id_key) for row in rows]
+        explicit = [row for row in rows if row.get(id_key) is not None]
+        if explicit:
+            db.execute(insert(model), explicit)
+        auto = [index for index, id_value in enumerate(ids) if id_value is None]
+        autoincrement = model.__table__.autoincrement_column
+        if (len(auto) > 1 and dialect.name in ['mysql', 'mariadb'] and autoincrement is not None
+                and autoincrement.key == id_key):
+            result = db.execute(insert(model).values([{k: v for k, v in rows[index].items() if k != id_key}
+                                                      for index in auto]))
+            step = db.execute(text('SELECT @@auto_increment_increment')).scalar() or 1
+            for offset, index in enumerate(auto):
+                ids[index] = result.lastrowid + offset * step
+            return ids
+        for index in auto:
+            ids[index] = db.execute(insert(model).values(**rows[index])).inserted_primary_key[0]
+        return ids
+
+    def bulk_set_links(self, db: Session, links: Dict[Any, Dict[str, list]], replace=False):
+        """
+        多对多中间表按关系批量写入，links: {id: {字段: [目标id]}}，中间表左表字段对应的是左表id
+        replace时先删掉这些数据原有的关联
+        """
+        model_config: ModelConfig = self.model.model_config
+        for k in {k for item_links in links.values() for k in item_links}:
+            relation = model_config.cols[k].relation
+            secondary = relation.secondary
+            source_col = secondary.c[relation.source_secondary_key]
+            source_ids = [id_value for id_value, item_links in links.items() if k in item_links]
+            if replace:
+                for chunk in chunk_list(source_ids):
+                    db.execute(delete(secondary).where(source_col.in_(chunk)))
+            rows = [{relation.source_secondary_key: id_value, relation.target_secondary_key: child}
+                    for id_value in source_ids for child in dict.fromkeys(links[id_value][k])]
+            for chunk in chunk_list(rows):
+                db.execute(insert(secondary), chunk)
+
+    @handle_db_errors
+    def bulk_add(self, db: Session, data_list: List[BaseModel]) -> BulkResult:
+        """
+        批量新增，在一个事务里完成，字段相同的数据一起插入，多对多关联一次写入
+        单条出错只记录在errors里，不影响其他数据
+        """
+        result, written = self.bulk_add_rows(db, data_list)
+        self.after_write(*written)
+        return result
+
+    def bulk_add_rows(self, db: Session, data_list: List[BaseModel]) -> Tuple[BulkResult, tuple]:
+        """
+        bulk_add的数据库部分，返回 (结果, after_write的参数)，异步版本在run_sync里调用
+        """
+        use_primary(db)
+        result = BulkResult()
+        items = self.bulk_items(db, data_list, result)
+        groups = {}
+        for index, values, links in items:
+            groups.setdefault(tuple(sorted(values)), []).append((index, values))
+        ids = {}
+        for group in groups.values():
+            for chunk in chunk_list(group):
+                ids.update(self.bulk_run(db, chunk, lambda rows: self.bulk_insert_rows(db, rows), result))
+        self.bulk_set_links(db, {ids[index]: links for index, _, links in items if index in ids and links})
+        db.commit()
+        result.ids = [ids[index] for index in sorted(ids)]
+        result.success = len(ids)
+        result.errors.sort(key=lambda error: error.index)
+        return result, (list(ids.values()), [{**values, **links} for index, values, links in items if index in ids])
+
+    @handle_db_errors
+    def bulk_update(self, db: Session, data_list: List[BaseModel]) -> BulkResult:
+        """
+        按id批量更新，改动字段相同的数据一起按主键批量UPDATE，多对多关联整体替换
+        """
+        result, written = self.bulk_update_rows(db, data_list)
+        self.after_write(*written)
+        return result
+
+    def bulk_update_rows(self, db: Session, data_list: List[BaseModel]) -> Tuple[BulkResult, tuple]:
+        use_primary(db)
+        model = self.model
+        id_key = model.model_config.id_key
+        result = BulkResult()
+        items = []
+        for index, values, links in self.bulk_items(db, data_list, result):
+            if values.get(id_key) is None:
+                result.errors.append(BulkItemError(index=index, detail=f"缺少{id_key}"))
+            else:
+                items.append((index, values, links))
+        exists = self.bulk_existing_ids(db, [values[id_key] for _, values, _ in items])
+
+        def execute(rows):
+            db.execute(update(model), rows)
+            return [row[id_key] for row in rows]
+
+        groups = {}
+        ids = {}
+        for index, values, links in items:
+            if values[id_key] not in exists:
+                result.errors.append(BulkItemError(index=index, detail="数据不存在"))
+            elif len(values) == 1:
+                ids[index] = values[id_key]  # 只改多对多
+            else:
+                groups.setdefault(tuple(sorted(values)), []).append((index, values))
+        for group in groups.values():
+            for chunk in chunk_list(group):
+                ids.update(self.bulk_run(db, chunk, execute, result))
+        self.bulk_set_links(db, {ids[index]: links for index, _, links in items if index in ids and links},
+                            replace=True)
+        db.commit()
+        result.ids = [ids[index] for index in sorted(ids)]
+        result.success = len(ids)
+        result.errors.sort(key=lambda error: error.index)
+        return result, (list(ids.values()), [{**values, **links} for index, values, links in items if index in ids])
+
+    @handle_db_errors
+    def bulk_delete(self, db: Session, data_list: List[BaseModel]) -> BulkResult:
+        """
+        按id分块 DELETE ... WHERE id IN，中间表数据靠外键级联删除
+        """
+        result, written = self.bulk_delete_rows(db, data_list)
+        self.after_write(*written)
+        return result
+
+    def bulk_delete_rows(self, db: Session, data_list: List[BaseModel]) -> Tuple[BulkResult, tuple]:
+        use_primary(db)
+        model = self.model
+        id_key = model.model_config.id_key
+        id_col = getattr(model, id_key)
+        result = BulkResult()
+        exists = self.bulk_existing_ids(db, [getattr(data, id_key) for data in data_list])
+        chunk = []
+        for index, data in enumerate(data_list):
+            if getattr(data, id_key) in exists:
+                chunk.append((index, getattr(data, id_key)))
+            else:
+                result.errors.append(BulkItemError(index=index, detail="数据不存在"))
+
+        def execute(rows):
+            db.execute(delete(model).where(id_col.in_(rows)).execution_options(synchronize_session=False))
+            return rows
+
+        ids = {}
+        for part in chunk_list(chunk):
+            ids.update(self.bulk_run(db, part, execute, result))
+        db.commit()
+        result.ids = [ids[index] for index in sorted(ids)]
+        result.success = len(ids)
+        result.errors.sort(key=lambda error: error.index)
+        return result, (list(ids.values()),)
+
+    def upsert_rows(self, db: Session, rows: List[dict], keys: List[str], constraint: str = None) -> list:
+        """
+        同样字段的一组数据一条语句upsert，返回upsert后的对象，顺序和rows一致
+        postgresql/sqlite用 ON CONFLICT DO UPDATE ... RETURNING
+        mysql用 ON DUPLICATE KEY UPDATE，冲突判断是表上所有唯一键，没有RETURNING所以按keys再查一次
+        """
+        model = self.model
+        dialect_name = get_dialect_name(db)
+        update_keys = [k for k in rows[0] if k not in keys] or keys
+        if dialect_name == 'mysql':
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(model)
+            db.execute(stmt.on_duplicate_key_update({k: stmt.inserted[k] for k in update_keys}), rows)
+            key_cols = [getattr(model, k) for k in keys]
+            key_values = [tuple(row[k] for k in keys) for row in rows]
+            if len(keys) == 1:
+                where = key_cols[0].in_([value[0] for value in key_values])
+            else:
+                where = tuple_(*key_cols).in_(key_values)
+            items = {tuple(getattr(item, k) for k in keys): item for item in
+                     db.scalars(select(model).filter(where).execution_options(populate_existing=True))}
+            return [items[value] for value in key_values]
+        if dialect_name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect_name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            raise HTTPException(status_code=400, detail=f"{dialect_name}不支持upsert")
+        stmt = dialect_insert(model)
+        conflict = {'constraint': constraint} if constraint and dialect_name == 'postgresql' else {
+            'index_elements': keys}
+        stmt = stmt.on_conflict_do_update(**conflict, set_={k: stmt.excluded[k] for k in update_keys})
+        stmt = stmt.returning(model, sort_by_parameter_order=True)
+        return list(db.scalars(stmt, rows, execution_options={'populate_existing': True}))
+
+    @handle_db_errors
+    def bulk_upsert(self, db: Session, data_list: List[BaseModel], upsert_keys: List[str] = None,
+                    upsert_constraint: str = None) -> list:
+        """
+        批量upsert，冲突字段按 参数 > 初始化时的配置 > 主键，数据里必须带上冲突字段
+        多对多字段整体替换，返回结果对象，顺序和data_list一致
+        """
+        items, written = self.bulk_upsert_rows(db, data_list, upsert_keys, upsert_constraint)
+        self.after_write(*written)
+        return items
+
+    def bulk_upsert_rows(self, db: Session, data_list: List[BaseModel], upsert_keys: List[str] = None,
+                         upsert_constraint: str = None) -> Tuple[list, tuple]:
+        use_primary(db)
+        model = self.model
+        keys = upsert_keys or self.upsert_keys or [model.model_config.id_key]
+        constraint = upsert_constraint or self.upsert_constraint
+        result = BulkResult()
+        items = self.bulk_items(db, data_list, result)
+        for index, values, _ in items:
+            lost = [k for k in keys if values.get(k) is None]
+            if lost:
+                result.errors.append(BulkItemError(index=index, detail=f"缺少{','.join(lost)}"))
+        if result.errors:
+            raise HTTPException(status_code=400, detail=[error.dict() for error in result.errors])
+        groups = {}
+        for index, values, _ in items:
+            groups.setdefault(tuple(sorted(values)), []).append((index, values))
+        upserted = {}
+        for group in groups.values():
+            for chunk in chunk_list(group):
+                rows = self.upsert_rows(db, [values for _, values in chunk], keys, constraint)
+                upserted.update(zip([index for index, _ in chunk], rows))
+        id_key = model.model_config.id_key
+        self.bulk_set_links(db, {getattr(upserted[index], id_key): links for index, _, links in items if links},
+                            replace=True)
+        db.commit()
+        return [upserted[index] for index in sorted(upserted)], (
+            [getattr(item, id_key) for item in upserted.values()], [{**values, **links} for _, values, links in items])
+
+    def upsert(self, db: Session, data: BaseModel, upsert_keys: List[str] = None, upsert_constraint: str = None):
+        return self.bulk_upsert(db, [data], upsert_keys, upsert_constraint)[0]
+
+
+class AsyncModelCRUD(ModelCRUD):
+    """
+    ModelCRUD的异步版本，配合SqlalchemyConnect.get_async_db使用，共用同一份ModelConfig
+    异步session里不能懒加载，to_full_dict的include/ex_include要和查询时传的一致
+    """
+
+    def select_by_id(self, id_value, query_include: QueryInclude = None):
+        model = self.model
+        return select(model).options(*query_load_options(model, query_include)).filter(
+            getattr(model, model.model_config.id_key) == id_value)
+
+    async def load_targets(self, db: AsyncSession, relation: Relation, ids):
+        target_model = relation.target_model
+        result = await db.execute(select(target_model).filter(getattr(target_model, relation.target_id_key).in_(ids)))
+        return set(result.scalars().all())
+
+    async def reload(self, db: AsyncSession, item):
+        id_value = getattr(item, self.model.model_config.id_key)
+        result = await db.execute(self.select_by_id(id_value).execution_options(populate_existing=True))
+        return result.scalars().first()
+
+    @handle_db_errors
+    async def update(self, db: AsyncSession, data: BaseModel):
+        use_primary(db)
+        model = self.model
+        model_config: ModelConfig = model.model_config
+        id_key = model_config.id_key
+        item = (await db.execute(self.select_by_id(getattr(data, id_key)))).scalars().first()
+        data = data.dict(exclude_unset=True)
+        col_names = get_model_col_names(model)
+        for k, v in data.items():
+            if '.' in k:
+                paths = k.split('.')
+                if paths[0] in col_names:
+                    col_type_info: TypeInfo = model_config.cols[paths[0]]
+                    if col_type_info.relation:
+                        # 一对一时，{"config.age":1}
+                        relation = col_type_info.relation
+                        if relation.relation_type in ["o2o"]:
+                            col = getattr(item, paths[0])
+                            if not col:
+                                if v is not None:
+                                    setattr(item, paths[0], relation.target_model(**{paths[1]: v}))
+                            else:
+                                setattr(col, paths[1], v)
+            if k in col_names:
+                col_type_info: TypeInfo = model_config.cols[k]
+                relation = col_type_info.relation
+                if relation:
+                    if relation.relation_type in ['m2m']:
+                        if v is not None:
+                            if v and type(v[0]) == dict:
+                                v = [child[model_config.id_key] for child in v]
+                            setattr(item, k, await self.load_targets(db, relation, v))
+                    elif relation.relation_type == 'o2o':
+                        if type(v) == dict:
+                            col = getattr(item, k)
+                            if not col:
+                                setattr(item, k, relation.target_model(**v))
+                            else:
+                                for v_k, v_v in v.items():
+                                    setattr(col, v_k, v_v)
+                else:
+                    setattr(item, k, v)
+        await db.commit()
+        await run_in_threadpool(self.after_write, [getattr(item, id_key)], [data])
+        return await self.reload(db, item)
+
+    @handle_db_errors
+    async def get(self, db: AsyncSession, data: BaseModel, query_include: QueryInclude = None):
+        id_key = self.model.model_config.id_key
+        return (await db.execute(self.select_by_id(getattr(data, id_key), query_include))).scalars().first()
+
+    async def get_dict(self, db: AsyncSession, data: BaseModel, query_include: QueryInclude = None) -> Optional[dict]:
+        # redis客户端是同步的，放到线程池里执行
+        id_value = getattr(data, self.model.model_config.id_key)
+        if self.cache:
+            cached = await run_in_threadpool(self.cache.get, self.model, id_value, query_include)
+            if cached is not None:
+                return cached
+        item = await self.get(db, data, query_include)
+        if item is None:
+            return None
+        full = item.to_full_dict(**include_kwargs(query_include))
+        if self.cache:
+            return await run_in_threadpool(self.cache.set, self.model, id_value, full, query_include)
+        return full
+
+    @handle_db_errors
+    async def add(self, db: AsyncSession, data: BaseModel):
+        use_primary(db)
+        model = self.model
+        item = model()
+        data = data.dict(exclude_unset=True)
+        col_names = get_model_col_names(model)
+        for k, v in data.items():
+            if k in col_names:
+                col_type_info: TypeInfo = model.model_config.cols[k]
+                relation = col_type_info.relation
+                if relation:
+                    if relation.relation_type == 'm2m':
+                        if v is not None:
+                            setattr(item, k, await self.load_targets(db, relation, v))
+                    elif relation.relation_type == 'o2o':
+                        if type(v) == dict:
+                            setattr(item, k, relation.target_model(**v))
+                else:
+                    setattr(item, k, v)
+        db.add(item)
+        await db.commit()
+        await run_in_threadpool(self.after_write, [getattr(item, model.model_config.id_key)], [data])
+        return await self.reload(db, item)
+
+    @handle_db_errors
+    async def query(self, db: AsyncSession, data: QueryParams) -> (int, List[Any]):
+        return await query_common_async(db, self.model, data)
+
+    @handle_db_errors
+    async def query_page(self, db: AsyncSession, data: QueryParams) -> PageData:
+        return await query_page_async(db, self.model, data)
+
+    @handle_db_errors
+    async def query_rows(self, db: AsyncSession, data: QueryParams) -> PageData:
+        # 结果已经是dict，不涉及懒加载，直接复用同步实现
+        return await db.run_sync(query_rows, self.model, data)
+
+    async def query_page_dict(self, db: AsyncSession, data: QueryParams) -> dict:
+        key = self.query_cache and await run_in_threadpool(self.query_cache.key, self.model, data)
+        if key:
+            cached = await run_in_threadpool(self.query_cache.get, key)
+            if cached is not None:
+                return cached
+        result = page_data_dict(self.model, await self.query_page(db, data), data)
+        return await run_in_threadpool(self.query_cache.set, key, result) if self.query_cache else result
+
+    @handle_db_errors
+    async def delete(self, db: AsyncSession, data: BaseModel):
+        use_primary(db)
+        id_key = self.model.model_config.id_key
+        await db.execute(delete(self.model).where(getattr(self.model, id_key) == getattr(data, id_key)))
+        await db.commit()
+        await run_in_threadpool(self.after_write, [getattr(data, id_key)])
+        return True
+
+    # 批量操作都是Core语句，数据库部分在run_sync里复用同步实现，缓存失效和其他方法一样放到线程池里
+    @handle_db_errors
+    async def bulk_add(self, db: AsyncSession, data_list: List[BaseModel]) -> BulkResult:
+        result, written = await db.run_sync(self.bulk_add_rows, data_list)
+        await run_in_threadpool(self.after_write, *written)
+        return result
+
+    @handle_db_errors
+    async def bulk_update(self, db: AsyncSession, data_list: List[BaseModel]) -> BulkResult:
+        result, written = await db.run_sync(self.bulk_update_rows, data_list)
+        await run_in_threadpool(self.after_write, *written)
+        return result
+
+    @handle_db_errors
+    async def bulk_delete(self, db: AsyncSession, data_list: List[BaseModel]) -> BulkResult:
+        result, written = await db.run_sync(self.bulk_delete_rows, data_list)
+        await run_in_threadpool(self.after_write, *written)
+        return result
+
+    @handle_db_errors
+    async def bulk_upsert(self, db: AsyncSession, data_list: List[BaseModel], upsert_keys: List[str] = None,
+                          upsert_constraint: str = None) -> list:
+        items, written = await db.run_sync(self.bulk_upsert_rows, data_list, upsert_keys, upsert_constraint)
+        await run_in_threadpool(self.after_write, *written)
+        # 多对多关联是直接写的中间表，重新查一次把关系加载上
+        id_key = self.model.model_config.id_key
+        ids = [getattr(item, id_key) for item in items]
+        result = await db.execute(select(self.model).options(*query_load_options(self.model)).filter(
+            getattr(self.model, id_key).in_(ids)).execution_options(populate_existing=True))
+        loaded = {getattr(item, id_key): item for item in result.scalars()}
+        return [loaded[id_value] for id_value in ids]
+
+    async def upsert(self, db: AsyncSession, data: BaseModel, upsert_keys: List[str] = None,
+                     upsert_constraint: str = None):
+        return (await self.bulk_upsert(db, [data], upsert_keys, upsert_constraint))[0]
+
 
 def make_link_table(base: declarative_base, left: str, right: str, table_name="") -> Table:
     link_table = Table(